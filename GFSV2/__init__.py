@@ -1,9 +1,15 @@
  
 # Default: setting time zone to UTC
-import os, pkg_resources
+import os
 os.environ["TZ"] = "UTC"
 
-version = pkg_resources.require(__package__)[0].version
+# importlib.metadata is considerably faster than importing pkg_resources
+try:
+   from importlib.metadata import version as _version
+   version = _version(__package__)
+except ImportError:
+   import pkg_resources
+   version = pkg_resources.require(__package__)[0].version
 
 print("""
               This is {:s} version {:s} 
@@ -16,3 +22,8 @@ from .readConfig         import readConfig
 from .getInventory       import getInventory
 from .inputCheck         import inputCheck
 from .download           import download
+from .session            import curlSession
+from .pipeline           import downloadAsync
+from .processPool        import downloadDates
+from .planner            import plan
+from .stream             import iterMessages
@@ -0,0 +1,359 @@
+# -------------------------------------------------------------------
+# - NAME:        daemon.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Long-running download daemon. Keeps the parsed config
+#                files, the curl sessions (open connections) and the
+#                inventory cache warm and processes download jobs
+#                submitted via a local Unix socket (see GFSV2_client)
+#                and/or a job directory.
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.daemon")
+
+import os, tempfile
+
+# Default socket; GFSV2_client uses the same default.
+DEFAULT_SOCKET = os.path.join(os.environ.get("XDG_RUNTIME_DIR", tempfile.gettempdir()), "GFSV2.sock")
+
+class downloadDaemon:
+   """Processes download jobs. Jobs are dicts (JSON objects) with the
+   following (optional) keys:
+
+   * ``config``: config file; the package default config if not set.
+   * ``version``: GFS reforecast version (2 or 12).
+   * ``param``, ``levels``, ``members``: parameters to be downloaded
+     (as GFSV2_get); the ``[data ...]`` sections of the config file
+     are used if not set.
+   * ``steps``: forecast steps, overrules the config file.
+   * ``dates``: list of dates (``YYYY-mm-dd``); the date range of the
+     config file is used if not set.
+   * ``jobs``: number of parallel connections.
+
+   Config files are parsed once (and again if modified); one curl
+   session is kept per config file. Jobs are processed one after
+   another by a worker thread.
+
+   Params
+   ------
+   socket : None or str
+        Unix socket to listen on. Each request is one JSON object per
+        line, the daemon answers with one JSON object per line. Besides
+        download jobs the commands ``{"command": "status"}`` and
+        ``{"command": "shutdown"}`` are supported.
+   jobdir : None or str
+        Directory polled for job files (``*.json``). Results are written
+        to ``<name>.result.json``, the job file is removed.
+   poll : float
+        Seconds between two checks of 'jobdir'.
+
+   Return
+   ------
+   No return, initializes an object of class downloadDaemon.
+
+   Example
+   -------
+   >>> daemon = downloadDaemon(socket = "/tmp/GFSV2.sock")
+   >>> daemon.serve()
+   """
+
+   def __init__(self, socket = None, jobdir = None, poll = 1.):
+      import threading, queue, time
+      assert isinstance(socket, (type(None), str)), TypeError("Argument 'socket' must be None or str")
+      assert isinstance(jobdir, (type(None), str)), TypeError("Argument 'jobdir' must be None or str")
+      assert socket or jobdir, ValueError("Requires 'socket' and/or 'jobdir'")
+
+      self.socket   = socket
+      self.jobdir   = jobdir
+      self.poll     = float(poll)
+      self.started  = time.time()
+      self.done     = 0
+      self.failed   = 0
+      self._lock    = threading.Lock()
+      self._configs = {}  # (config file, version) -> (mtime, config, session)
+      self._queue   = queue.Queue()
+      self._stop    = threading.Event()
+      self._server  = None
+      self._thread  = None
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def config(self, file = None, version = None):
+      """config(file = None, version = None)
+
+      Params
+      ------
+      file : None or str
+         Config file, None for the package default config.
+      version : None or int
+         Forces the GFS reforecast version.
+
+      Return
+      ------
+      Returns a tuple (config, session); the config is only read again
+      if the file has been modified since.
+      """
+      from GFSV2.readConfig import readConfig
+      from GFSV2.session import curlSession
+
+      key   = (os.path.abspath(file) if file else None, version)
+      mtime = os.path.getmtime(file) if file else None
+      with self._lock:
+         if not key in self._configs or self._configs[key][0] != mtime:
+            if key in self._configs:
+               log.info(f"Config file {file} modified, reading again")
+               self._configs[key][2].close()
+            config = readConfig(file, force_version = version)
+            self._configs[key] = (mtime, config, curlSession(config))
+         return self._configs[key][1:]
+
+   def run(self, job):
+      """run(job)
+
+      Processes one job.
+
+      Params
+      ------
+      job : dict
+         Job specification, see downloadDaemon.
+
+      Return
+      ------
+      dict : Result with the keys 'status' ("ok" or "error"),
+      'downloaded', 'missing' (number of files), 'elapsed' (seconds)
+      and 'error' (message or None).
+      """
+      import copy, time
+      import datetime as dt
+      from GFSV2.download import download, _jobs
+
+      timer = time.monotonic()
+      try:
+         version         = job.get("version")
+         base, session   = self.config(job.get("config"), version)
+         config          = copy.copy(base)
+         if version: config.version = version
+         if job.get("param"):
+            members     = bool(job.get("members", False)) or config.version == 12
+            config.data = {x: {"members": members, "levels": job.get("levels")} for x in job["param"]}
+            config.steps = job.get("steps")
+         elif job.get("steps"):
+            config.steps = job.get("steps")
+         if job.get("jobs"): config.curl_max_connections = int(job["jobs"])
+
+         if job.get("dates"):
+            dates = [dt.datetime.strptime(x, "%Y-%m-%d") for x in job["dates"]]
+         else:
+            dates = [config.main_from + dt.timedelta(i) for i in range((config.main_to - config.main_from).days + 1)]
+            if config.main_only: dates = [x for x in dates if x.month == config.main_only]
+
+         todo = sum([len(_jobs(config, x, extend = False)) for x in dates])
+         for date in dates:
+            log.info("Processing date {:s}".format(date.strftime("%Y-%m-%d %HZ")))
+            download(config, date, session = session)
+         missing = sum([len(_jobs(config, x, extend = False)) for x in dates])
+         res = {"status": "ok", "downloaded": todo - missing, "missing": missing, "error": None}
+      except (Exception, SystemExit) as e:
+         # readConfig and the inventory parser exit on errors
+         log.error(f"Job failed: {e}")
+         res = {"status": "error", "downloaded": 0, "missing": None, "error": str(e) or type(e).__name__}
+      res["elapsed"] = round(time.monotonic() - timer, 3)
+      with self._lock:
+         if res["status"] == "ok": self.done   += 1
+         else:                     self.failed += 1
+      return res
+
+   def status(self):
+      """status()
+
+      Return
+      ------
+      dict : Uptime, number of jobs processed/failed/queued and the
+      config files loaded.
+      """
+      import time
+      with self._lock:
+         return {"status": "ok", "uptime": round(time.time() - self.started, 1),
+                 "done": self.done, "failed": self.failed, "queued": self._queue.qsize(),
+                 "configs": [(x[0] or "default") + (f" (version {x[1]:d})" if x[1] else "") for x in self._configs.keys()]}
+
+   def submit(self, job):
+      """submit(job)
+
+      Queues a job and waits until it has been processed.
+
+      Params
+      ------
+      job : dict
+         Job specification, see downloadDaemon.
+
+      Return
+      ------
+      dict : Result, see run(). Jobs submitted or still queued once the
+      daemon shuts down are not processed (status "error").
+      """
+      import threading
+      item = {"job": job, "done": threading.Event(), "result": None}
+      with self._lock:
+         if self._stop.is_set(): return self._cancelled()
+         self._queue.put(item)
+      item["done"].wait()
+      return item["result"]
+
+   @staticmethod
+   def _cancelled():
+      return {"status": "error", "downloaded": 0, "missing": None, "error": "Daemon shut down, job not processed"}
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def _worker(self):
+      while True:
+         item = self._queue.get()
+         if item is None: break
+         item["result"] = self.run(item["job"])
+         item["done"].set()
+
+   def _watch(self):
+      import json
+      while not self._stop.wait(self.poll):
+         for name in sorted(os.listdir(self.jobdir)):
+            if not name.endswith(".json") or name.endswith(".result.json"): continue
+            file    = os.path.join(self.jobdir, name)
+            running = file + ".running"
+            try:
+               os.rename(file, running) # claim the job
+            except OSError:
+               continue
+            log.info(f"Processing job file {file}")
+            try:
+               with open(running) as fid: job = json.load(fid)
+               if not isinstance(job, dict):
+                  res = {"status": "error", "error": "Request must be a JSON object"}
+               else:
+                  res = self.submit(job)
+            except ValueError as e:
+               res = {"status": "error", "error": f"Cannot read job file ({e})"}
+            result = file[:-len(".json")] + ".result.json"
+            with open(result + ".tmp", "w") as fid: json.dump(res, fid)
+            os.rename(result + ".tmp", result)
+            os.remove(running)
+
+   def _handle(self, request):
+      import json
+      try:
+         msg = json.loads(request)
+      except ValueError as e:
+         return {"status": "error", "error": f"Invalid request ({e})"}
+      if not isinstance(msg, dict):
+         return {"status": "error", "error": "Request must be a JSON object"}
+      command = msg.get("command", "download")
+      if command == "status":
+         return self.status()
+      elif command == "shutdown":
+         import threading
+         threading.Thread(target = self.shutdown).start()
+         return {"status": "ok"}
+      elif command == "download":
+         return self.submit(msg)
+      return {"status": "error", "error": f"Unknown command \"{command}\""}
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def serve(self):
+      """serve()
+
+      Starts the worker thread, the job directory watcher and the socket
+      server; blocks until shutdown() is called. Exits if the socket is
+      in use by another daemon; stale sockets (daemon not running) are
+      removed.
+      """
+      import threading, socketserver, json
+
+      if self.socket and os.path.exists(self.socket) and not self._stale(self.socket):
+         log.error(f"{self.socket} exists and is in use (daemon running?), stop")
+         import sys; sys.exit(9)
+
+      self._thread = threading.Thread(target = self._worker, daemon = True)
+      self._thread.start()
+      if self.jobdir:
+         os.makedirs(self.jobdir, exist_ok = True)
+         threading.Thread(target = self._watch, daemon = True).start()
+         log.info(f"Watching job directory {self.jobdir}")
+
+      if not self.socket:
+         self._stop.wait()
+         return
+
+      daemon = self
+      class handler(socketserver.StreamRequestHandler):
+         def handle(self):
+            for line in self.rfile:
+               if not line.strip(): continue
+               res = daemon._handle(line.decode("UTF-8"))
+               self.wfile.write((json.dumps(res) + "\n").encode("UTF-8"))
+               self.wfile.flush()
+
+      if os.path.exists(self.socket): os.remove(self.socket)  # stale, see above
+      self._server = socketserver.ThreadingUnixStreamServer(self.socket, handler)
+      self._server.daemon_threads = True
+      log.info(f"Listening on {self.socket}")
+      try:
+         self._server.serve_forever()
+      finally:
+         self._server.server_close()
+         if os.path.exists(self.socket): os.remove(self.socket)
+
+   @staticmethod
+   def _stale(path):
+      """True if 'path' is a Unix socket nobody is listening on."""
+      import socket, stat
+      if not stat.S_ISSOCK(os.stat(path).st_mode): return False
+      probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try:
+         probe.connect(path)
+      except ConnectionRefusedError:
+         return True
+      except OSError:
+         return False
+      finally:
+         probe.close()
+      return False
+
+   def shutdown(self):
+      """shutdown()
+
+      Stops the daemon once the current job is finished; queued jobs
+      are cancelled. Closes all curl sessions.
+      """
+      import queue
+      from GFSV2.metrics import getMetrics
+      from GFSV2.tracing import getTracer
+      log.info("Shutting down")
+      with self._lock:
+         self._stop.set()
+         pending = []
+         while True:
+            try:
+               pending.append(self._queue.get_nowait())
+            except queue.Empty:
+               break
+         self._queue.put(None)
+      pending = [x for x in pending if x is not None]
+      for item in pending:
+         item["result"] = self._cancelled()
+         item["done"].set()
+      if len(pending) > 0: log.warning(f"Cancelled {len(pending):d} queued job(s)")
+      if self._thread: self._thread.join()
+      if self._server: self._server.shutdown()
+      with self._lock:
+         # Metrics and tracers may be shared by several configs
+         recorders = []
+         for _, config, session in self._configs.values():
+            session.close()
+            for x in [getMetrics(config), getTracer(config)]:
+               if x and not x in recorders: recorders.append(x)
+         for x in recorders: x.close()
+         self._configs = {}
@@ -13,8 +13,8 @@ log = logging.getLogger("GFSV2.download")
 # -------------------------------------------------------------------
 # Function for downloading reforecast data
 # -------------------------------------------------------------------
-def download(config, date):
-   """download(config, date)
+def download(config, date, session = None):
+   """download(config, date, session = None)
 
    Params
    ------
@@ -22,24 +22,98 @@ def download(config, date):
         Object as returned by the readConfig() function of this package.
    date : datetime.datetime
         Specifies the date for which the data should be downloaded.
+   session : None or GFSV2.session.curlSession
+        Session used for all downloads (inventories and data). Should
+        be re-used when calling download() for multiple dates to keep
+        the connections to the server open. If None, a new session is
+        created and closed once done.
 
    Return
    ------
    No return, fails if anything goes wrong.
+
+   Details
+   -------
+   The files (one per parameter and type/member) are independent
+   of each other. If '[curl] max_connections' is larger than one
+   they are processed by a bounded pool of workers, each of them
+   using its own curl handle, such that several files are
+   transferred at the same time. Completed files are post-processed
+   (subsetting, renaming; see _finalize()) by a second pool of
+   '[main] subset_workers' workers while the next files are
+   transferred.
    """
 
-   import pycurl, os, sys, time
+   import threading
    from datetime import datetime as dt
-   from GFSV2 import getInventory
    from GFSV2.readConfig import readConfig
+   from GFSV2.session import curlSession
+   from GFSV2.tracing import span
 
    assert isinstance(config, readConfig), TypeError("argument 'config' of must be GFSV2.readConfig.readConfig")
    assert isinstance(date, dt), TypeError("argument 'date' must be of type 'datetime.datetime'")
+   assert isinstance(session, (type(None), curlSession)), TypeError("argument 'session' must be None or GFSV2.session.curlSession")
 
    # Openftp logfile if set
    if config.curl_logfile:
       curllog = open(config.curl_logfile, "a")
    else: curllog = None
+   # Lock used to serialize writing to the curl logfile
+   lock = threading.Lock()
+
+   # Collecting the files to be downloaded
+   jobs = _jobs(config, date)
+
+   # Create a temporary session if needed
+   own_session = session is None
+   if own_session: session = curlSession(config)
+
+   # Processing the files; sequentially or using a pool of workers
+   # if more than one connection is allowed.
+   # Tracing span covering the whole date (see GFSV2.tracing)
+   from concurrent.futures import ThreadPoolExecutor
+   with span(config, "download", date = date, files = len(jobs)):
+      post = ThreadPoolExecutor(max_workers = _postworkers(config), thread_name_prefix = "postprocess")
+      try:
+         if config.curl_max_connections > 1 and len(jobs) > 1:
+            nworkers = min(config.curl_max_connections, len(jobs))
+            log.info(f"Downloading {len(jobs):d} files using {nworkers:d} connections")
+            with ThreadPoolExecutor(max_workers = nworkers) as pool:
+               futures = [pool.submit(_download_file, config, date, *job, session, curllog, lock, post) for job in jobs]
+               # Re-raises exceptions occurring in one of the workers
+               finalize = [f.result() for f in futures]
+         else:
+            finalize = [_download_file(config, date, *job, session, curllog, lock, post) for job in jobs]
+         # Waiting for the post-processing
+         for f in finalize:
+            if f is not None: f.result()
+      finally:
+         post.shutdown(wait = True)
+         # Close ftp logfile if opened beforehand
+         if curllog: curllog.close()
+         if own_session: session.close()
+
+
+# -------------------------------------------------------------------
+# Files to be downloaded
+# -------------------------------------------------------------------
+def _outfiles(config, date):
+   """_outfiles(config, date)
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+   date : datetime.datetime
+        Date for which the data should be downloaded.
+
+   Return
+   ------
+   list : List of tuples (param, typ, levels, outfile), one for each
+   output file of this date.
+   """
+
+   res = []
 
    # Loop over parameters defined
    for param in config.data.keys():
@@ -58,117 +132,731 @@ def download(config, date):
       else:
         raise NotImplementedError(f"No implementation for handling GFS version {config.version}")
 
-      # Downloading data
+      # Define output grib file
       for typ in types:
-
-         # Define output grib file
          outfile = date.strftime(config.outfile).replace("<type>",typ).replace("<param>",param).replace("<version>", f"{config.version:d}")
+         res.append((param, typ, levels, outfile))
 
-         # If file exists: skip
-         if os.path.isfile(outfile): continue
-
-         # Else: create directory of necessary
-         outdir  = os.path.dirname(outfile)
-         if not os.path.exists(outdir): os.makedirs(outdir)
-
-         # Create the range string for curl
-         log.info("Downloading inventory information data")
-         inv = getInventory(config, date, param, typ, levels)
-         if len(inv.entries) == 0:
-            log.info("Inventory empty, skip this file")
-            continue
-
-         # Loopingg over all inventory entries to set up curl calls
-         curlrange = {}
-         for rec in inv.entries:
-            if not rec.bit_end == "END":
-               tmp = f"{rec.bit_start:d}-{rec.bit_end:d}"
-            else:
-               tmp = f"{rec.bit_start:d}-"
-            if not rec.gribfile in curlrange:
-                curlrange[rec.gribfile] = []
-            curlrange[rec.gribfile].append(tmp)
-
-         # 'curlrange' may now have one or multiple entries if
-         # we have to fetch data from multiple grib files (might
-         # be the case when using version = 12 and fetching data
-         # for forecast steps in the range of Days:1-10 but also
-         # at the same time for steps in the range of Days:10-16).
-         # Thus, loop, download, store.
-
-         # Open binary file connection (temporary file)
-         fp = open("{:s}.tmp".format(outfile), "wb")
-
-         # Setting curl options
-         timer = dt.now()
-         success = True
-         c = pycurl.Curl()
-         c.setopt(pycurl.WRITEDATA, fp)
-         c.setopt(c.NOPROGRESS, 0)
+   return res
+
+
+def _jobs(config, date, extend = None):
+   """_jobs(config, date, extend = None)
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+   date : datetime.datetime
+        Date for which the data should be downloaded.
+   extend : None or bool
+        If True, existing output files are included as well (see
+        '[main] extend'). Defaults to the config (None).
+
+   Return
+   ------
+   list : List of tuples (param, typ, levels, outfile), one for each
+   output file which does not yet exist. If the state data base is
+   used ([main] state) files marked as complete are skipped without
+   checking the file system.
+   """
+
+   from GFSV2.stateDB import getState
+
+   # Existing files are checked for missing fields later on
+   if config.main_extend if extend is None else extend:
+      return _outfiles(config, date)
+
+   state = getState(config)
+   done  = state.completed(date) if state else set()
+
+   # If file exists: skip
+   return [x for x in _outfiles(config, date) if not x[3] in done and not _exists(config, date, x[0], x[1], x[3])]
+
+
+def _exists(config, date, param, typ, outfile):
+   """_exists(config, date, param, typ, outfile)
+
+   Return
+   ------
+   bool : True if the output file exists or, if '[main] archive' is
+   used, the data are contained in the archive.
+   """
+   import os
+   from GFSV2.gribArchive import getArchive
+   if os.path.isfile(outfile): return True
+   archive = getArchive(config, date)
+   return archive is not None and archive.contains(date, param, typ)
+
+
+# -------------------------------------------------------------------
+# Downloading one single output file
+# -------------------------------------------------------------------
+def _download_file(config, date, param, typ, levels, outfile, session, curllog, lock, post = None):
+   """_download_file(config, date, param, typ, levels, outfile, session, curllog, lock, post = None)
+
+   Downloads the inventory and the required fields for one parameter
+   and one type (member) and stores the data in 'outfile'. Used by
+   download(); may be called concurrently from multiple threads.
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+   date : datetime.datetime
+        Specifies the date for which the data should be downloaded.
+   param : str
+        Name of the parameter to be downloaded.
+   typ : str
+        Type of the grib file (e.g., c00, p01, mean, ...).
+   levels : None or list
+        Pressure levels to be downloaded (None for surface variables).
+   outfile : str
+        Name of the final output file.
+   session : GFSV2.session.curlSession
+        Session used to download the inventories and the data.
+   curllog : None or file
+        Opened curl logfile (or None if not used).
+   lock : threading.Lock
+        Lock to serialize writing to the curl logfile.
+   post : None or concurrent.futures.Executor
+        If set, the post-processing (_finalize()) is submitted to this
+        executor, else done immediately.
+
+   Return
+   ------
+   None or the future of the post-processing (if submitted to 'post').
+   """
+
+   res = None
+   inv = _inventory(config, date, param, typ, levels, outfile, session)
+   if inv is not None:
+      if _transfer(config, inv, outfile, session, curllog, lock):
+         if post is None: _finalize(config, outfile, inv)
+         else:            res = post.submit(_finalize, config, outfile, inv)
+
+   # Sleep if set
+   _sleep(config)
+   return res
+
+
+def _postworkers(config):
+   """_postworkers(config)
+
+   Return
+   ------
+   int : Number of workers for the post-processing of the downloaded
+   files; '[main] subset_workers' if subsetting is used, else one
+   (renaming only).
+   """
+   return config.subset_workers if config.lonsubset is not None else 1
+
+
+def _sleep(config):
+   """_sleep(config)
+
+   Sleeps '[main] sleeptime' seconds (if set) before the next download.
+   """
+   import time
+   from GFSV2.tracing import span
+   if config.main_sleeptime:
+      log.debug("Sleeping \"{:.0f}\" seconds before starting next download".format(config.main_sleeptime))
+      with span(config, "sleep", seconds = config.main_sleeptime):
+         time.sleep( config.main_sleeptime )
+
+
+# -------------------------------------------------------------------
+# Stages of downloading one file: inventory, transfer, finalize
+# -------------------------------------------------------------------
+def _inventory(config, date, param, typ, levels, outfile, session):
+   """_inventory(config, date, param, typ, levels, outfile, session)
+
+   Downloads the inventory for one output file. If '[main] extend'
+   is set and the output exists, the inventory is reduced to the
+   fields missing (see GFSV2.extend.extendInventory).
+
+   Return
+   ------
+   None if there is nothing to download (empty inventory or existing
+   output complete), else an object of class GFSV2.getInventory.getInventory.
+   """
+
+   from GFSV2 import getInventory
+   from GFSV2.extend import extendInventory
+   from GFSV2.tracing import span
+
+   # Create the range string for curl
+   log.info("Downloading inventory information data")
+   inv = getInventory(config, date, param, typ, levels, session = session)
+   if config.main_extend and len(inv.entries) > 0:
+      with span(config, "extend", outfile = outfile):
+         inv, missing = extendInventory(config, inv, outfile)
+      if inv is None or missing == 0: return None
+   _register(config, date, param, typ, outfile, inv)
+   if len(inv.entries) == 0:
+      log.info("Inventory empty, skip this file")
+      return None
+   return inv
+
+
+def _register(config, date, param, typ, outfile, inv):
+   """_register(config, date, param, typ, outfile, inv)
+
+   Adds the output file to the state data base (if used) together
+   with the source grib files and byte ranges of the inventory.
+   """
+   from GFSV2.stateDB import getState, PENDING, UNAVAILABLE
+   state = getState(config)
+   if state is None: return
+   if len(inv.entries) == 0:
+      state.register(outfile, date, param, typ, UNAVAILABLE)
+   else:
+      entries = inv.entries if inv.extends is None else inv.extends
+      ranges  = [(x.gribfile, x.bit_start, x.bit_end) for x in entries]
+      sources = list(dict.fromkeys([x[0] for x in ranges]))
+      state.register(outfile, date, param, typ, PENDING, sources, ranges)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def _transfer(config, inv, outfile, session, curllog, lock):
+   """_transfer(config, inv, outfile, session, curllog, lock)
+
+   Downloads the fields specified by the inventory into the
+   temporary file '<outfile>.tmp'; creates the output directory
+   if needed. The temporary file is preallocated and each field is
+   written at its final position such that the ranges can be
+   requested (and retried) in any order.
+
+   Return
+   ------
+   bool : True if all fields have been downloaded successfully.
+   """
+
+   import os
+   from datetime import datetime as dt
+   from GFSV2.rangePlanner import planRanges, rangeSink, allocate
+   from GFSV2.journal import downloadJournal
+   from GFSV2.tracing import span
+
+   with span(config, "transfer", date = inv.date, param = inv.param, type = inv.typ, outfile = outfile):
+      # Create directory if necessary
+      outdir  = os.path.dirname(outfile)
+      if outdir: os.makedirs(outdir, exist_ok = True)
+
+      # Merging the byte ranges of all inventory entries; adjacent
+      # (or near-adjacent, see [curl] range_gap) messages are
+      # requested at once.
+      curlrange = planRanges(inv.entries, config.curl_range_gap)
+
+      # 'curlrange' may now have one or multiple entries if
+      # we have to fetch data from multiple grib files (might
+      # be the case when using version = 12 and fetching data
+      # for forecast steps in the range of Days:1-10 but also
+      # at the same time for steps in the range of Days:10-16).
+      # Thus, loop, download, store.
+
+      # The last message of a grib file goes to the end of the file; the
+      # size of the remote file is required to know the size of the field.
+      if not _resolve(session, curlrange):
+         log.error(f"Skip {outfile}")
+         _mark(config, outfile, False)
+         return False
+
+      # All ranges in the order they are written into the output file
+      # and their positions in the (preallocated) output file.
+      pieces    = [(grb, x[0], x[1]) for grb,plan in curlrange.items() for x in plan["wanted"]]
+      positions = [0]
+      for _,start,end in pieces: positions.append(positions[-1] + end - start + 1)
+      tmpfile   = "{:s}.tmp".format(outfile)
+
+      # If resume is enabled: check if there is an interrupted download
+      # we can continue (see journal.py).
+      journal   = downloadJournal(tmpfile, pieces) if config.curl_resume else None
+      completed = journal.load() if journal else None
+      if completed is not None:
+         log.info(f"Resuming {tmpfile}, {len(completed):d} of {len(pieces):d} field(s) already downloaded")
+         fd = os.open(tmpfile, os.O_RDWR)
+      else:
+         fd = os.open(tmpfile, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+
+      # Setting curl options
+      timer    = dt.now()
+      success  = False
+      metrics  = session.metrics
+      requests = 0
+      retries  = 0
+      written  = 0
+      c        = None
+      try:
+         if completed is None: allocate(fd, positions[-1])
+         if journal: journal.start(resume = completed is not None)
+
+         c = session.acquire()
+         # Progress bars of concurrent transfers would be interleaved
+         c.setopt(c.NOPROGRESS, 0 if config.curl_max_connections == 1 else 1)
 
          # Looping over curlrange, start downloading
-         for grb,bitrange in curlrange.items():
-            retries_left = config.curl_retries # resetting retries
-            c.setopt(pycurl.URL, grb)
-            log.info(f"Downloading field(s) from {grb}")
-
-            # Download with retries if set
-            while retries_left >= 0:
-               log.info("Retries left: {:d}".format(retries_left))
-               try:
-                  if config.curl_timeout:
-                     log.info("Curl timeout is {:d}".format(config.curl_timeout))
-                     c.setopt(pycurl.CONNECTTIMEOUT, config.curl_timeout)
-                  c.setopt(pycurl.FOLLOWLOCATION, 0)
-                  log.info("Downloading -> {:s}.tmp".format(outfile))
-                  for i in range(0, len(bitrange)):
-                     c.setopt(c.RANGE, bitrange[i])
-                     c.perform()
-                  if curllog: 
-                     now    = dt.now()
-                     nowstr = now.strftime("%Y-%m-%d %H:%M:%S")
-                     curllog.write(" {:s}; {:6d}; {:16s}; {:s}\n".format( nowstr,
-                        int((now-timer).seconds),"success",outfile))
-                  break
-               except Exception as e:
-                  log.error("Problems with download")
-                  log.error(e)
-                  retries_left -= 1
-                  if curllog:
-                     now    = dt.now()
-                     nowstr = now.strftime("%Y-%m-%d %H:%M:%S")
-                     curllog.write(" {:s}; {:6d}; {:16s}; {:s}\n".format(nowstr,
-                        int((now-timer).seconds), "error-{:d}".format(e[0]),outfile))
-                  if config.curl_sleeptime:
-                     log.info("Sleeping {:.0f} seconds and retry download".format(config.curl_sleeptime))
-                     time.sleep(config.curl_sleeptime)
-                  success = False
-
-         # Only if download was successful:
-         fp.close()
-         if success:
-            log.debug(f"Finished downloading, moving {outfile}.tmp to {outfile}")
-            # Subset if requested
-            if config.lonsubset is not None:
-               import subprocess as sub
-               log.info("Subsetting -> {:s}".format(outfile))
-               p = sub.Popen(["wgrib2","{:s}.tmp".format(outfile),\
-                              "-small_grib",config.lonsubset,config.latsubset,outfile],
-                              stdout=sub.PIPE,stderr=sub.PIPE)
-               out,err = p.communicate()
-               # Remove temporary file (global data set)
-               if os.path.isfile("{:s}.tmp".format(outfile)):
-                  os.remove("{:s}.tmp".format(outfile))
-            # Else simply move
-            else:
-               os.rename("{:s}.tmp".format(outfile), outfile)
-
-         # Sleep if set
-         if config.main_sleeptime:
-            log.debug("Sleeping \"{:.0f}\" seconds before starting next download")
-            time.sleep( config.main_sleeptime )
-
-   # Close ftp logfile if opened beforehand
-   if curllog: curllog.close()
+         first = 0 # Index of the first range of the current grib file in 'pieces'
+         ok    = True
+         for grb,plan in curlrange.items():
+
+            # Skip ranges already downloaded (resume)
+            n     = len(plan["wanted"])
+            sink  = rangeSink(fd, plan["wanted"], positions[first:(first + n)],
+                              completed = set([i - first for i in (completed or []) if first <= i < first + n]),
+                              callback = _journal_callback(journal, first), segment = _segment(config))
+            first += n
+            if len(sink.remaining()) == 0: continue
+
+            with span(config, "fetch", url = grb, fields = len(sink.remaining())):
+               ok, nreq, nretry = _fetch(config, session, c, grb, sink, outfile, curllog, lock, timer)
+            requests += nreq
+            retries  += nretry
+            written  += sink.written
+
+            # Do not continue with the next grib file if this one failed
+            if not ok: break
+         success = ok
+      finally:
+         # Close temporary file and return the curl handle to the pool
+         # (also if an exception occurred), keep journal if not successful
+         os.close(fd)
+         if c is not None: session.release(c)
+         if journal: journal.close(remove = success)
+         if not success: _mark(config, outfile, False)
+      if metrics:
+         metrics.transfer(outfile, written, (dt.now() - timer).total_seconds(), success, requests, retries)
+      return success
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def _resolve(session, curlrange):
+   """_resolve(session, curlrange)
+
+   Replaces open ends (last message of a grib file, end None) of the
+   ranges returned by GFSV2.rangePlanner.planRanges() by the last byte
+   of the remote file (in place).
+
+   Return
+   ------
+   bool : False if the size of one of the remote files is unknown.
+   """
+   for grb,plan in curlrange.items():
+      start,end = plan["wanted"][-1]
+      if end is not None: continue
+      size = session.size(grb)
+      if size is None:
+         log.error(f"Cannot determine the size of {grb}")
+         return False
+      plan["wanted"][-1] = (start, size - 1)
+   return True
+
+
+def _segment(config):
+   """_segment(config)
+
+   Return
+   ------
+   None or int : Maximum size of the segments in bytes if segmented
+   downloads are enabled ('[curl] segments' > 1), else None.
+   """
+   return config.curl_segment_size if config.curl_segments > 1 else None
+
+
+def _fetch(config, session, c, grb, sink, outfile, curllog, lock, timer):
+   """_fetch(config, session, c, grb, sink, outfile, curllog, lock, timer)
+
+   Requests the ranges of one grib file not yet received by 'sink'
+   (rangeSink or memorySink) with retries. If '[curl] segments' is
+   larger than one the requests (segments of up to '[curl] segment_size';
+   the sink has to be created with the same segment size, see _segment())
+   are distributed among multiple connections. If the message cache
+   is used ('[cache] message_directory') cached messages are taken from
+   the cache, the messages downloaded are added to the cache.
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+   session : GFSV2.session.curlSession
+        Session (rate control, metrics).
+   c : pycurl.Curl
+        Curl handle used for the requests.
+   grb : str
+        URL of the grib file.
+   sink : GFSV2.rangePlanner.rangeSink
+        Object the data are written to.
+   outfile : str
+        Name of the output file (logging, metrics).
+   curllog : None or file
+        Opened curl logfile (or None if not used).
+   lock : None or threading.Lock
+        Lock to serialize writing to the curl logfile.
+   timer : datetime.datetime
+        Start of the transfer (curl logfile).
+
+   Return
+   ------
+   Returns a tuple (success, requests, retries).
+   """
+
+   import pycurl
+   from datetime import datetime as dt
+   from GFSV2.rangePlanner import mergeSpans, chunkSpans
+   from GFSV2.messageCache import getMessageCache
+   from GFSV2.tracing import span
+
+   # Take the messages available in the message cache (if used) first
+   cache = getMessageCache(config)
+   if cache:
+      with span(config, "message cache", url = grb):
+         count, nbytes = cache.fill(grb, sink)
+      if count > 0:
+         log.info(f"Using {count:d} field(s) ({nbytes / 1024**2:.1f} MB) from the message cache")
+         if session.metrics: session.metrics.cache(grb, count, nbytes, outfile = outfile)
+      if len(sink.remaining()) == 0: return (True, 0, 0)
+      fresh = sink.pending()
+
+   log.info(f"Downloading field(s) from {grb}")
+
+   # Multi-range requests are only supported via http(s)
+   segment    = _segment(config)
+   multirange = config.curl_multirange and grb.startswith("http")
+   groups     = chunkSpans(mergeSpans(sink.remaining(), config.curl_range_gap, segment), multirange)
+   log.info(f"Requesting {len(sink.pending()):d} field(s) using {len(groups):d} request(s)")
+
+   nseg = min(config.curl_segments, len(groups))
+   if nseg <= 1:
+      c.setopt(pycurl.URL, grb)
+      res = _request(config, session, c, grb, sink, None, multirange, outfile, curllog, lock, timer)
+   else:
+      # Segmented download; each worker uses its own curl handle and
+      # retries the requests assigned to it.
+      from concurrent.futures import ThreadPoolExecutor
+      log.info(f"Using {nseg:d} connections for {grb}")
+      def work(within):
+         with session.handle() as h, span(config, "segment", url = grb, spans = len(within)):
+            h.setopt(pycurl.URL, grb)
+            return _request(config, session, h, grb, sink, within, multirange, outfile, curllog, lock, timer)
+      with ThreadPoolExecutor(max_workers = nseg) as pool:
+         tmp = list(pool.map(work, groups))
+      res = (all([x[0] for x in tmp]), sum([x[1] for x in tmp]), sum([x[2] for x in tmp]))
+
+   # Keep the messages downloaded (also if some of them failed)
+   if cache:
+      with span(config, "message cache store", url = grb):
+         cache.store(grb, sink, fresh)
+
+   if curllog and res[0]:
+      now    = dt.now()
+      nowstr = now.strftime("%Y-%m-%d %H:%M:%S")
+      with lock:
+         curllog.write(" {:s}; {:6d}; {:16s}; {:s}\n".format( nowstr,
+            int((now-timer).seconds),"success",outfile))
+   return res
+
+
+def _request(config, session, c, grb, sink, within, multirange, outfile, curllog, lock, timer):
+   """_request(config, session, c, grb, sink, within, multirange, outfile, curllog, lock, timer)
+
+   Requests the ranges not yet received by 'sink' (only those inside
+   the spans 'within' if set) with retries. Only the ranges not yet
+   written are requested again, partially written ranges are resumed.
+   Used by _fetch().
+
+   Return
+   ------
+   Returns a tuple (success, requests, retries).
+   """
+
+   import pycurl
+   from datetime import datetime as dt
+   from GFSV2.rangePlanner import mergeSpans, chunkSpans, rangeString, rangeResponse
+   from GFSV2.rateLimit import httpError, retryAfter
+   from GFSV2.tracing import span
+
+   metrics      = session.metrics
+   requests     = 0
+   retries      = 0
+   retries_left = config.curl_retries # resetting retries
+   throttled    = 0                   # Retries due to server throttling
+   attempt      = 0
+
+   while True:
+      remaining = sink.remaining()
+      if within is not None:
+         remaining = [x for x in remaining if any([a <= x[0] and x[1] <= b for a,b in within])]
+      if len(remaining) == 0: break
+      spans = chunkSpans(mergeSpans(remaining, config.curl_range_gap, _segment(config)), multirange)[0]
+      try:
+         log.debug("Downloading {:s} for {:s}".format(rangeString(spans), outfile))
+         resp = rangeResponse(sink, spans[0][0])
+         c.setopt(pycurl.WRITEFUNCTION, session.rate.wrap(resp.write))
+         c.setopt(pycurl.HEADERFUNCTION, resp.header)
+         c.setopt(c.RANGE, rangeString(spans))
+         session.rate.request()
+         requests += 1
+         with span(config, "request", url = grb, ranges = len(spans), attempt = attempt):
+            c.perform()
+         if not resp.status in [None, 200, 206]:
+            raise httpError(resp.status, retryAfter(resp.headers.get("retry-after")))
+         resp.check()
+         if metrics: metrics.request(c, grb, outfile = outfile, ranges = len(spans), attempt = attempt)
+         sink.finish(spans)
+      except Exception as e:
+         log.error("Problems with download")
+         log.error(e)
+         if metrics: metrics.request(c, grb, error = e, outfile = outfile, ranges = len(spans), attempt = attempt)
+         # Throttling (HTTP 429/503) has its own limit of retries
+         if isinstance(e, httpError) and e.throttled and throttled < config.curl_throttle_retries:
+            throttled += 1
+         else:
+            retries_left -= 1
+         if curllog:
+            now    = dt.now()
+            nowstr = now.strftime("%Y-%m-%d %H:%M:%S")
+            code   = e.args[0] if isinstance(e, pycurl.error) else 0
+            with lock:
+               curllog.write(" {:s}; {:6d}; {:16s}; {:s}\n".format(nowstr,
+                  int((now-timer).seconds), "error-{:d}".format(code),outfile))
+         if retries_left < 0:
+            return (False, requests, retries)
+         log.info("Retries left: {:d}".format(retries_left))
+         # Exponential backoff with jitter (or as requested by the server)
+         with span(config, "backoff", attempt = attempt):
+            session.rate.wait(attempt, e)
+         attempt += 1
+         retries += 1
+
+   return (True, requests, retries)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def _finalize(config, outfile, inv = None):
+   """_finalize(config, outfile, inv = None)
+
+   Subsets the temporary file '<outfile>.tmp' if requested (up to
+   '[main] subset_retries' retries if subsetting fails; the temporary
+   file is kept if not successful), or moves it to 'outfile'. If
+   '[main] archive' is used the messages are appended to the archive
+   (requires the inventory 'inv') and 'outfile' is removed, else the
+   field index '<outfile>.inv' is written (see GFSV2.extend.writeIndex).
+   If an existing output file is extended ('inv.extends' set) the new
+   messages are appended to 'outfile'. May be called concurrently
+   from multiple threads (post-processing stage, see download() and
+   GFSV2.pipeline).
+
+   Return
+   ------
+   bool : True if successful.
+   """
+
+   import os, time
+   from GFSV2.metrics import getMetrics
+   from GFSV2.tracing import span
+
+   tmpfile = "{:s}.tmp".format(outfile)
+   extends = None if inv is None else inv.extends
+   target  = outfile if extends is None else "{:s}.new".format(outfile)
+   log.debug(f"Finished downloading, moving {tmpfile} to {target}")
+   timer = time.monotonic()
+   # Subset if requested
+   attempts = 1
+   if config.lonsubset is not None:
+      for attempts in range(1, config.subset_retries + 2):
+         if attempts > 1:
+            log.warning(f"Retrying to subset {tmpfile} ({attempts - 1:d} of {config.subset_retries:d})")
+            time.sleep(attempts - 1)
+         with span(config, "subset", outfile = outfile, method = config.subset_method, attempt = attempts):
+            success = _subset(config, tmpfile, target)
+         if success: break
+      if not success:
+         log.error(f"Subsetting {tmpfile} failed {attempts:d} time(s), keeping the file")
+   # Else simply move
+   else:
+      with span(config, "rename", outfile = outfile):
+         os.rename(tmpfile, target)
+      success = True
+   if success and extends is not None:
+      with span(config, "merge", outfile = outfile):
+         success = _merge(outfile, target, extends, inv.entries)
+   elif success and inv is not None and config.archive is None:
+      _index(outfile, inv.entries)
+   metrics = getMetrics(config)
+   if metrics:
+      metrics.subset(outfile, config.subset_method if config.lonsubset is not None else "none",
+                     time.monotonic() - timer, success, attempts)
+   _mark(config, outfile, success)
+   if success and inv is not None: success = _archive(config, outfile, inv)
+   return success
+
+
+def _merge(outfile, newfile, entries, new):
+   """_merge(outfile, newfile, entries, new)
+
+   Appends the new messages to the existing output file (see
+   GFSV2.extend.mergeFields); 'newfile' is kept if not successful.
+
+   Return
+   ------
+   bool : True if successful.
+   """
+   from GFSV2.extend import mergeFields
+   try:
+      n = mergeFields(outfile, newfile, entries, new)
+   except Exception as e:
+      log.error(f"Cannot merge {newfile} into {outfile} ({e}), keeping the file")
+      return False
+   log.info(f"Extended {outfile} ({n:d} field(s))")
+   return True
+
+
+def _index(outfile, entries):
+   """_index(outfile, entries)
+
+   Writes the field index of 'outfile' (see GFSV2.extend.writeIndex);
+   without index the file can only be extended if the fields can be
+   identified by level and step.
+   """
+   from GFSV2.extend import writeIndex
+   try:
+      writeIndex(outfile, entries)
+   except Exception as e:
+      log.warning(f"Cannot write field index of {outfile} ({e})")
+
+
+def _archive(config, outfile, inv):
+   """_archive(config, outfile, inv)
+
+   Appends 'outfile' to the archive (if '[main] archive' is set) and
+   removes the file.
+
+   Return
+   ------
+   bool : True if successful (or no archive used).
+   """
+   import os
+   from GFSV2.gribArchive import getArchive
+   from GFSV2.tracing import span
+
+   archive = getArchive(config, inv.date)
+   if archive is None: return True
+   try:
+      with span(config, "archive", outfile = outfile):
+         archive.append(outfile, inv.date, inv.param, inv.typ, inv.entries)
+   except Exception as e:
+      log.error(f"Cannot append {outfile} to {archive.file} ({e}), keeping the file")
+      return False
+   os.remove(outfile)
+   return True
+
+
+def _mark(config, outfile, success):
+   """_mark(config, outfile, success)
+
+   Marks an output file as complete or failed in the state data
+   base (if used).
+   """
+   from GFSV2.stateDB import getState, FAILED
+   state = getState(config)
+   if state is None: return
+   if success: state.complete(outfile)
+   else:       state.mark(outfile, FAILED)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def _journal_callback(journal, offset):
+   """_journal_callback(journal, offset)
+
+   Returns the callback used by rangeSink to journal completed ranges.
+
+   Params
+   ------
+   journal : None or GFSV2.journal.downloadJournal
+        Journal (None if resume is disabled).
+   offset : int
+        Index of the first range of the sink in the journal.
+
+   Return
+   ------
+   None or function.
+   """
+   if journal is None: return None
+   def fun(index):
+      journal.add(offset + index)
+   return fun
+
+
+# -------------------------------------------------------------------
+# Areal subset
+# -------------------------------------------------------------------
+def _subset(config, tmpfile, outfile):
+   """_subset(config, tmpfile, outfile)
+
+   Subsets the downloaded (global) data and writes the result to
+   'outfile'. Uses the native subsetting (GFSV2.gribSubset) if
+   '[main] subset_method = native' and falls back to 'wgrib2 -small_grib'
+   if the native subsetting does not support the grib file. Errors
+   (exceptions, output of wgrib2) are logged; the output of wgrib2 is
+   logged on debug level if successful. The temporary file is removed
+   if the subsetting was successful, 'outfile' is only created if
+   successful.
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+   tmpfile : str
+        Name of the downloaded (global) grib file.
+   outfile : str
+        Name of the final output file.
+
+   Return
+   ------
+   bool : True if successful, else False.
+   """
+
+   import os
+
+   log.info("Subsetting -> {:s}".format(outfile))
+   success = False
+   if config.subset_method == "native":
+      from GFSV2.gribSubset import subsetGrib
+      try:
+         subsetGrib(tmpfile, outfile, config._lonmin_, config._lonmax_, config._latmin_, config._latmax_)
+         success = True
+      except NotImplementedError as e:
+         log.info(f"Native subsetting not possible ({e}), using wgrib2")
+      except Exception as e:
+         log.error(f"Native subsetting failed for {tmpfile} ({e})")
+         return False
 
+   if not success:
+      import subprocess as sub
+      # wgrib2 writes into a temporary file; no incomplete output
+      # files if wgrib2 fails.
+      subfile = "{:s}.subset".format(outfile)
+      try:
+         p = sub.Popen(["wgrib2", tmpfile, "-small_grib", config.lonsubset, config.latsubset, subfile],
+                       stdout=sub.PIPE, stderr=sub.PIPE)
+         out,err = p.communicate()
+         success = p.returncode == 0
+         level   = logging.DEBUG if success else logging.ERROR
+         if not success:
+            log.error(f"wgrib2 subsetting failed for {tmpfile} (return code {p.returncode})")
+         for line in (out + err).decode("UTF-8", "replace").strip().split("\n"):
+            if line: log.log(level, f"wgrib2: {line}")
+         if success: os.rename(subfile, outfile)
+      except OSError as e:
+         log.error(f"Cannot run wgrib2 to subset {tmpfile} ({e})")
+      finally:
+         if os.path.isfile(subfile): os.remove(subfile)
 
+   # Remove temporary file (global data set)
+   if success and os.path.isfile(tmpfile):
+      os.remove(tmpfile)
+   return success
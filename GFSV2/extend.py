@@ -0,0 +1,367 @@
+# -------------------------------------------------------------------
+# - NAME:        extend.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Incremental extension of existing output files
+#                ('[main] extend'). The fields contained in an output
+#                file (field index '<outfile>.inv' or the archive index)
+#                are compared to the inventory; only the missing
+#                messages are downloaded and merged into the existing
+#                file.
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.extend")
+
+import struct
+
+# Units of the forecast time (GRIB2 code table 4.4) in hours
+_UNITS = {0: 1. / 60., 1: 1., 2: 24., 10: 3., 11: 6., 12: 12., 13: 1. / 3600.}
+# Position of the end of the overall time interval in section 4 for
+# statistically processed fields (templates 4.8, 4.11, 4.12).
+_END_TIME = {8: 34, 11: 37, 12: 36}
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def gribFields(file):
+   """gribFields(file)
+
+   Lists the messages of a GRIB2 file together with their level and
+   forecast step. Only the headers (sections 0 to 4) of the messages
+   are read.
+
+   Params
+   ------
+   file : str
+        Name of the grib file.
+
+   Return
+   ------
+   list : List of tuples (offset, length, level, step) in the order
+   of the file. 'level' is the pressure level in hPa (None for all
+   other types of levels), 'step' the forecast step in hours (end of
+   the time range for statistically processed fields), matching
+   GFSV2.getInventory.inventry. Raises a ValueError if the file is
+   corrupt and a NotImplementedError for unsupported messages (e.g.,
+   GRIB1 or unknown product definition templates).
+   """
+   return [(offset, length) + _describe(head, file, offset) for offset, length, head in _messages(file)]
+
+
+def _messages(file):
+   """_messages(file)
+
+   Return
+   ------
+   list : List of tuples (offset, length, head) with the position and
+   the first bytes (sections 0 to 4) of each message of a GRIB2 file.
+   Raises a ValueError if the file is corrupt and a NotImplementedError
+   for GRIB1 messages.
+   """
+   import os
+   total = os.path.getsize(file)
+   res   = []
+   with open(file, "rb") as fid:
+      offset = 0
+      while offset < total:
+         fid.seek(offset)
+         head = fid.read(1024)
+         if len(head) < 16 or head[:4] != b"GRIB":
+            raise ValueError(f"No valid GRIB message at byte {offset:d} in {file}")
+         if head[7] != 2:
+            raise NotImplementedError(f"GRIB edition {head[7]:d} not supported")
+         length = struct.unpack(">Q", head[8:16])[0]
+         if offset + length > total:
+            raise ValueError(f"Truncated GRIB message at byte {offset:d} in {file}")
+         res.append((offset, length, head))
+         offset += length
+   return res
+
+
+def _describe(head, file, offset):
+   """_describe(head, file, offset)
+
+   Decodes level and step from sections 1 and 4 of a GRIB2 message
+   (first bytes of the message in 'head').
+
+   Return
+   ------
+   Returns a tuple (level, step).
+   """
+   import datetime as dt
+   from GFSV2.gribSubset import _signed
+
+   pos = 16; ref = None; sec4 = None
+   while sec4 is None and pos + 5 <= len(head):
+      length, num = struct.unpack(">IB", head[pos:(pos + 5)])
+      if num == 1:
+         ref = dt.datetime(*struct.unpack(">HBBBBB", head[(pos + 12):(pos + 19)]))
+      elif num == 4:
+         sec4 = head[pos:(pos + length)]
+      elif num > 4:
+         break
+      pos += length
+   if ref is None or sec4 is None or len(sec4) < 28:
+      raise NotImplementedError(f"Cannot read section 1/4 of the message at byte {offset:d} in {file}")
+
+   # Pressure level in hPa (type of first fixed surface 100, in Pa)
+   level = None
+   if sec4[22] == 100:
+      value = _signed(struct.unpack(">I", sec4[24:28])[0], 4) * 10.**(-_signed(sec4[23], 1))
+      level = int(round(value / 100.))
+
+   template = struct.unpack(">H", sec4[7:9])[0]
+   if template in _END_TIME:
+      i   = _END_TIME[template]
+      end = dt.datetime(*struct.unpack(">HBBBBB", sec4[i:(i + 7)]))
+      step = (end - ref).total_seconds() / 3600.
+   elif template in [0, 1, 2] and sec4[17] in _UNITS:
+      step = struct.unpack(">I", sec4[18:22])[0] * _UNITS[sec4[17]]
+   else:
+      raise NotImplementedError(f"Product definition template 4.{template:d} not supported ({file})")
+   return (level, int(round(step)))
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def writeIndex(outfile, entries):
+   """writeIndex(outfile, entries)
+
+   Writes the field index '<outfile>.inv' (inventory of the output
+   file in the format of the inventory files, byte offsets of
+   'outfile'). The index identifies the fields when the file is
+   extended; fields sharing level and step (e.g., heights, soil layers
+   or accumulation periods) cannot be distinguished otherwise.
+
+   Params
+   ------
+   outfile : str
+        Name of the output file.
+   entries : list
+        List of GFSV2.getInventory.inventry objects, one for each
+        message in 'outfile' (same order).
+
+   Return
+   ------
+   No return. Raises a ValueError if the number of messages does not
+   match the number of entries.
+   """
+   import os
+   msgs = _messages(outfile)
+   if len(msgs) != len(entries):
+      raise ValueError(f"{outfile} contains {len(msgs):d} messages, expected {len(entries):d}")
+   lines = [f"{i + 1:d}:{offset:d}:d={x.date:d}:" + ":".join(x.field) + "\n"
+            for i, ((offset, length, head), x) in enumerate(zip(msgs, entries))]
+   tmp = f"{outfile}.inv.tmp"
+   with open(tmp, "w") as fid: fid.write("".join(lines))
+   os.replace(tmp, f"{outfile}.inv")
+
+
+def fileFields(file):
+   """fileFields(file)
+
+   Params
+   ------
+   file : str
+        Name of the output file.
+
+   Return
+   ------
+   Returns a tuple (fields, exact) where 'fields' is a list of tuples
+   (offset, length, key), one for each message in 'file'. If the field
+   index (see writeIndex()) exists and matches the file, 'exact' is
+   True and 'key' is the field (see GFSV2.getInventory.inventry.field).
+   Else (files written by older versions) 'exact' is False and 'key'
+   is the tuple (level, step) read from the GRIB2 headers.
+   """
+   fields, index = _fileFields(file)
+   return (fields, index is not None)
+
+
+def _fileFields(file):
+   """_fileFields(file)
+
+   Return
+   ------
+   Returns a tuple (fields, index); 'fields' as fileFields(), 'index'
+   the entries of the field index (list of inventry objects) or None
+   if the index does not exist or does not match the file.
+   """
+   import os
+   from GFSV2.getInventory import parseInventory
+
+   msgs  = _messages(file)
+   index = f"{file}.inv"
+   if os.path.isfile(index):
+      with open(index, "r") as fid:
+         entries = parseInventory(file, fid.read().split("\n"))
+      if [x.bit_start for x in entries] == [x[0] for x in msgs]:
+         return ([(offset, length, x.field) for (offset, length, head), x in zip(msgs, entries)], entries)
+      log.warning(f"Field index {index} does not match {file}, ignored")
+   return ([(offset, length, _describe(head, file, offset)) for offset, length, head in msgs], None)
+
+
+def _key(entry, exact):
+   """Key of an inventory entry; the field if 'exact', else (level, step)."""
+   return entry.field if exact else (entry.level, entry.step)
+
+
+def _unique(entries):
+   """True if the inventory entries can be identified by level and step."""
+   return len(set([(x.level, x.step) for x in entries])) == len(entries)
+
+
+def existingFields(config, inv, outfile):
+   """existingFields(config, inv, outfile)
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+   inv : GFSV2.getInventory.getInventory
+        Inventory of the output file.
+   outfile : str
+        Name of the output file.
+
+   Return
+   ------
+   None if there is no output (neither the file nor data in the
+   archive), else a tuple (keys, exact) with the set of keys of the
+   fields already available (see fileFields()). Uses the archive index
+   if '[main] archive' is set, else the output file.
+   """
+   import os
+   from GFSV2.gribArchive import getArchive
+
+   archive = getArchive(config, inv.date)
+   if archive is not None:
+      if not archive.contains(inv.date, inv.param, inv.typ): return None
+      entries = archive.entries(inv.date, inv.param, inv.typ)
+      exact   = all([x.field is not None for x in entries])
+      return (set([_key(x, exact) for x in entries]), exact)
+   if not os.path.isfile(outfile): return None
+   fields, exact = fileFields(outfile)
+   return (set([x[2] for x in fields]), exact)
+
+
+def extendInventory(config, inv, outfile):
+   """extendInventory(config, inv, outfile)
+
+   Reduces the inventory to the fields missing in the existing output.
+   If the output file is extended (no archive) the list of all entries
+   (order of the final file) is stored in 'inv.extends' which tells
+   GFSV2.download._finalize() to append the new messages to the
+   existing file.
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+   inv : GFSV2.getInventory.getInventory
+        Inventory of the output file (modified in place).
+   outfile : str
+        Name of the output file.
+
+   Return
+   ------
+   Returns a tuple (inv, missing) with the inventory and the number
+   of fields missing; 'inv' is None if the existing output cannot be
+   extended (see log).
+   """
+   try:
+      have = existingFields(config, inv, outfile)
+   except (ValueError, NotImplementedError) as e:
+      log.error(f"Cannot read {outfile} ({e}), not extended")
+      return (None, 0)
+   if have is None: return (inv, len(inv.entries))
+
+   have, exact = have
+   if not exact and not _unique(inv.entries):
+      log.error(f"Fields of {outfile} cannot be identified by level and step (no field index), not extended")
+      return (None, 0)
+   missing = [x for x in inv.entries if not _key(x, exact) in have]
+   log.info(f"{outfile} contains {len(inv.entries) - len(missing):d} of {len(inv.entries):d} field(s)")
+   if len(missing) > 0 and config.archive is None:
+      inv.extends = _order(inv.entries)
+   inv.entries = missing
+   return (inv, len(missing))
+
+
+def _order(entries):
+   """_order(entries)
+
+   Return
+   ------
+   list : Entries in the order a newly downloaded file contains the
+   messages (grib files in order of appearance, sorted by position).
+   """
+   res = {}
+   for x in entries: res.setdefault(x.gribfile, []).append(x)
+   return [x for grb in res.values() for x in sorted(grb, key = lambda x: x.bit_start)]
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def mergeFields(outfile, newfile, entries, new):
+   """mergeFields(outfile, newfile, entries, new)
+
+   Appends the messages of 'newfile' to the existing 'outfile'. All
+   fields of 'outfile' are kept, also the ones no longer in the
+   inventory (e.g., steps or levels removed from the config). The
+   result is written to '<outfile>.merge' and renamed (atomic), the
+   field index is updated (see writeIndex()); 'newfile' is removed
+   once done.
+
+   Params
+   ------
+   outfile : str
+        Name of the existing output file.
+   newfile : str
+        Grib file with the new messages.
+   entries : list
+        List of GFSV2.getInventory.inventry objects, all fields of the
+        inventory; used to identify the fields of output files without
+        field index (written by older versions).
+   new : list
+        List of GFSV2.getInventory.inventry objects, one for each
+        message in 'newfile' (same order).
+
+   Return
+   ------
+   int : Number of messages in the merged file. Raises a ValueError
+   if a field of 'newfile' is already contained in 'outfile'.
+   """
+   import os, shutil
+   old, index = _fileFields(outfile)
+   exact = index is not None
+   if not exact and not _unique(entries):
+      raise ValueError(f"Fields of {outfile} cannot be identified by level and step (no field index)")
+   if len(_messages(newfile)) != len(new):
+      raise ValueError(f"{newfile} contains {len(_messages(newfile)):d} messages, expected {len(new):d}")
+   have = set([x[2] for x in old])
+   for x in new:
+      if _key(x, exact) in have:
+         raise ValueError(f"Field {_key(x, exact)} contained twice")
+   # Without field index the existing fields are looked up in the inventory
+   if index is None:
+      lookup = dict([(_key(x, False), x) for x in entries])
+      index  = [lookup.get(x[2]) for x in old]
+
+   tmp = f"{outfile}.merge"
+   try:
+      shutil.copyfile(outfile, tmp)
+      with open(tmp, "ab") as out, open(newfile, "rb") as fid:
+         shutil.copyfileobj(fid, out)
+      if os.path.isfile(f"{outfile}.inv"): os.remove(f"{outfile}.inv")
+      os.replace(tmp, outfile)
+   finally:
+      if os.path.isfile(tmp): os.remove(tmp)
+   if all([x is not None for x in index]):
+      writeIndex(outfile, index + new)
+   else:
+      log.warning(f"{outfile} contains fields not in the inventory, no field index written")
+   os.remove(newfile)
+   return len(old) + len(new)
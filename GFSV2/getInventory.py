@@ -14,6 +14,17 @@
 import logging, logging.config
 log = logging.getLogger("GFSV2.getInventory")
 
+import re, sys
+
+# Precompiled patterns used to decode the inventory lines
+_re_line  = re.compile(r"^[0-9]+:([0-9]+):d=([0-9]+):([^:]*):([^:]*):((anl|[0-9-]+)[^:]*)")
+_re_level = re.compile(r"^([0-9]+)\smb$")
+_re_step  = re.compile(r"^[0-9]+-([0-9]+)$")
+
+# GFS reforecast version 12: last forecast step (hours) contained in
+# the Days:1-10 files, later steps are in the Days:10-16 files.
+DAYS_1_10_MAXSTEP = 240
+
 class inventry:
    """Helper object to store inventory data.
    Each inventory object represents one message or one line
@@ -31,6 +42,8 @@ class inventry:
    No return, saves information internally.
    """
 
+   __slots__ = ("gribfile", "bit_start", "bit_end", "date", "param", "desc", "fcst", "level", "step")
+
    # ----------------------------------------------------------------
    # ----------------------------------------------------------------
    def __init__(self, gribfile, line):
@@ -39,41 +52,45 @@ class inventry:
       assert isinstance(line, str), TypeError("Argument 'line' must be string")
 
       # Matching line
-      import re
-      mtch = re.match("^[0-9]+:([0-9]+):d=([0-9]+):([^:]*):([^:]*):(anl|[0-9-]+).*$",line)
+      mtch = _re_line.match(line)
+      if not mtch:
+         log.error("Cannot decode inventory line \"{:s}\"".format(line))
+         sys.exit(9)
 
       # Extract information
+      start, date, self.param, self.desc, self.fcst, step = mtch.groups()
       self.gribfile  = gribfile
-      self.bit_start = int(mtch.group(1)) 
+      self.bit_start = int(start)
       self.bit_end   = None
-      self.date      = int(mtch.group(2))
-      self.param     = mtch.group(3)
+      self.date      = int(date)
 
       # Contains level information
-      self.desc      = mtch.group(4)
-      lv = re.match("^([0-9]+)\smb$",self.desc)
-      if lv:
-         self.level = int(lv.group(1))
-      else:
-         self.level = None
-
-      # Convert step. If step range: end of stpe is used
-      self.step      = mtch.group(5)
-      if re.match("^[0-9]+-[0-9]+$",self.step):
-         self.step = int(self.step.split("-")[1])
-      elif re.match("^[0-9]+$",self.step):
-         self.step = int(self.step)
-      elif re.match("^anl$",self.step):
+      lv = _re_level.match(self.desc) if self.desc.endswith("mb") else None
+      self.level     = int(lv.group(1)) if lv else None
+
+      # Convert step. If step range: end of step is used
+      if step.isdigit():
+         self.step = int(step)
+      elif step == "anl":
          self.step = 0
       else:
-         log.error("Cannot decode \"{:s}\"".format(self.step))
-         sys.exit(9)
+         st = _re_step.match(step)
+         if not st:
+            log.error("Cannot decode \"{:s}\"".format(step))
+            sys.exit(9)
+         self.step = int(st.group(1))
+
+   @property
+   def field(self):
+      """Tuple (name, level, time range) as in the inventory (e.g.,
+      ("TMAX", "2 m above ground", "3-6 hour max fcst")) identifying
+      the field within an output file."""
+      return (self.param, self.desc, self.fcst)
 
    # ----------------------------------------------------------------
    # Devel method
    # ----------------------------------------------------------------
    def show(self):
-      from os.path import basename
 
       if self.level == None:
          lev = "sfc"
@@ -81,9 +98,64 @@ class inventry:
          lev = "{:d}".format(self.level)
 
       if not self.bit_end == "END":
-         log.info(f"   INV {self.param:10s} {lev:5s}mb {self.step:3d}  {self.bit_start:10d}-{self.bit_end:10d}  in  {self.gribfile}")
+         log.debug(f"   INV {self.param:10s} {lev:5s}mb {self.step:3d}  {self.bit_start:10d}-{self.bit_end:10d}  in  {self.gribfile}")
       else:
-         log.info(f"   INV {self.param:10s} {lev:5s}mb {self.step:3d}  {self.bit_start:10d}-   END  in  {self.gribfile}")
+         log.debug(f"   INV {self.param:10s} {lev:5s}mb {self.step:3d}  {self.bit_start:10d}-   END  in  {self.gribfile}")
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def parseInventory(gribfile, content):
+   """parseInventory(gribfile, content)
+
+   Parses the lines of one inventory file.
+
+   Params
+   ------
+   gribfile : str
+        URL of the grib file described by the inventory.
+   content : list
+        List of str, lines of the inventory file (empty lines are ignored).
+
+   Return
+   ------
+   list : List of inventry objects in the order of the inventory file.
+   Each inventry only contains the bit where the message starts; the
+   end is set to "bit where the next message starts - 1", or "END"
+   for the last message (range to the end of the file).
+   """
+   entries = [inventry(gribfile, line) for line in content if line and not line.isspace()]
+   for rec,nxt in zip(entries, entries[1:]):
+      rec.bit_end = nxt.bit_start - 1
+   if len(entries) > 0: entries[-1].bit_end = "END" # go to the end
+   return entries
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def filterEntries(entries, levels, steps):
+   """filterEntries(entries, levels, steps)
+
+   Params
+   ------
+   entries : list
+        List of inventry objects.
+   levels : None or list
+        Pressure levels to keep; None for surface variables (all entries).
+   steps : None or list
+        Forecast steps to keep; None to keep all steps.
+
+   Return
+   ------
+   list : List of the inventry objects matching 'levels' and 'steps'.
+   """
+   levels = None if levels is None else set(levels)
+   steps  = None if steps  is None else set(steps)
+   if levels is None and steps is None: return list(entries)
+   if levels is None: return [x for x in entries if x.step in steps]
+   if steps  is None: return [x for x in entries if x.level in levels]
+   return [x for x in entries if x.level in levels and x.step in steps]
+
 
 class getInventory:
    """This function downloads the inventory (.inv) file from the
@@ -104,24 +176,30 @@ class getInventory:
    level : None or list
         Either None or a list with one or more integers to specify
         the pressure levels for pressure level variables.
+   session : None or GFSV2.session.curlSession
+        Session used to download the inventory files. If None, a
+        new session is created and closed once done.
 
    Return
    ------
    getInventory : Returns an object of type @ref getInventory.
    """
 
-   def __init__(self, config, date, param, typ, levels):
+   def __init__(self, config, date, param, typ, levels, session = None):
       import sys
       import os
       import urllib
       from datetime import datetime as dt
       from GFSV2.readConfig import readConfig
+      from GFSV2.session import curlSession
+      from GFSV2.tracing import span
 
       assert isinstance(config, readConfig), TypeError("Argument 'config' must be of type GFSV2.readConfig.readConfig")
       assert isinstance(date, dt), TypeError("Argument 'date' must be of type datetime.datetime")
       assert isinstance(param, str), TypeError("Argument 'param' must be string")
       assert isinstance(typ, str), TypeError("Argument 'typ' must be string")
       assert isinstance(levels, (type(None), list)), TypeError("Argument 'level' must be None or list")
+      assert isinstance(session, (type(None), curlSession)), TypeError("Argument 'session' must be None or GFSV2.session.curlSession")
 
       if config.version == 2:
           inv = [date.strftime("{:s}/{:s}".format(config.ftp_baseurl, config.ftp_filename))]
@@ -132,10 +210,16 @@ class getInventory:
           inv[0] = inv[0].replace("<days>", "Days:1-10")
           inv[1] = inv[1].replace("<days>", "Days:10-16")
           inv_postfix = "idx"
+          # Days:10-16 not needed if all steps requested are in Days:1-10
+          if config.steps is not None and max(config.steps, default = 0) <= DAYS_1_10_MAXSTEP:
+              inv = inv[:1]
       else:
           raise NotImplementedError(f"No implementation for handling GFS version {config.version}")
 
       inv = [x.replace("<type>",typ).replace("<param>",param) for x in inv]
+      self.date     = date
+      self.param    = param
+      self.typ      = typ
       self.gribfile = inv
       self.invfile  = [f"{x}.{inv_postfix}" for x in inv]
 
@@ -143,69 +227,88 @@ class getInventory:
 
       # List to store elements needed
       self.entries = []
+      # All entries of the output file if an existing file is extended
+      # (see GFSV2.extend.extendInventory)
+      self.extends = None
 
-      # Reading inventory file(s). In case of GFS reforecast version 12
-      # there are two separate files, one for Days:1-10 and one for Days:10-16
-      for i in range(len(self.invfile)):
-
-        try:
-           from urllib.request import urlopen
-           uid = urlopen(self.invfile[i])
-           content = [x.decode("UTF-8").replace("\\n", "") for x in uid.readlines()]
-           uid.close()
-        except Exception as e:
-           if hasattr(e, "reason"):
-              log.error(f"Problems reading {url}, reason: \"{e.reason}\"")
-           else:
-              log.error(e)
-              log.error(f"Return code:                     ({e.strerror}:{e.errno})")
-           log.error("Could not download inventory file! Skip this.")
-           content = None
-
-        # If we have got content
-        if not content == None:
-           entries = []
-           for line in content:
-              if len(line.strip()) == 0: continue
-              entries.append(inventry(self.gribfile[i], line))
-
-           # Each inventry only contains the bit where the message
-           # starts, not the bit where the message ends. Save "bit where the
-           # next message starts - 1" to each of them to specify the range
-           for i in range(len(entries) -1, -1, -1):
-              if i == (len(entries) - 1):
-                 entries[i].bit_end = "END" # go to the end
-              else:
-                 entries[i].bit_end = entries[i+1].bit_start - 1
-
-           # Drop the steps we dont need!
-           for rec in entries:
-              if levels is None:
-                 # If no step-subset is defined: append
-                 if config.steps is None:
-                    self.entries.append(rec)
-                 # Else only append if step matches user specification
-                 elif rec.step in config.steps:
-                    self.entries.append(rec)
-              else:
-                 # If no step-subset is defined: append
-                 if rec.level in levels and config.steps is None:
-                    self.entries.append(rec)
-                 # Else only append if step matches user specification
-                 elif rec.level in levels and rec.step in config.steps:
-                    self.entries.append(rec)
-
-      # Show entries/fields to be downloaded
-      for rec in self.entries: rec.show()
-
+      # Persistent inventory cache (None if not configured)
+      from GFSV2.inventoryCache import getCache
+      cache = getCache(config)
+      # Bucket listing (None if '[s3] discover' is not enabled)
+      from GFSV2.s3Listing import getListing
+      listing = getListing(config)
 
+      # Create a temporary session if needed
+      own_session = session is None
+      if own_session: session = curlSession(config)
 
+      # Reading inventory file(s). In case of GFS reforecast version 12
+      # there are two separate files, one for Days:1-10 and one for Days:10-16
+      with span(config, "getInventory", date = date, param = param, type = typ):
+         for i in range(len(self.invfile)):
 
+           # Try to get the content from the cache first
+           if cache:
+              cached, content = cache.get(self.invfile[i])
+           else:
+              cached = False
 
+           # Not requesting inventories which do not exist (bucket listing)
+           if not cached and listing and not listing.exists(self.invfile[i], date, session):
+              log.debug(f"{self.invfile[i]} not available (bucket listing), skip")
+              continue
 
+           if not cached:
+              with span(config, "inventory request", url = self.invfile[i]):
+                 content, missing = self._fetch(session, self.invfile[i])
 
+           # If we have got content
+           entries = [] if content is None else parseInventory(self.gribfile[i], content)
 
+           # Store freshly downloaded inventories (or the information
+           # that the inventory does not exist) in the cache.
+           if cache and not cached and (content is not None or missing):
+              cache.put(self.invfile[i], content, entries)
 
+           # Drop the levels and steps we dont need!
+           self.entries += filterEntries(entries, levels, config.steps)
 
+      if own_session: session.close()
 
+      # Show entries/fields to be downloaded
+      log.info(f"{len(self.entries):d} field(s) found in inventory")
+      if log.isEnabledFor(logging.DEBUG):
+         for rec in self.entries: rec.show()
 
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def _fetch(self, session, url):
+      """_fetch(session, url)
+
+      Downloads one inventory file.
+
+      Params
+      ------
+      session : GFSV2.session.curlSession
+         Session used to download the file.
+      url : str
+         URL of the inventory file.
+
+      Return
+      ------
+      Returns a tuple (content, missing). content is a list of str
+      (lines of the inventory file) or None if the file could not be
+      downloaded. missing is True if the server reported that the
+      file does not exist (HTTP 404/403 or FTP 550).
+      """
+      try:
+         status, raw = session.fetch(url)
+      except Exception as e:
+         log.error(f"Problems reading {url}, reason: \"{e}\"")
+         log.error("Could not download inventory file! Skip this.")
+         return (None, False)
+      if not status in [0, 200, 226]:
+         log.error(f"Problems reading {url}, return code {status}")
+         log.error("Could not download inventory file! Skip this.")
+         return (None, status in [403, 404])
+      return (raw.decode("UTF-8").split("\n"), False)
@@ -0,0 +1,248 @@
+# -------------------------------------------------------------------
+# - NAME:        gribArchive.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Consolidated output. Instead of keeping one small grib
+#                file per date, parameter and member, all messages of a
+#                date (or month, depending on '[main] archive') are
+#                appended to one grib archive with an accompanying
+#                byte-offset index ('<archive>.index').
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.gribArchive")
+
+import os, threading
+try:
+   import fcntl
+except ImportError:
+   fcntl = None
+
+# One archive object per file and process
+_instances = {}
+_lock      = threading.Lock()
+
+def getArchive(config, date):
+   """getArchive(config, date)
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+   date : datetime.datetime
+        Date of interest.
+
+   Return
+   ------
+   None if '[main] archive' is not set, else the object of class
+   gribArchive the data of this date are written to.
+   """
+   if config.archive is None: return None
+   file = date.strftime(config.archive).replace("<version>", f"{config.version:d}")
+   with _lock:
+      if not file in _instances: _instances[file] = gribArchive(file)
+   return _instances[file]
+
+
+def gribMessages(data):
+   """gribMessages(data)
+
+   Params
+   ------
+   data : bytes
+        Content of a grib file (GRIB1 or GRIB2).
+
+   Return
+   ------
+   list : List of tuples (offset, length), one for each message.
+   """
+   res = []; offset = data.find(b"GRIB")
+   while offset >= 0 and offset + 16 <= len(data):
+      if data[offset + 7] == 2:
+         length = int.from_bytes(data[offset + 8:offset + 16], "big")
+      else:
+         length = int.from_bytes(data[offset + 4:offset + 7], "big")
+      if length <= 0 or offset + length > len(data):
+         raise ValueError(f"Truncated grib message at byte {offset:d}")
+      res.append((offset, length))
+      offset = data.find(b"GRIB", offset + length)
+   return res
+
+
+class archiveEntry:
+   """One message of the archive (one line of the index file).
+
+   Attributes: offset, length, date (int, YYYYmmddHH), param, type,
+   level (None for non-pressure-level fields), step and field (name,
+   level and time range as in the inventory, see
+   GFSV2.getInventory.inventry.field; None for index lines written by
+   older versions).
+   """
+   __slots__ = ("offset", "length", "date", "param", "type", "level", "step", "field")
+
+   def __init__(self, line):
+      tmp = line.rstrip("\n").split(":")
+      self.offset = int(tmp[0]); self.length = int(tmp[1]); self.date = int(tmp[2])
+      self.param  = tmp[3];      self.type   = tmp[4]
+      self.level  = int(tmp[5]) if tmp[5] else None
+      self.step   = int(tmp[6])
+      self.field  = tuple(tmp[7:10]) if len(tmp) >= 10 else None
+
+   def __repr__(self):
+      return f"<archiveEntry {self.date:d} {self.param} {self.type} {self.level} {self.step:d} @{self.offset:d}+{self.length:d}>"
+
+
+class gribArchive:
+   """Grib archive with byte-offset index. The index ('<file>.index')
+   contains one line per message:
+   ``offset:length:date:param:type:level:step:name:desc:range``, e.g.,
+   ``0:1205:2000010100:tmp_pres:c00:500:6:TMP:500 mb:6 hour fcst``
+   (empty level for non-pressure-level fields; the last three columns
+   are the field as in the inventory). Data are appended before the index
+   lines are written; appending is safe across threads and (via file
+   locks) processes.
+
+   Params
+   ------
+   file : str
+        Name of the archive file.
+
+   Return
+   ------
+   No return, initializes an object of class gribArchive.
+
+   Example
+   -------
+   >>> arch = gribArchive("GFSV12_200001.grib2")
+   >>> for entry in arch.entries(param = "tmp_pres", level = 500):
+   ...    data = arch.read(entry)
+   """
+
+   def __init__(self, file):
+      assert isinstance(file, str), TypeError("Argument 'file' must be str")
+      self.file    = file
+      self.index   = f"{file}.index"
+      self._lock   = threading.Lock()
+      self._items  = []
+      self._keys   = set()
+      self._pos    = 0
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def _update(self):
+      """Reads index lines appended since the last call."""
+      if not os.path.isfile(self.index) or os.path.getsize(self.index) == self._pos: return
+      with open(self.index) as fid:
+         fid.seek(self._pos)
+         for line in fid:
+            if not line.endswith("\n"): break # incomplete line (being written)
+            entry = archiveEntry(line)
+            self._items.append(entry)
+            self._keys.add((entry.date, entry.param, entry.type))
+            self._pos += len(line.encode())
+
+   def contains(self, date, param, typ):
+      """contains(date, param, typ)
+
+      Params
+      ------
+      date : datetime.datetime
+         Date of interest.
+      param : str
+         Name of the parameter (as in the config file).
+      typ : str
+         Type (member).
+
+      Return
+      ------
+      bool : True if the archive contains the data.
+      """
+      with self._lock:
+         self._update()
+         return (int(date.strftime("%Y%m%d%H")), param, typ) in self._keys
+
+   def entries(self, date = None, param = None, typ = None, level = None, step = None):
+      """entries(date = None, param = None, typ = None, level = None, step = None)
+
+      Return
+      ------
+      list : Entries (archiveEntry) matching the arguments given; all
+      entries if no argument is set.
+      """
+      with self._lock:
+         self._update()
+         res = list(self._items)
+      if date  is not None: res = [x for x in res if x.date == int(date.strftime("%Y%m%d%H"))]
+      if param is not None: res = [x for x in res if x.param == param]
+      if typ   is not None: res = [x for x in res if x.type == typ]
+      if level is not None: res = [x for x in res if x.level == level]
+      if step  is not None: res = [x for x in res if x.step == step]
+      return res
+
+   def read(self, entry):
+      """read(entry)
+
+      Params
+      ------
+      entry : archiveEntry
+         Entry as returned by entries().
+
+      Return
+      ------
+      bytes : The grib message.
+      """
+      with open(self.file, "rb") as fid:
+         fid.seek(entry.offset)
+         return fid.read(entry.length)
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def append(self, gribfile, date, param, typ, fields):
+      """append(gribfile, date, param, typ, fields)
+
+      Appends all messages of a grib file to the archive.
+
+      Params
+      ------
+      gribfile : str
+         Grib file to be appended.
+      date : datetime.datetime
+         Date of the data.
+      param : str
+         Name of the parameter (as in the config file).
+      typ : str
+         Type (member).
+      fields : list
+         List of GFSV2.getInventory.inventry objects, one for each
+         message in 'gribfile' (same order), providing level, step
+         and field.
+
+      Return
+      ------
+      int : Number of messages appended. Raises a ValueError if the
+      number of messages does not match the number of fields.
+      """
+      with open(gribfile, "rb") as fid: data = fid.read()
+      msgs = gribMessages(data)
+      if len(msgs) != len(fields):
+         raise ValueError(f"{gribfile} contains {len(msgs):d} messages, expected {len(fields):d}")
+
+      outdir = os.path.dirname(self.file)
+      if outdir: os.makedirs(outdir, exist_ok = True)
+      with self._lock, open(self.file, "ab") as fid, open(self.index, "a") as idx:
+         if fcntl: fcntl.flock(fid, fcntl.LOCK_EX)
+         try:
+            base = fid.seek(0, os.SEEK_END)
+            fid.write(data); fid.flush()
+            lines = []
+            for (offset, length), field in zip(msgs, fields):
+               level = "" if field.level is None else f"{field.level:d}"
+               lines.append(f"{base + offset:d}:{length:d}:{date:%Y%m%d%H}:{param}:{typ}:{level}:{field.step:d}:" +
+                            ":".join(field.field) + "\n")
+            idx.write("".join(lines)); idx.flush()
+         finally:
+            if fcntl: fcntl.flock(fid, fcntl.LOCK_UN)
+      log.debug(f"Appended {len(msgs):d} message(s) of {gribfile} to {self.file}")
+      return len(msgs)
@@ -0,0 +1,413 @@
+# -------------------------------------------------------------------
+# - NAME:        gribSubset.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Native (in-process) regional subsetting of GRIB2
+#                files; replaces 'wgrib2 -small_grib' for regular
+#                lat/lon grids with simple or complex packing (with
+#                or without spatial differencing). Other grids or
+#                packings (e.g., JPEG2000) raise a NotImplementedError
+#                such that the caller can fall back to wgrib2.
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.gribSubset")
+
+import struct, threading
+
+# Precomputed subsets; key is (section 3, bounds). Shared by all
+# files processed by this process as the grid is typically identical.
+_masks = {}
+_lock  = threading.Lock()
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def subsetGrib(infile, outfile, lonmin, lonmax, latmin, latmax):
+   """subsetGrib(infile, outfile, lonmin, lonmax, latmin, latmax)
+
+   Extracts all grid points within lonmin/lonmax/latmin/latmax
+   (inclusive) from all messages in 'infile' and writes the cropped
+   messages to 'outfile', similar to 'wgrib2 -small_grib'.
+
+   Only supports regular lat/lon grids (grid definition template 3.0),
+   simple packing and complex packing (data representation templates
+   5.0, 5.2, 5.3; without missing value management) and messages
+   without bitmap. Simple packing: the packed values of the grid points
+   within the subset are copied. Complex packing: the packed integers
+   are decoded up to the last grid point of the subset and the subset
+   is written using simple packing with the same reference value,
+   binary and decimal scale factor (lossless).
+
+   Params
+   ------
+   infile : str
+        Name of the GRIB2 file to be subsetted.
+   outfile : str
+        Name of the output file (written via '<outfile>.subset' and
+        renamed once finished).
+   lonmin, lonmax : float
+        Longitude range in degrees (-180 to 360, lonmin < lonmax).
+   latmin, latmax : float
+        Latitude range in degrees.
+
+   Return
+   ------
+   int : Number of messages written. Raises a NotImplementedError if
+   'infile' contains messages which cannot be handled.
+   """
+
+   import os
+
+   bounds = (float(lonmin), float(lonmax), float(latmin), float(latmax))
+   tmp    = f"{outfile}.subset"
+   count  = 0
+   try:
+      with open(infile, "rb") as fin, open(tmp, "wb") as fout:
+         while True:
+            head = fin.read(16)
+            if len(head) == 0: break
+            if len(head) < 16 or head[:4] != b"GRIB":
+               raise ValueError(f"No valid GRIB message at byte {fin.tell() - len(head):d} in {infile}")
+            if head[7] != 2:
+               raise NotImplementedError(f"GRIB edition {head[7]:d} not supported")
+            total = struct.unpack(">Q", head[8:16])[0]
+            msg   = head + fin.read(total - 16)
+            if len(msg) != total or msg[-4:] != b"7777":
+               raise ValueError(f"Incomplete GRIB message in {infile}")
+            fout.write(_subset_message(msg, bounds))
+            count += 1
+      os.rename(tmp, outfile)
+   finally:
+      if os.path.isfile(tmp): os.remove(tmp)
+
+   return count
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def _signed(x, nbytes):
+   """Decodes GRIB2 sign-and-magnitude integers."""
+   sign = 1 << (8 * nbytes - 1)
+   return -(x & ~sign) if x & sign else x
+
+def _tosigned(x, nbytes):
+   """Encodes GRIB2 sign-and-magnitude integers."""
+   return (abs(x) | (1 << (8 * nbytes - 1))) if x < 0 else x
+
+
+def _subset_message(msg, bounds):
+   """_subset_message(msg, bounds)
+
+   Params
+   ------
+   msg : bytes
+        One complete GRIB2 message.
+   bounds : tuple
+        (lonmin, lonmax, latmin, latmax).
+
+   Return
+   ------
+   bytes : The cropped message.
+   """
+
+   out  = [msg[:16]]
+   pos  = 16
+   grid = None
+   while pos < len(msg) - 4:
+      length, num = struct.unpack(">IB", msg[pos:(pos + 5)])
+      sec = msg[pos:(pos + length)]
+      pos += length
+
+      if num == 3:
+         grid = _get_grid(sec, bounds)
+         sec  = grid["sec3"]
+      elif num == 5:
+         # Rewritten together with the data section (section 7)
+         template = struct.unpack(">H", sec[9:11])[0]
+         if not template in [0, 2, 3]:
+            raise NotImplementedError(f"Data representation template 5.{template:d} not supported")
+         sec5 = sec
+         out.append(None)
+         continue
+      elif num == 6:
+         if sec[5] != 255:
+            raise NotImplementedError("Messages with bitmap not supported")
+      elif num == 7:
+         out[out.index(None)], sec = _subset_values(sec5, sec, grid)
+      out.append(sec)
+
+   out.append(b"7777")
+   res = b"".join(out)
+   return res[:8] + struct.pack(">Q", len(res)) + res[16:]
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def _get_grid(sec3, bounds):
+   """_get_grid(sec3, bounds)
+
+   Returns the precomputed subset for a grid definition (section 3),
+   computes and stores it if not yet available.
+
+   Return
+   ------
+   dict : Containing the new section 3 ("sec3"), number of points in
+   the subset ("npts") and a list of runs ("runs"; tuples with the
+   index of the first point and the number of points) to be copied.
+   """
+   key = (bytes(sec3), bounds)
+   with _lock:
+      if key in _masks: return _masks[key]
+
+   template = struct.unpack(">H", sec3[12:14])[0]
+   if sec3[5] != 0 or template != 0:
+      raise NotImplementedError(f"Grid definition template 3.{template:d} not supported")
+   (ni, nj, angle, subdiv, la1, lo1, flags, la2, lo2, di, dj, scan) = \
+         struct.unpack(">IIIIIIBIIIIB", sec3[30:72])
+   if not angle in [0, 0xFFFFFFFF] or not subdiv in [0, 0xFFFFFFFF]:
+      raise NotImplementedError("Grids with non-standard basic angle not supported")
+   if scan & 0xB0:
+      raise NotImplementedError(f"Scanning mode {scan:d} not supported")
+   if len(sec3) != 72:
+      raise NotImplementedError("Grids with optional list of numbers not supported")
+
+   la1 = _signed(la1, 4) * 1e-6; lo1 = _signed(lo1, 4) * 1e-6
+   di  = di * 1e-6;              dj  = dj * 1e-6
+   lonmin, lonmax, latmin, latmax = bounds
+   eps = 1e-6
+
+   # Rows (j) within the latitude range
+   jdir = 1. if scan & 0x40 else -1.
+   rows = [j for j in range(nj) if latmin - eps <= la1 + jdir * j * dj <= latmax + eps]
+
+   # Columns (i) within the longitude range. For global grids the subset
+   # starts at the western edge and may cross the 0/360 meridian.
+   inside = lambda i: ((lo1 + i * di - lonmin) % 360.) <= (lonmax - lonmin) + eps
+   if abs(ni * di - 360.) < eps:
+      i0   = int(-(-(((lonmin - lo1) % 360.) - eps) // di)) % ni
+      cols = []
+      for k in range(ni):
+         if not inside((i0 + k) % ni): break
+         cols.append((i0 + k) % ni)
+   else:
+      cols = [i for i in range(ni) if inside(i)]
+
+   if len(rows) == 0 or len(cols) == 0:
+      raise ValueError("Subset does not contain any grid point")
+
+   # Runs of consecutive columns (two if crossing the meridian)
+   colruns = []
+   for i in cols:
+      if len(colruns) > 0 and colruns[-1][0] + colruns[-1][1] == i:
+         colruns[-1][1] += 1
+      else:
+         colruns.append([i, 1])
+   runs = [(j * ni + i, n) for j in rows for i,n in colruns]
+
+   nlo1 = (lo1 + cols[0] * di) % 360.
+   nlo2 = (lo1 + cols[-1] * di) % 360.
+   nla1 = la1 + jdir * rows[0] * dj
+   nla2 = la1 + jdir * rows[-1] * dj
+   npts = len(rows) * len(cols)
+
+   sec3 = bytearray(sec3)
+   sec3[6:10]  = struct.pack(">I", npts)
+   sec3[30:38] = struct.pack(">II", len(cols), len(rows))
+   sec3[46:54] = struct.pack(">II", _tosigned(int(round(nla1 * 1e6)), 4), _tosigned(int(round(nlo1 * 1e6)), 4))
+   sec3[55:63] = struct.pack(">II", _tosigned(int(round(nla2 * 1e6)), 4), _tosigned(int(round(nlo2 * 1e6)), 4))
+
+   res = {"sec3": bytes(sec3), "npts": npts, "runs": runs}
+   log.debug(f"Subset for grid {ni:d}x{nj:d}: {len(cols):d}x{len(rows):d} points")
+   with _lock:
+      _masks[key] = res
+   return res
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def _subset_values(sec5, sec7, grid):
+   """_subset_values(sec5, sec7, grid)
+
+   Params
+   ------
+   sec5 : bytes
+        Data representation section (section 5) of the original message.
+   sec7 : bytes
+        Data section (section 7) of the original message.
+   grid : dict
+        Object returned by _get_grid().
+
+   Return
+   ------
+   Returns a tuple with the new sections 5 and 7.
+   """
+   template = struct.unpack(">H", sec5[9:11])[0]
+   if template == 0:
+      sec5 = sec5[:5] + struct.pack(">I", grid["npts"]) + sec5[9:]
+      return (sec5, _subset_data(sec7, grid, sec5[19]))
+
+   # Complex packing; decoded up to the last point of the subset
+   last   = grid["runs"][-1][0] + grid["runs"][-1][1]
+   values = _unpack_complex(sec5, sec7, last)
+   values = [x for first,n in grid["runs"] for x in values[first:(first + n)]]
+   if min(values) < 0:
+      raise NotImplementedError("Negative packed values not supported")
+
+   # Simple packing (template 5.0) with the same R, E, D
+   nbits = max(values).bit_length()
+   sec5  = struct.pack(">IBIH", 21, 5, len(values), 0) + sec5[11:19] + bytes([nbits, sec5[20]])
+   data  = b""
+   if nbits > 0:
+      bits = "".join([format(x, f"0{nbits:d}b") for x in values])
+      bits += "0" * (-len(bits) % 8)
+      data = int(bits, 2).to_bytes(len(bits) // 8, "big")
+   return (sec5, struct.pack(">IB", 5 + len(data), 7) + data)
+
+
+def _bits(data, start, end):
+   """Bytes data[start:end] as string of '0' and '1'."""
+   return format(int.from_bytes(data[start:end], "big"), f"0{(end - start) * 8:d}b")
+
+def _unpack(data, pos, count, nbits):
+   """_unpack(data, pos, count, nbits)
+
+   Reads 'count' unsigned integers of 'nbits' bits each starting at
+   byte 'pos' of 'data'.
+
+   Return
+   ------
+   Returns a tuple (values, pos) with the list of integers and the
+   position of the next byte (values are padded to full bytes).
+   """
+   end = pos + (count * nbits + 7) // 8
+   if nbits == 0: return ([0] * count, end)
+   bits = _bits(data, pos, end)
+   return ([int(bits[(i * nbits):((i + 1) * nbits)], 2) for i in range(count)], end)
+
+
+def _unpack_complex(sec5, sec7, count):
+   """_unpack_complex(sec5, sec7, count)
+
+   Decodes the packed integers of a message using complex packing
+   (data representation template 5.2) or complex packing with spatial
+   differencing (template 5.3), see GRIB2 code tables and NCEP g2clib
+   (comunpack.c).
+
+   Params
+   ------
+   sec5 : bytes
+        Data representation section (section 5).
+   sec7 : bytes
+        Data section (section 7).
+   count : int
+        Number of values to be decoded (from the start of the field).
+
+   Return
+   ------
+   list : The first 'count' packed integers X (original values are
+   (R + X * 2^E) / 10^D, section 5).
+   """
+   template = struct.unpack(">H", sec5[9:11])[0]
+   npts     = struct.unpack(">I", sec5[5:9])[0]
+   nbits    = sec5[19]
+   if sec5[22] != 0:
+      raise NotImplementedError("Complex packing with missing value management not supported")
+   ng, wref, wbits, lref, linc, llast, lbits = struct.unpack(">IBBIBIB", sec5[31:47])
+   count = min(count, npts)
+
+   # Extra descriptors (spatial differencing): first value(s) and
+   # minimum of the differences (sign and magnitude).
+   data = sec7[5:]
+   pos  = 0
+   if template == 3:
+      order, ov = sec5[47], sec5[48]
+      if not order in [1, 2]:
+         raise NotImplementedError(f"Spatial differencing of order {order:d} not supported")
+      extra = [_signed(int.from_bytes(data[(i * ov):((i + 1) * ov)], "big"), ov) for i in range(order + 1)]
+      pos   = (order + 1) * ov
+
+   # Group reference values, widths and lengths
+   refs,    pos = _unpack(data, pos, ng, nbits)
+   widths,  pos = _unpack(data, pos, ng, wbits)
+   lengths, pos = _unpack(data, pos, ng, lbits)
+   widths  = [wref + x for x in widths]
+   lengths = [lref + x * linc for x in lengths]
+   if ng > 0: lengths[-1] = llast
+
+   # Groups required for the first 'count' values
+   needed = 0; nvals = 0
+   while needed < ng and nvals < count:
+      nvals  += lengths[needed]
+      needed += 1
+   bits = _bits(data, pos, pos + (sum([w * n for w,n in zip(widths[:needed], lengths[:needed])]) + 7) // 8)
+   res  = []; p = 0
+   for ref,w,n in zip(refs[:needed], widths[:needed], lengths[:needed]):
+      if w == 0:
+         res += [ref] * n
+      else:
+         res += [ref + int(bits[(p + i * w):(p + (i + 1) * w)], 2) for i in range(n)]
+         p   += w * n
+   if len(res) < count:
+      raise ValueError("Data section of complex packed message too short")
+   res = res[:count]
+
+   # Undo spatial differencing
+   if template == 3:
+      minsd = extra[-1]
+      if order == 1:
+         res[0] = extra[0]
+         for i in range(1, count):
+            res[i] += minsd + res[i - 1]
+      else:
+         res[0] = extra[0]
+         if count > 1: res[1] = extra[1]
+         for i in range(2, count):
+            res[i] += minsd + 2 * res[i - 1] - res[i - 2]
+   return res
+
+
+def _subset_data(sec7, grid, nbits):
+   """_subset_data(sec7, grid, nbits)
+
+   Copies the packed values of the grid points within the subset.
+
+   Params
+   ------
+   sec7 : bytes
+        Data section (section 7) of the original message.
+   grid : dict
+        Object returned by _get_grid().
+   nbits : int
+        Number of bits per packed value (section 5).
+
+   Return
+   ------
+   bytes : New data section (section 7).
+   """
+   data = sec7[5:]
+   out  = bytearray()
+   if nbits > 0:
+      acc = 0; accbits = 0
+      for first,n in grid["runs"]:
+         start = first * nbits
+         nb    = n * nbits
+         b0    = start // 8
+         b1    = (start + nb + 7) // 8
+         chunk = int.from_bytes(data[b0:b1], "big")
+         chunk = (chunk >> ((b1 * 8) - (start + nb))) & ((1 << nb) - 1)
+         acc   = (acc << nb) | chunk
+         accbits += nb
+         # Flush full bytes
+         nbytes = accbits // 8
+         if nbytes > 0:
+            out += (acc >> (accbits - nbytes * 8)).to_bytes(nbytes, "big")
+            accbits -= nbytes * 8
+            acc &= (1 << accbits) - 1
+      # Remaining bits, padded with zeros
+      if accbits > 0:
+         out += (acc << (8 - accbits)).to_bytes(1, "big")
+   return struct.pack(">IB", 5 + len(out), 7) + bytes(out)
+
@@ -55,6 +55,19 @@ class inputCheck( object ):
       parser.add_argument("-s","--steps",nargs="+",type=int, default=None, 
             help="Integer, steps for which the data should be downloaded (forecast lead time, " + \
                  "e.g., 3 6 9 12 24 48).")
+      parser.add_argument("-j","--jobs",type=int, default=None,
+            help="Integer, number of files to be downloaded in parallel. Overrules " + \
+                 "[curl] max_connections (defaults to 1).")
+      parser.add_argument("-P","--processes",type=int, default=None,
+            help="Integer, number of worker processes; the dates are distributed " + \
+                 "among the processes. Overrules [main] processes (defaults to 1).")
+      parser.add_argument("--trace",type=str, default=None, metavar="FILE",
+            help="String, writes tracing spans of all phases (inventory, transfer, " + \
+                 "subsetting, ...) to FILE (Chrome trace format, open in " + \
+                 "https://ui.perfetto.dev).")
+      parser.add_argument("--profile",type=str, default=None, nargs="?", const="", metavar="FILE",
+            help="Profiles the run (cProfile) and shows a sorted report at the end; " + \
+                 "the statistics are stored in FILE if given.")
 
       required = parser.add_argument_group('required arguments')
       required.add_argument("-p","--param",nargs="+",type=str,
@@ -76,6 +89,15 @@ class inputCheck( object ):
           log.warning("--version 12 always uses --members True, mean/sprd not available")
           args.members = True
 
+      if args.jobs is not None and args.jobs < 1:
+         log.error("Input -j/--jobs: must be a positive integer!")
+         parser.print_help()
+         sys.exit(1)
+      if args.processes is not None and args.processes < 1:
+         log.error("Input -P/--processes: must be a positive integer!")
+         parser.print_help()
+         sys.exit(1)
+
       # Check required inputs
       check = self._check_req_()
       if not check:
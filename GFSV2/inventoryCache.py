@@ -0,0 +1,301 @@
+# -------------------------------------------------------------------
+# - NAME:        inventoryCache.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Persistent on-disk cache for the inventory files.
+#                The reforecast archive does not change, thus the
+#                inventories only have to be downloaded once.
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.inventoryCache")
+
+# One cache object per cache directory (and process)
+import threading
+_instances = {}
+_lock      = threading.Lock()
+
+def getCache(config):
+   """getCache(config)
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+
+   Return
+   ------
+   None if '[cache] directory' is not set, else an object of class
+   inventoryCache. The object is created once per process and directory
+   and shared afterwards.
+   """
+   if config.cache_dir is None: return None
+   with _lock:
+      if not config.cache_dir in _instances:
+         _instances[config.cache_dir] = inventoryCache(config.cache_dir,
+               max_size = config.cache_max_size, max_age = config.cache_max_age,
+               negative_ttl = config.cache_negative_ttl)
+   return _instances[config.cache_dir]
+
+
+class inventoryCache:
+   """Persistent inventory cache and catalogue. Stores the content of
+   the inventory files (keyed by the URL of the inventory file) in
+   an SQLite data base together with the parsed entries (catalogue)
+   which can be queried via the query() method. Inventory files
+   which do not exist (404) are stored as negative entries. Also
+   stores bucket listings (see GFSV2.s3Listing).
+
+   Params
+   ------
+   directory : str
+        Directory where to store the cache (file 'inventory.sqlite').
+   max_size : None or float
+        Maximum size of the cached inventory content in megabytes. If
+        exceeded, the least recently used inventories are evicted.
+   max_age : None or float
+        Maximum age in days. Older inventories are downloaded again.
+   negative_ttl : float
+        Time in hours for how long a missing inventory file (404) is
+        remembered. If 0, missing inventories are not cached.
+
+   Return
+   ------
+   No return, initializes an object of class inventoryCache.
+   """
+
+   _schema = """
+   CREATE TABLE IF NOT EXISTS inventory (
+      url      TEXT PRIMARY KEY,
+      status   INTEGER NOT NULL,
+      content  TEXT,
+      size     INTEGER NOT NULL,
+      fetched  REAL NOT NULL,
+      accessed REAL NOT NULL
+   );
+   CREATE INDEX IF NOT EXISTS inventory_accessed ON inventory (accessed);
+   -- Total size of all inventories; kept up to date by the triggers (also
+   -- if the cache is shared by multiple processes).
+   CREATE TABLE IF NOT EXISTS total (
+      id       INTEGER PRIMARY KEY CHECK (id = 0),
+      size     INTEGER NOT NULL
+   );
+   INSERT INTO total SELECT 0, (SELECT COALESCE(SUM(size), 0) FROM inventory)
+      WHERE NOT EXISTS (SELECT 1 FROM total);
+   CREATE TRIGGER IF NOT EXISTS inventory_insert AFTER INSERT ON inventory
+      BEGIN UPDATE total SET size = size + NEW.size WHERE id = 0; END;
+   CREATE TRIGGER IF NOT EXISTS inventory_delete AFTER DELETE ON inventory
+      BEGIN UPDATE total SET size = size - OLD.size WHERE id = 0; END;
+   CREATE TABLE IF NOT EXISTS entries (
+      url       TEXT NOT NULL,
+      gribfile  TEXT NOT NULL,
+      bit_start INTEGER NOT NULL,
+      bit_end   INTEGER,
+      date      INTEGER,
+      param     TEXT,
+      desc      TEXT,
+      level     INTEGER,
+      step      INTEGER
+   );
+   CREATE INDEX IF NOT EXISTS entries_url ON entries (url);
+   CREATE INDEX IF NOT EXISTS entries_query ON entries (param, level, step);
+   CREATE TABLE IF NOT EXISTS listing (
+      bucket   TEXT NOT NULL,
+      prefix   TEXT NOT NULL,
+      content  BLOB NOT NULL,
+      fetched  REAL NOT NULL,
+      PRIMARY KEY (bucket, prefix)
+   );
+   """
+
+   def __init__(self, directory, max_size = None, max_age = None, negative_ttl = 24):
+      import os, sqlite3, threading
+
+      assert isinstance(directory, str), TypeError("Argument 'directory' must be string")
+      assert isinstance(max_size, (type(None), int, float)), TypeError("Argument 'max_size' must be None or numeric")
+      assert isinstance(max_age, (type(None), int, float)), TypeError("Argument 'max_age' must be None or numeric")
+      assert isinstance(negative_ttl, (int, float)), TypeError("Argument 'negative_ttl' must be numeric")
+
+      os.makedirs(directory, exist_ok = True)
+      self.file         = os.path.join(directory, "inventory.sqlite")
+      self.max_size     = None if not max_size else int(max_size * 1024**2)
+      self.max_age      = None if not max_age  else max_age * 86400.
+      self.negative_ttl = negative_ttl * 3600.
+
+      log.debug(f"Opening inventory cache {self.file}")
+      self._lock = threading.Lock()
+      self._db   = sqlite3.connect(self.file, timeout = 60, check_same_thread = False)
+      with self._lock, self._db:
+         self._db.executescript(self._schema)
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def get(self, url):
+      """get(url)
+
+      Params
+      ------
+      url : str
+         URL of the inventory file.
+
+      Return
+      ------
+      Returns a tuple (found, content). If the inventory is not in
+      the cache (or expired) found is False. If found is True, content
+      is a list of str (lines) or None for missing inventories (404).
+      """
+      import time
+      now = time.time()
+      with self._lock:
+         row = self._db.execute("SELECT status, content, fetched FROM inventory WHERE url = ?", (url,)).fetchone()
+         if row is None: return (False, None)
+         status, content, fetched = row
+         expired = (status != 200 and now - fetched > self.negative_ttl) or \
+                   (self.max_age is not None and now - fetched > self.max_age)
+         if expired:
+            with self._db:
+               self._delete(url)
+            return (False, None)
+         with self._db:
+            self._db.execute("UPDATE inventory SET accessed = ? WHERE url = ?", (now, url))
+      log.debug(f"Inventory cache hit for {url}")
+      return (True, None if status != 200 else content.split("\n"))
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def put(self, url, content, entries = None):
+      """put(url, content, entries = None)
+
+      Params
+      ------
+      url : str
+         URL of the inventory file.
+      content : None or list of str
+         Content (lines) of the inventory file or None if the
+         file does not exist on the server (negative cache).
+      entries : None or list
+         List of GFSV2.getInventory.inventry objects (all entries of
+         the inventory file, not only the ones selected) stored in the
+         catalogue.
+      """
+      import time
+      if content is None and self.negative_ttl <= 0: return
+      now     = time.time()
+      text    = None if content is None else "\n".join([x.rstrip("\n") for x in content])
+      status  = 404 if content is None else 200
+      size    = 0 if text is None else len(text)
+      with self._lock, self._db:
+         self._delete(url)
+         self._db.execute("INSERT INTO inventory VALUES (?, ?, ?, ?, ?, ?)",
+                          (url, status, text, size, now, now))
+         if entries:
+            self._db.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                  [(url, x.gribfile, x.bit_start, None if x.bit_end == "END" else x.bit_end,
+                    x.date, x.param, x.desc, x.level, x.step) for x in entries])
+         self._evict()
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def query(self, param = None, level = None, step = None, date = None):
+      """query(param = None, level = None, step = None, date = None)
+
+      Queries the catalogue of all cached inventory entries.
+
+      Params
+      ------
+      param : None or str
+         Parameter name as in the inventory file (e.g., "TMP").
+      level : None or int
+         Pressure level in hPa.
+      step : None or int
+         Forecast step in hours.
+      date : None or int
+         Initialization as in the inventory file (YYYYmmddHH).
+
+      Return
+      ------
+      list : List of dictionaries, one per matching entry.
+      """
+      cols  = ["url", "gribfile", "bit_start", "bit_end", "date", "param", "desc", "level", "step"]
+      where = []; args = []
+      for key,val in {"param": param, "level": level, "step": step, "date": date}.items():
+         if val is None: continue
+         where.append(f"{key} = ?"); args.append(val)
+      sql = f"SELECT {', '.join(cols)} FROM entries"
+      if len(where) > 0: sql += " WHERE " + " AND ".join(where)
+      with self._lock:
+         rows = self._db.execute(sql + " ORDER BY url, bit_start", args).fetchall()
+      return [dict(zip(cols, x)) for x in rows]
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def getListing(self, bucket, prefix):
+      """getListing(bucket, prefix)
+
+      Params
+      ------
+      bucket : str
+         URL of the bucket.
+      prefix : str
+         Prefix listed.
+
+      Return
+      ------
+      None if the listing is not in the cache (or expired), else a set
+      of keys.
+      """
+      import time, zlib
+      with self._lock:
+         row = self._db.execute("SELECT content, fetched FROM listing WHERE bucket = ? AND prefix = ?",
+                                (bucket, prefix)).fetchone()
+      if row is None: return None
+      if self.max_age is not None and time.time() - row[1] > self.max_age: return None
+      log.debug(f"Listing cache hit for {bucket}/{prefix}")
+      content = zlib.decompress(row[0]).decode("UTF-8")
+      return set(content.split("\n")) if content else set()
+
+   def putListing(self, bucket, prefix, keys):
+      """putListing(bucket, prefix, keys)
+
+      Params
+      ------
+      bucket : str
+         URL of the bucket.
+      prefix : str
+         Prefix listed.
+      keys : set
+         All keys starting with 'prefix'.
+      """
+      import time, zlib
+      content = zlib.compress("\n".join(sorted(keys)).encode("UTF-8"))
+      with self._lock, self._db:
+         self._db.execute("INSERT OR REPLACE INTO listing VALUES (?, ?, ?, ?)",
+                          (bucket, prefix, content, time.time()))
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def _delete(self, url):
+      self._db.execute("DELETE FROM inventory WHERE url = ?", (url,))
+      self._db.execute("DELETE FROM entries WHERE url = ?", (url,))
+
+   def _evict(self):
+      if self.max_size is None: return
+      total = self._db.execute("SELECT size FROM total WHERE id = 0").fetchone()[0]
+      if total <= self.max_size: return
+      # Least recently used first, in batches (deleting while iterating
+      # over a cursor of the same connection is not safe)
+      while total > self.max_size:
+         rows = self._db.execute("SELECT url, size FROM inventory ORDER BY accessed LIMIT 100").fetchall()
+         if len(rows) == 0: break
+         for url,size in rows:
+            self._delete(url)
+            total -= size
+            if total <= self.max_size: break
+      log.debug("Evicted least recently used entries from inventory cache")
+
+   def close(self):
+      with self._lock:
+         self._db.close()
+
@@ -0,0 +1,115 @@
+# -------------------------------------------------------------------
+# - NAME:        journal.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Journal of completed byte ranges written next to
+#                the temporary output file; allows to resume
+#                interrupted downloads.
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.journal")
+
+class downloadJournal:
+   """Keeps track of the byte ranges (fields) already written to a
+   temporary output file. The temporary file is preallocated and each
+   range is written at its own position (see GFSV2.rangePlanner.rangeSink),
+   the journal stores the index of each range once complete (in any
+   order). If a download is interrupted the next run only requests
+   the ranges not yet journaled.
+
+   Params
+   ------
+   tmpfile : str
+        Name of the temporary output file. The journal is stored
+        in the same directory as '<tmpfile>.journal'.
+   pieces : list
+        List of tuples (url, start, end); all ranges to be written
+        into 'tmpfile' in the order they are written. Used to ensure
+        the journal belongs to the very same download plan.
+
+   Return
+   ------
+   No return, initializes an object of class downloadJournal.
+   """
+
+   def __init__(self, tmpfile, pieces):
+      import json, hashlib
+      self.tmpfile   = tmpfile
+      self.file      = f"{tmpfile}.journal"
+      self.signature = hashlib.sha1(json.dumps(pieces).encode("UTF-8")).hexdigest()
+      self.size      = sum([x[2] - x[1] + 1 for x in pieces])
+      self._fid      = None
+      self._lines    = []
+
+   def load(self):
+      """load()
+
+      Return
+      ------
+      Returns None if there is nothing to resume (no or invalid journal
+      or temporary file). Else a set with the indices of the ranges
+      completed.
+      """
+      import os, json
+      if not os.path.isfile(self.file) or not os.path.isfile(self.tmpfile): return None
+      lines = []
+      with open(self.file, "r") as fid:
+         for line in fid.readlines():
+            # Stop at incomplete lines (interrupted while writing)
+            try:
+               lines.append(json.loads(line))
+            except Exception:
+               break
+      if len(lines) == 0 or lines[0].get("signature") != self.signature:
+         log.info(f"Journal {self.file} does not match the current download, starting from scratch")
+         return None
+      if os.path.getsize(self.tmpfile) != self.size:
+         log.warning(f"Temporary file {self.tmpfile} does not have the expected size, starting from scratch")
+         return None
+      self._lines = lines
+      return set([x["piece"] for x in lines[1:]])
+
+   def start(self, resume):
+      """start(resume)
+
+      Opens the journal for writing.
+
+      Params
+      ------
+      resume : bool
+         If False a new journal is started (existing one overwritten).
+         If True the entries read by load() are kept.
+      """
+      import json
+      lines = self._lines if resume else [{"signature": self.signature}]
+      self._fid = open(self.file, "w")
+      self._fid.write("".join([json.dumps(x) + "\n" for x in lines]))
+      self._fid.flush()
+
+   def add(self, piece):
+      """add(piece)
+
+      Params
+      ------
+      piece : int
+         Index of the range completed (written to the temporary file).
+      """
+      import json
+      self._fid.write(json.dumps({"piece": piece}) + "\n")
+      self._fid.flush()
+
+   def close(self, remove = False):
+      """close(remove = False)
+
+      Params
+      ------
+      remove : bool
+         If True, the journal file is deleted (download complete).
+      """
+      import os
+      if self._fid: self._fid.close()
+      self._fid = None
+      if remove and os.path.isfile(self.file): os.remove(self.file)
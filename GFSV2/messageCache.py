@@ -0,0 +1,270 @@
+# -------------------------------------------------------------------
+# - NAME:        messageCache.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Local cache of grib messages keyed by the URL of the
+#                remote grib file and the byte range of the message.
+#                Output files are assembled from the cache before
+#                going to the network; the cache can be shared by
+#                multiple configs (and users) on the same host.
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.messageCache")
+
+# One cache object per cache directory (and process)
+import threading
+_instances = {}
+_lock      = threading.Lock()
+
+def getMessageCache(config):
+   """getMessageCache(config)
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+
+   Return
+   ------
+   None if '[cache] message_directory' is not set, else an object of
+   class messageCache. The object is created once per process and
+   directory and shared afterwards.
+   """
+   if config.cache_message_dir is None: return None
+   with _lock:
+      if not config.cache_message_dir in _instances:
+         _instances[config.cache_message_dir] = messageCache(config.cache_message_dir,
+               max_size = config.cache_message_max_size)
+   return _instances[config.cache_message_dir]
+
+
+class messageCache:
+   """Cache of grib messages. Each message is stored in its own file
+   named by the SHA-256 hash of the key (URL of the grib file and byte
+   range, '<url>:<start>-<end>'); an SQLite data base keeps track of
+   size and last access. The reforecasts do not change, thus a message
+   is identified by its location in the remote file. Messages are
+   validated when read (see GFSV2.verify.checkMessage); invalid or
+   vanished messages are treated as missing. Files are written to a
+   temporary file and renamed, thus multiple processes can use the
+   same cache at the same time (users sharing a cache need write
+   permissions on the directory, e.g., a common group and umask 002).
+
+   Params
+   ------
+   directory : str
+        Directory where to store the cache (data base 'messages.sqlite'
+        and one subdirectory per first two characters of the hash).
+   max_size : None or float
+        Maximum size of the cache in megabytes. If exceeded, the least
+        recently used messages are evicted.
+
+   Return
+   ------
+   No return, initializes an object of class messageCache.
+   """
+
+   _schema = """
+   CREATE TABLE IF NOT EXISTS messages (
+      key       TEXT PRIMARY KEY,
+      url       TEXT NOT NULL,
+      bit_start INTEGER NOT NULL,
+      bit_end   INTEGER NOT NULL,
+      size      INTEGER NOT NULL,
+      stored    REAL NOT NULL,
+      accessed  REAL NOT NULL
+   );
+   CREATE INDEX IF NOT EXISTS messages_accessed ON messages (accessed);
+   -- Total size of all messages; kept up to date by the triggers (also
+   -- if the cache is shared by multiple processes).
+   CREATE TABLE IF NOT EXISTS total (
+      id        INTEGER PRIMARY KEY CHECK (id = 0),
+      size      INTEGER NOT NULL
+   );
+   INSERT INTO total SELECT 0, (SELECT COALESCE(SUM(size), 0) FROM messages)
+      WHERE NOT EXISTS (SELECT 1 FROM total);
+   CREATE TRIGGER IF NOT EXISTS messages_insert AFTER INSERT ON messages
+      BEGIN UPDATE total SET size = size + NEW.size WHERE id = 0; END;
+   CREATE TRIGGER IF NOT EXISTS messages_delete AFTER DELETE ON messages
+      BEGIN UPDATE total SET size = size - OLD.size WHERE id = 0; END;
+   """
+
+   def __init__(self, directory, max_size = None):
+      import os, sqlite3, threading
+
+      assert isinstance(directory, str), TypeError("Argument 'directory' must be string")
+      assert isinstance(max_size, (type(None), int, float)), TypeError("Argument 'max_size' must be None or numeric")
+
+      os.makedirs(directory, exist_ok = True)
+      self.directory = directory
+      self.file      = os.path.join(directory, "messages.sqlite")
+      self.max_size  = None if not max_size else int(max_size * 1024**2)
+
+      log.debug(f"Opening message cache {self.file}")
+      self._lock = threading.Lock()
+      self._db   = sqlite3.connect(self.file, timeout = 60, check_same_thread = False)
+      with self._lock, self._db:
+         self._db.executescript(self._schema)
+
+   def _key(self, url, start, end):
+      import hashlib
+      return hashlib.sha256(f"{url}:{start:d}-{end:d}".encode("UTF-8")).hexdigest()
+
+   def _path(self, key):
+      import os
+      return os.path.join(self.directory, key[:2], key)
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def get(self, url, start, end):
+      """get(url, start, end)
+
+      Params
+      ------
+      url : str
+         URL of the grib file.
+      start, end : int
+         First and last byte of the message in the remote file.
+
+      Return
+      ------
+      None if the message is not in the cache, else the message (bytes).
+      """
+      import time
+      from GFSV2.verify import checkMessage
+      key = self._key(url, start, end)
+      with self._lock:
+         row = self._db.execute("SELECT size FROM messages WHERE key = ?", (key,)).fetchone()
+      if row is None: return None
+      try:
+         with open(self._path(key), "rb") as fid: data = fid.read()
+      except OSError:
+         data = None
+      if data is None or len(data) != row[0] or checkMessage(data[:16], data[-4:], end - start + 1):
+         log.warning(f"Dropping invalid message {url} {start:d}-{end:d} from message cache")
+         with self._lock, self._db:
+            self._delete(key)
+         return None
+      with self._lock, self._db:
+         self._db.execute("UPDATE messages SET accessed = ? WHERE key = ?", (time.time(), key))
+      return data
+
+   def put(self, url, start, end, data):
+      """put(url, start, end, data)
+
+      Adds a message to the cache (if not yet cached).
+
+      Params
+      ------
+      url : str
+         URL of the grib file.
+      start, end : int
+         First and last byte of the message in the remote file.
+      data : bytes
+         The message.
+      """
+      import os, time
+      assert len(data) == end - start + 1, ValueError("Length of 'data' does not match the byte range")
+      key  = self._key(url, start, end)
+      path = self._path(key)
+      with self._lock:
+         found = self._db.execute("SELECT 1 FROM messages WHERE key = ?", (key,)).fetchone()
+      if found and os.path.isfile(path): return
+
+      os.makedirs(os.path.dirname(path), exist_ok = True)
+      tmp = f"{path}.{os.getpid():d}.{threading.get_ident():d}.tmp"
+      with open(tmp, "wb") as fid: fid.write(data)
+      os.replace(tmp, path)
+      now = time.time()
+      with self._lock, self._db:
+         # No 'INSERT OR REPLACE', the replaced row would not fire the delete trigger
+         self._db.execute("DELETE FROM messages WHERE key = ?", (key,))
+         self._db.execute("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (key, url, start, end, len(data), now, now))
+         self._evict()
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def fill(self, url, sink):
+      """fill(url, sink)
+
+      Writes all cached messages not yet received by 'sink' into the sink.
+
+      Params
+      ------
+      url : str
+         URL of the grib file.
+      sink : GFSV2.rangePlanner.rangeSink
+         Object the data are written to.
+
+      Return
+      ------
+      Returns a tuple (messages, bytes) with the number of messages
+      and bytes taken from the cache.
+      """
+      count = 0; nbytes = 0
+      for i in sink.pending():
+         start,end = sink.wanted[i]
+         data = self.get(url, start, end)
+         if data is None: continue
+         sink.write(start, data)
+         count += 1; nbytes += len(data)
+      return (count, nbytes)
+
+   def store(self, url, sink, indices):
+      """store(url, sink, indices)
+
+      Adds the messages received by 'sink' to the cache.
+
+      Params
+      ------
+      url : str
+         URL of the grib file.
+      sink : GFSV2.rangePlanner.rangeSink
+         Object the data have been written to (see rangeSink.read()).
+      indices : list
+         Indices of the ranges (messages) to be stored; incomplete
+         ranges are ignored.
+      """
+      pending = set(sink.pending())
+      for i in indices:
+         if i in pending: continue
+         data = sink.read(i)
+         if data is None: continue
+         try:
+            self.put(url, *sink.wanted[i], data)
+         except OSError as e:
+            log.warning(f"Cannot store message in message cache: {e}")
+            return
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def _delete(self, key):
+      import os
+      self._db.execute("DELETE FROM messages WHERE key = ?", (key,))
+      try:
+         os.remove(self._path(key))
+      except OSError:
+         pass
+
+   def _evict(self):
+      if self.max_size is None: return
+      total = self._db.execute("SELECT size FROM total WHERE id = 0").fetchone()[0]
+      if total <= self.max_size: return
+      # Least recently used first, in batches (deleting while iterating
+      # over a cursor of the same connection is not safe)
+      while total > self.max_size:
+         rows = self._db.execute("SELECT key, size FROM messages ORDER BY accessed LIMIT 100").fetchall()
+         if len(rows) == 0: break
+         for key,size in rows:
+            self._delete(key)
+            total -= size
+            if total <= self.max_size: break
+      log.debug("Evicted least recently used messages from message cache")
+
+   def close(self):
+      with self._lock:
+         self._db.close()
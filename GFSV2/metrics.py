@@ -0,0 +1,317 @@
+# -------------------------------------------------------------------
+# - NAME:        metrics.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Transfer metrics. Collects per-request information
+#                (bytes, time to first byte, throughput, status, ...)
+#                as well as inventory and subsetting times, writes
+#                them as JSON lines and exposes the aggregated values
+#                in the Prometheus text format.
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.metrics")
+
+# One metrics object per process
+import threading
+_instances = {}
+_lock      = threading.Lock()
+_serve     = True   # Set to False in worker processes (no exporter)
+
+def getMetrics(config):
+   """getMetrics(config)
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+
+   Return
+   ------
+   None if neither '[metrics] file' nor '[metrics] port' is set, else
+   an object of class transferMetrics. The object is created once per
+   process and shared afterwards; the Prometheus exporter is started
+   when the object is created.
+   """
+   if config.metrics_file is None and config.metrics_port is None: return None
+   key = (config.metrics_file, config.metrics_port, config.metrics_address)
+   with _lock:
+      if not key in _instances:
+         _instances[key] = transferMetrics(config.metrics_file,
+                                           config.metrics_port if _serve else None,
+                                           config.metrics_address)
+   return _instances[key]
+
+
+def _escape(value):
+   """Label value escaped for the Prometheus text format."""
+   return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class transferMetrics:
+   """Collects transfer metrics. Each event (request, inventory,
+   cache, subset, file) is written as one JSON line to 'file' (if set) and
+   added to the aggregated counters which can be retrieved in the
+   Prometheus text format via prometheus() or scraped via HTTP.
+
+   Params
+   ------
+   file : None or str
+        Name of the JSON lines file (appended).
+   port : None or int
+        If set, the aggregated metrics are served via HTTP on this port
+        ('http://<address>:<port>/metrics').
+   address : str
+        Address the exporter binds to; defaults to the loopback
+        interface, "0.0.0.0" (or "") to serve on all interfaces.
+
+   Return
+   ------
+   No return, initializes an object of class transferMetrics.
+   """
+
+   def __init__(self, file = None, port = None, address = "127.0.0.1"):
+      import threading, time
+      assert isinstance(file, (type(None), str)), TypeError("Argument 'file' must be None or str")
+      assert isinstance(port, (type(None), int)), TypeError("Argument 'port' must be None or int")
+      assert isinstance(address, str), TypeError("Argument 'address' must be str")
+
+      self.file     = file
+      self.port     = port
+      self.address  = address
+      self.started  = time.time()
+      self._lock    = threading.Lock()
+      self._fid     = open(file, "a") if file else None
+      self._values  = {}  # (name, labels) -> value
+      self._server  = None
+      if port is not None: self._serve(port)
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def _add(self, name, value, **labels):
+      key = (name, tuple(sorted(labels.items())))
+      self._values[key] = self._values.get(key, 0) + value
+
+   def _set(self, name, value, **labels):
+      self._values[(name, tuple(sorted(labels.items())))] = value
+
+   def _write(self, kind, fields):
+      import json, time
+      if self._fid is None: return
+      rec = dict({"time": round(time.time(), 3), "kind": kind}, **fields)
+      self._fid.write(json.dumps(rec) + "\n")
+      self._fid.flush()
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def request(self, c, url, kind = "request", error = None, **fields):
+      """request(c, url, kind = "request", error = None, **fields)
+
+      Records one request using the information of the curl handle.
+
+      Params
+      ------
+      c : pycurl.Curl
+         Curl handle after perform().
+      url : str
+         URL requested.
+      kind : str
+         Type of the request ("request" for data, "inventory").
+      error : None or Exception
+         Error if the request failed.
+      **fields
+         Additional information written to the JSON lines file
+         (e.g., outfile, attempt).
+      """
+      import pycurl
+      info = {"url":      url,
+              "status":   c.getinfo(pycurl.RESPONSE_CODE),
+              "bytes":    int(c.getinfo(pycurl.SIZE_DOWNLOAD)),
+              "ttfb":     round(c.getinfo(pycurl.STARTTRANSFER_TIME), 4),
+              "duration": round(c.getinfo(pycurl.TOTAL_TIME), 4),
+              "speed":    round(c.getinfo(pycurl.SPEED_DOWNLOAD), 1),
+              "connects": c.getinfo(pycurl.NUM_CONNECTS),
+              "error":    None if error is None else str(error)}
+      info.update(fields)
+      status = str(info["status"]) if error is None or info["status"] else "error"
+      with self._lock:
+         self._write(kind, info)
+         self._add("gfsv2_requests_total", 1, kind = kind, status = status)
+         self._add("gfsv2_bytes_total", info["bytes"], kind = kind)
+         self._add("gfsv2_request_seconds_sum", info["duration"], kind = kind)
+         self._add("gfsv2_request_seconds_count", 1, kind = kind)
+         self._add("gfsv2_ttfb_seconds_sum", info["ttfb"], kind = kind)
+         self._add("gfsv2_ttfb_seconds_count", 1, kind = kind)
+         self._add("gfsv2_connects_total", info["connects"], kind = kind)
+         if error is not None: self._add("gfsv2_errors_total", 1, kind = kind)
+         self._set("gfsv2_last_speed_bytes_per_second", info["speed"], kind = kind)
+
+   def transfer(self, outfile, nbytes, duration, success, requests, retries):
+      """transfer(outfile, nbytes, duration, success, requests, retries)
+
+      Records one output file (data transfer).
+
+      Params
+      ------
+      outfile : str
+         Name of the output file.
+      nbytes : int
+         Number of bytes written.
+      duration : float
+         Seconds spent for the transfer.
+      success : bool
+         Whether or not the transfer was successful.
+      requests : int
+         Number of requests.
+      retries : int
+         Number of retries.
+      """
+      info = {"outfile": outfile, "bytes": nbytes, "duration": round(duration, 4),
+              "speed": round(nbytes / duration, 1) if duration > 0 else None,
+              "success": success, "requests": requests, "retries": retries}
+      with self._lock:
+         self._write("file", info)
+         self._add("gfsv2_files_total", 1, status = "success" if success else "failed")
+         self._add("gfsv2_retries_total", retries)
+         self._add("gfsv2_file_seconds_sum", duration)
+         self._add("gfsv2_file_seconds_count", 1)
+
+   def cache(self, url, messages, nbytes, **fields):
+      """cache(url, messages, nbytes, **fields)
+
+      Records messages taken from the message cache instead of
+      downloading them.
+
+      Params
+      ------
+      url : str
+         URL of the grib file.
+      messages : int
+         Number of messages.
+      nbytes : int
+         Number of bytes.
+      **fields
+         Additional information written to the JSON lines file.
+      """
+      info = dict({"url": url, "messages": messages, "bytes": nbytes}, **fields)
+      with self._lock:
+         self._write("cache", info)
+         self._add("gfsv2_cache_messages_total", messages)
+         self._add("gfsv2_cache_bytes_total", nbytes)
+
+   def subset(self, outfile, method, duration, success, attempts = 1):
+      """subset(outfile, method, duration, success, attempts = 1)
+
+      Records the post-processing (subsetting or renaming) of one file.
+
+      Params
+      ------
+      outfile : str
+         Name of the output file.
+      method : str
+         Method used ("native", "wgrib2", or "none" if only renamed).
+      duration : float
+         Seconds spent.
+      success : bool
+         Whether or not successful.
+      attempts : int
+         Number of attempts (see '[main] subset_retries').
+      """
+      info = {"outfile": outfile, "method": method, "duration": round(duration, 4),
+              "success": success, "attempts": attempts}
+      with self._lock:
+         self._write("subset", info)
+         self._add("gfsv2_subset_seconds_sum", duration, method = method)
+         self._add("gfsv2_subset_seconds_count", 1, method = method)
+         if attempts > 1: self._add("gfsv2_subset_retries_total", attempts - 1, method = method)
+         if not success: self._add("gfsv2_errors_total", 1, kind = "subset")
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def prometheus(self):
+      """prometheus()
+
+      Return
+      ------
+      str : Aggregated metrics in the Prometheus text exposition format.
+      """
+      import time
+      with self._lock:
+         values = dict(self._values)
+      values[("gfsv2_uptime_seconds", ())] = time.time() - self.started
+      # Metric family; the '_sum' and '_count' series of the durations
+      # form a summary (samples of a family must be grouped)
+      def family(name):
+         for suffix in ["_sum", "_count"]:
+            if name.endswith(suffix): return (name[:-len(suffix)], "summary")
+         return (name, "counter" if name.endswith("_total") else "gauge")
+      lines = []; last = None
+      for (name, labels), value in sorted(values.items(), key = lambda x: (family(x[0][0])[0], x[0])):
+         fam, typ = family(name)
+         if fam != last:
+            lines.append(f"# TYPE {fam} {typ}")
+            last = fam
+         lab = ",".join([f"{k}=\"{_escape(v)}\"" for k,v in labels])
+         lines.append(f"{name}{{{lab}}} {value}" if lab else f"{name} {value}")
+      return "\n".join(lines) + "\n"
+
+   def _serve(self, port):
+      import http.server, threading
+      metrics = self
+      class handler(http.server.BaseHTTPRequestHandler):
+         def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+               self.send_response(404); self.end_headers(); return
+            body = metrics.prometheus().encode("UTF-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+         def log_message(self, *args): pass
+      try:
+         self._server = http.server.ThreadingHTTPServer((self.address, port), handler)
+      except OSError as e:
+         log.error(f"Cannot start metrics exporter on {self.address}:{port:d}: {e}")
+         return
+      threading.Thread(target = self._server.serve_forever, daemon = True).start()
+      log.info(f"Serving metrics on http://{self.address or '0.0.0.0'}:{port:d}/metrics")
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def summary(self):
+      """summary()
+
+      Logs a summary of the aggregated metrics (per run).
+      """
+      with self._lock:
+         v = dict(self._values)
+      get = lambda name, **labels: v.get((name, tuple(sorted(labels.items()))), 0)
+      for kind in ["inventory", "request"]:
+         n = get("gfsv2_request_seconds_count", kind = kind)
+         if n == 0: continue
+         nbytes = get("gfsv2_bytes_total", kind = kind)
+         secs   = get("gfsv2_request_seconds_sum", kind = kind)
+         log.info("- {:20s} {:d} requests, {:.1f} MB, mean {:.3f} s, TTFB {:.3f} s, {:.2f} MB/s".format(
+                  f"Metrics {kind}:", n, nbytes / 1024.**2, secs / n,
+                  get("gfsv2_ttfb_seconds_sum", kind = kind) / n,
+                  nbytes / 1024.**2 / secs if secs > 0 else 0))
+      if get("gfsv2_cache_messages_total") > 0:
+         log.info("- {:20s} {:d} messages, {:.1f} MB".format("Metrics cache:",
+                  get("gfsv2_cache_messages_total"), get("gfsv2_cache_bytes_total") / 1024.**2))
+      log.info("- {:20s} {:d} ok, {:d} failed, {:d} retries".format("Metrics files:",
+               get("gfsv2_files_total", status = "success"), get("gfsv2_files_total", status = "failed"),
+               get("gfsv2_retries_total")))
+
+   def close(self):
+      """close()
+
+      Logs the summary, closes the JSON lines file and stops the exporter.
+      """
+      self.summary()
+      if self._fid: self._fid.close()
+      self._fid = None
+      if self._server: self._server.shutdown()
+      self._server = None
@@ -0,0 +1,165 @@
+# -------------------------------------------------------------------
+# - NAME:        pipeline.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Asyncio based download pipeline. Inventories of
+#                upcoming files are prefetched while the data of the
+#                current files are transferred, post-processing
+#                (subsetting) runs in a separate stage.
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.pipeline")
+
+# Marks the end of a queue
+_STOP = None
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+async def downloadAsync(config, dates, session = None):
+   """downloadAsync(config, dates, session = None)
+
+   Asynchronous counterpart to download() processing multiple dates
+   in one go. The work is split into three stages connected by bounded
+   queues:
+
+   * inventory: inventories of upcoming (date, param, type) files are
+     downloaded ahead of time,
+   * transfer: '[curl] max_connections' files are downloaded at the
+     same time,
+   * post-processing: subsetting/renaming of completed files by
+     '[main] subset_workers' workers (see download._finalize()).
+
+   If a stage falls behind the queues fill up and the preceding stage
+   waits (backpressure), thus only a limited number of inventories and
+   completed temporary files are kept at any time.
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+   dates : list or GFSV2.planner.downloadPlan
+        List of datetime.datetime objects; dates to be processed.
+        Alternatively a plan as returned by GFSV2.planner.plan(); the
+        files of the plan are downloaded using the inventories of
+        the plan (not downloaded again).
+   session : None or GFSV2.session.curlSession
+        Session used for all downloads. If None, a new session is
+        created and closed once done.
+
+   Return
+   ------
+   No return, raises the first exception occurring in one of the stages.
+
+   Example
+   -------
+   >>> import asyncio
+   >>> asyncio.run(downloadAsync(config, dates))
+   """
+
+   import asyncio, threading
+   from concurrent.futures import ThreadPoolExecutor
+   from datetime import datetime as dt
+   from GFSV2.readConfig import readConfig
+   from GFSV2.session import curlSession
+   from GFSV2.download import _jobs, _exists, _inventory, _register, _transfer, _finalize, _sleep, _postworkers
+   from GFSV2.planner import downloadPlan
+
+   assert isinstance(config, readConfig), TypeError("argument 'config' of must be GFSV2.readConfig.readConfig")
+   assert isinstance(dates, (list, downloadPlan)), TypeError("argument 'dates' must be a list or GFSV2.planner.downloadPlan")
+   if isinstance(dates, list):
+      for date in dates:
+         assert isinstance(date, dt), TypeError("elements in 'dates' must be of type 'datetime.datetime'")
+   assert isinstance(session, (type(None), curlSession)), TypeError("argument 'session' must be None or GFSV2.session.curlSession")
+
+   # Number of workers per stage
+   ntransfer = config.curl_max_connections
+   nprefetch = max(2, ntransfer)
+   npost     = _postworkers(config)
+
+   loop     = asyncio.get_running_loop()
+   executor = ThreadPoolExecutor(max_workers = nprefetch + ntransfer + npost)
+
+   # Queues between the stages
+   jobq      = asyncio.Queue(maxsize = 2 * nprefetch)
+   transferq = asyncio.Queue(maxsize = 2 * ntransfer)
+   postq     = asyncio.Queue(maxsize = 2 * npost)
+
+   # Open ftp logfile if set
+   curllog = open(config.curl_logfile, "a") if config.curl_logfile else None
+   lock    = threading.Lock()
+
+   own_session = session is None
+   if own_session: session = curlSession(config)
+
+   def run(fun, *args):
+      return loop.run_in_executor(executor, fun, *args)
+
+   # Stage 1: inventories
+   async def prefetch():
+      while True:
+         job = await jobq.get()
+         if job is _STOP: break
+         date, (param, typ, levels, outfile), inv = job
+         if inv is None:
+            inv = await run(_inventory, config, date, param, typ, levels, outfile, session)
+         # Planned file downloaded in the meantime
+         elif not config.main_extend and await run(_exists, config, date, param, typ, outfile):
+            continue
+         else:
+            await run(_register, config, date, param, typ, outfile, inv)
+         if inv is not None: await transferq.put((outfile, inv))
+
+   # Stage 2: data transfer
+   async def transfer():
+      while True:
+         job = await transferq.get()
+         if job is _STOP: break
+         outfile, inv = job
+         if await run(_transfer, config, inv, outfile, session, curllog, lock):
+            await postq.put((outfile, inv))
+         if config.main_sleeptime:
+            await run(_sleep, config)
+
+   # Stage 3: post-processing
+   async def postprocess():
+      while True:
+         job = await postq.get()
+         if job is _STOP: break
+         await run(_finalize, config, *job)
+
+   # Feeding the jobs (files to be downloaded) date by date
+   async def produce():
+      if isinstance(dates, downloadPlan):
+         for rec in dates.files:
+            job = (rec["param"], rec["type"], rec["levels"], rec["outfile"])
+            await jobq.put((rec["date"], job, rec["inventory"]))
+         return
+      for date in dates:
+         log.info("Processing date {:s}".format(date.strftime("%Y-%m-%d %HZ")))
+         for job in await run(_jobs, config, date):
+            await jobq.put((date, job, None))
+
+   # Once all workers of a stage are done, one stop signal is sent
+   # to each worker of the next stage.
+   async def stage(workers, nnext, nextq):
+      await asyncio.gather(*workers)
+      for i in range(nnext): await nextq.put(_STOP)
+
+   tasks = [asyncio.ensure_future(x) for x in [
+            stage([produce()],                           nprefetch, jobq),
+            stage([prefetch()    for i in range(nprefetch)], ntransfer, transferq),
+            stage([transfer()    for i in range(ntransfer)], npost,     postq),
+            stage([postprocess() for i in range(npost)],     0,         None)]]
+   try:
+      # Stop everything as soon as one of the stages fails
+      done, pending = await asyncio.wait(tasks, return_when = asyncio.FIRST_EXCEPTION)
+      for task in pending: task.cancel()
+      for task in done:
+         if task.exception(): raise task.exception()
+   finally:
+      executor.shutdown(wait = True)
+      if curllog: curllog.close()
+      if own_session: session.close()
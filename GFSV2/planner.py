@@ -0,0 +1,211 @@
+# -------------------------------------------------------------------
+# - NAME:        planner.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Dry-run planner. Resolves the inventories of all
+#                files to be downloaded and estimates the number of
+#                bytes and requests without downloading any data.
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.planner")
+
+class downloadPlan:
+   """Result of plan(). Contains one entry per output file to be
+   downloaded including the inventory, the byte ranges and the
+   estimated number of bytes and requests.
+
+   Attributes
+   ----------
+   files : list
+        List of dictionaries with "date", "param", "type", "levels",
+        "outfile", "inventory" (GFSV2.getInventory.getInventory),
+        "fields" (number of fields), "bytes" (None if unknown),
+        and "requests".
+   existing : int
+        Number of output files skipped as they already exist.
+   unavailable : list
+        List of output files for which no fields are available
+        (empty or missing inventories).
+   """
+
+   def __init__(self):
+      self.files       = []
+      self.existing    = 0
+      self.unavailable = []
+
+   def bytes(self):
+      """bytes()
+
+      Return
+      ------
+      tuple : Total number of bytes (files with known size) and
+      number of files with unknown size.
+      """
+      known = [x["bytes"] for x in self.files if x["bytes"] is not None]
+      return (sum(known), len(self.files) - len(known))
+
+   def requests(self):
+      """requests()
+
+      Return
+      ------
+      int : Total number of (range) requests.
+      """
+      return sum([x["requests"] for x in self.files])
+
+   def summary(self):
+      """summary()
+
+      Return
+      ------
+      dict : Number of files, fields, requests and bytes
+      (None if unknown) per (param, type).
+      """
+      res = {}
+      for rec in self.files:
+         key = (rec["param"], rec["type"])
+         if not key in res: res[key] = {"files": 0, "fields": 0, "requests": 0, "bytes": 0}
+         res[key]["files"]    += 1
+         res[key]["fields"]   += rec["fields"]
+         res[key]["requests"] += rec["requests"]
+         if res[key]["bytes"] is not None and rec["bytes"] is not None:
+            res[key]["bytes"] += rec["bytes"]
+         else:
+            res[key]["bytes"] = None
+      return res
+
+   def show(self):
+      """show()
+
+      Prints the plan (summary per param/type and totals) to console.
+      """
+      fmt = lambda x: "unknown" if x is None else "{:.1f} MB".format(x / 1024.**2)
+      log.info("Download plan")
+      log.info("- {:20s} {:10s} {:>6s} {:>7s} {:>8s} {:>12s}".format("Param", "Type", "Files", "Fields", "Requests", "Size"))
+      for (param, typ), rec in sorted(self.summary().items()):
+         log.info("- {:20s} {:10s} {:6d} {:7d} {:8d} {:>12s}".format(param, typ,
+                  rec["files"], rec["fields"], rec["requests"], fmt(rec["bytes"])))
+      total, unknown = self.bytes()
+      log.info("- {:20s} {:d}".format("Files to download:", len(self.files)))
+      log.info("- {:20s} {:d}".format("Files existing:",     self.existing))
+      log.info("- {:20s} {:d}".format("Files unavailable:",  len(self.unavailable)))
+      log.info("- {:20s} {:d}".format("Requests:",           self.requests()))
+      log.info("- {:20s} {:s}{:s}".format("Total size:", fmt(total),
+               "" if unknown == 0 else f" (plus {unknown:d} file(s) of unknown size)"))
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def plan(config, dates, session = None):
+   """plan(config, dates, session = None)
+
+   Dry-run of the download. Resolves the inventories of all files to
+   be downloaded (skipping existing output files), applies the step and
+   level filters and estimates the number of bytes and range requests
+   (considering '[curl] range_gap' and '[curl] multirange'). No data
+   are downloaded; if the last message of a grib file is required, the
+   size of the grib file is requested (HEAD) to get the number of bytes.
+
+   The plan can be passed to downloadAsync() instead of a list of dates
+   to download the files without fetching the inventories again.
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+   dates : list
+        List of datetime.datetime objects; dates to be processed.
+   session : None or GFSV2.session.curlSession
+        Session used to download the inventories. If None, a new session
+        is created and closed once done.
+
+   Return
+   ------
+   downloadPlan : Object of class downloadPlan.
+   """
+
+   from concurrent.futures import ThreadPoolExecutor
+   from datetime import datetime as dt
+   from GFSV2.readConfig import readConfig
+   from GFSV2.session import curlSession
+   from GFSV2.download import _jobs, _outfiles
+
+   assert isinstance(config, readConfig), TypeError("argument 'config' of must be GFSV2.readConfig.readConfig")
+   assert isinstance(dates, list), TypeError("argument 'dates' must be a list")
+   for date in dates:
+      assert isinstance(date, dt), TypeError("elements in 'dates' must be of type 'datetime.datetime'")
+   assert isinstance(session, (type(None), curlSession)), TypeError("argument 'session' must be None or GFSV2.session.curlSession")
+
+   own_session = session is None
+   if own_session: session = curlSession(config)
+
+   res  = downloadPlan()
+   jobs = []
+   for date in dates:
+      tmp = _jobs(config, date)
+      res.existing += len(_outfiles(config, date)) - len(tmp)
+      jobs += [(date, *x) for x in tmp]
+   log.info(f"Planning {len(jobs):d} file(s) for {len(dates):d} date(s)")
+
+   # Resolving inventories in parallel ([curl] max_connections)
+   try:
+      with ThreadPoolExecutor(max_workers = config.curl_max_connections) as pool:
+         files = list(pool.map(lambda x: _plan_file(config, session, *x), jobs))
+   finally:
+      if own_session: session.close()
+
+   for job,rec in zip(jobs, files):
+      if rec is None:    res.unavailable.append(job[-1])
+      elif rec is False: res.existing += 1
+      else:              res.files.append(rec)
+
+   return res
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def _plan_file(config, session, date, param, typ, levels, outfile):
+   """_plan_file(config, session, date, param, typ, levels, outfile)
+
+   Return
+   ------
+   None if no fields are available, False if an existing output
+   file contains all fields ('[main] extend'), else a dictionary as
+   stored in downloadPlan.files (only the missing fields if extended).
+   """
+
+   from GFSV2 import getInventory
+   from GFSV2.rangePlanner import planRanges, mergeSpans, chunkSpans, splitRange
+   from GFSV2.download import _segment
+   from GFSV2.extend import extendInventory
+
+   inv = getInventory(config, date, param, typ, levels, session = session)
+   if len(inv.entries) == 0: return None
+   if config.main_extend:
+      inv, missing = extendInventory(config, inv, outfile)
+      if inv is None or missing == 0: return False
+
+   nbytes = 0; nrequests = 0
+   segment = _segment(config)
+   for grb,rec in planRanges(inv.entries, config.curl_range_gap).items():
+      multirange = config.curl_multirange and grb.startswith("http")
+      # Size of the last message unknown; get size of the grib file
+      if rec["wanted"][-1][1] is None:
+         size = session.size(grb)
+         if size is None:
+            nbytes = None
+            nrequests += len(chunkSpans(mergeSpans(rec["wanted"], config.curl_range_gap), multirange))
+            continue
+         rec["wanted"][-1] = (rec["wanted"][-1][0], size - 1)
+      parts = [x for a,b in rec["wanted"] for x in splitRange(a, b, segment)]
+      spans = mergeSpans(parts, config.curl_range_gap, segment)
+      nrequests += len(chunkSpans(spans, multirange))
+      # Bytes transferred, including the unused bytes between merged ranges
+      if nbytes is not None:
+         nbytes += sum([b - a + 1 for a,b in spans])
+
+   return {"date": date, "param": param, "type": typ, "levels": levels, "outfile": outfile,
+           "inventory": inv, "fields": len(inv.entries), "bytes": nbytes, "requests": nrequests}
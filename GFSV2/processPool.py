@@ -0,0 +1,209 @@
+# -------------------------------------------------------------------
+# - NAME:        processPool.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Processing a range of dates using multiple worker
+#                processes. The dates are distributed via a shared
+#                queue (each worker takes the next date once idle),
+#                log messages of all workers are written by the main
+#                process.
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.processPool")
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def downloadDates(config, dates, processes = None):
+   """downloadDates(config, dates, processes = None)
+
+   Downloads the data for all 'dates' using a pool of worker processes.
+   The dates are put into a shared queue; whenever a worker is done with
+   a date it takes the next one (work-stealing), thus the workers stay
+   busy even if some dates take much longer than others. Each worker
+   uses its own GFSV2.session.curlSession and calls download() for one
+   date after another, '[curl] max_connections' still controls the
+   number of files downloaded in parallel within each worker.
+
+   Log messages of the workers are forwarded to the handlers of the
+   main process (prefixed with the name of the worker). A date failing
+   does not stop the other workers; once all dates are processed a
+   summary is logged.
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+   dates : list
+        List of datetime.datetime objects; dates to be processed.
+   processes : None or int
+        Number of worker processes. If None, '[main] processes' is used.
+
+   Return
+   ------
+   dict : Summary with the number of dates processed ("dates"), files
+   downloaded ("downloaded"), files still missing ("missing"; not
+   available or failed), the dates which failed ("failed"; dictionary
+   with date and error message) and the elapsed time in seconds
+   ("elapsed").
+   """
+
+   import multiprocessing as mp
+   import logging.handlers, queue, time
+   from datetime import datetime as dt
+   from GFSV2.readConfig import readConfig
+
+   assert isinstance(config, readConfig), TypeError("argument 'config' of must be GFSV2.readConfig.readConfig")
+   assert isinstance(dates, list), TypeError("argument 'dates' must be a list")
+   for date in dates:
+      assert isinstance(date, dt), TypeError("elements in 'dates' must be of type 'datetime.datetime'")
+   if processes is None: processes = config.main_processes
+   assert isinstance(processes, int) and processes >= 1, ValueError("argument 'processes' must be a positive integer")
+
+   timer     = time.time()
+   processes = max(1, min(processes, len(dates)))
+   # The main process is multi-threaded (log listener, metrics exporter,
+   # post-processing); forking it could copy locks held by other threads.
+   # The workers initialize their own sessions, caches and loggers anyway.
+   ctx       = mp.get_context("spawn")
+
+   # Dates to be processed (plus one stop signal per worker)
+   dateq   = ctx.Queue()
+   resultq = ctx.Queue()
+   logq    = ctx.Queue()
+   for date in dates: dateq.put(date)
+   for i in range(processes): dateq.put(None)
+
+   # Writing the log messages of all workers via the handlers
+   # of the main process
+   root     = logging.getLogger()
+   listener = logging.handlers.QueueListener(logq, *root.handlers, respect_handler_level = True)
+   listener.start()
+
+   # Creates the trace file (if used) the workers append to
+   from GFSV2.tracing import getTracer
+   getTracer(config)
+
+   log.info(f"Processing {len(dates):d} date(s) using {processes:d} worker process(es)")
+   workers = [ctx.Process(target = _worker, name = f"worker-{i + 1:d}",
+                          args = (config, dateq, resultq, logq, root.level)) for i in range(processes)]
+   for p in workers: p.start()
+
+   # Collecting the results; stop waiting if all workers died
+   # (e.g., killed) before all dates have been processed.
+   results = []
+   try:
+      while len(results) < len(dates):
+         try:
+            results.append(resultq.get(timeout = 1))
+         except queue.Empty:
+            if not any([p.is_alive() for p in workers]) and resultq.empty(): break
+   finally:
+      for p in workers: p.join()
+      listener.stop()
+
+   # Summary
+   res = {"dates":      len(results),
+          "downloaded": sum([x["downloaded"] for x in results]),
+          "missing":    sum([x["missing"] for x in results]),
+          "failed":     dict([(x["date"], x["error"]) for x in results if x["error"] is not None]),
+          "elapsed":    time.time() - timer}
+
+   log.info("Summary: {:d} of {:d} date(s) processed by {:d} worker(s) in {:.0f} seconds".format(
+            res["dates"], len(dates), processes, res["elapsed"]))
+   log.info("- {:20s} {:d}".format("Files downloaded:", res["downloaded"]))
+   log.info("- {:20s} {:d}".format("Files missing:",    res["missing"]))
+   log.info("- {:20s} {:d}".format("Dates failed:",     len(res["failed"])))
+   for date,error in res["failed"].items():
+      log.error("  {:s}: {:s}".format(date.strftime("%Y-%m-%d %HZ"), error))
+   if len(results) < len(dates):
+      log.error("{:d} date(s) not processed, worker(s) terminated unexpectedly".format(len(dates) - len(results)))
+
+   return res
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def _worker(config, dateq, resultq, logq, level):
+   """_worker(config, dateq, resultq, logq, level)
+
+   Worker process; processes dates from 'dateq' until receiving None.
+   For each date a dictionary is put into 'resultq'.
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+   dateq : multiprocessing.Queue
+        Queue with the dates to be processed.
+   resultq : multiprocessing.Queue
+        Queue to report the results to the main process.
+   logq : multiprocessing.Queue
+        Queue the log records are sent to.
+   level : int
+        Log level of the root logger.
+   """
+
+   import logging.handlers, multiprocessing as mp
+   from GFSV2.session import curlSession
+   from GFSV2.download import download, _jobs
+
+   # Sending all log records to the main process
+   name = mp.current_process().name
+   root = logging.getLogger()
+   for h in list(root.handlers): root.removeHandler(h)
+   handler = logging.handlers.QueueHandler(logq)
+   handler.addFilter(_prefix(name))
+   root.addHandler(handler)
+   root.setLevel(level)
+
+   # Profiling (see GFSV2.tracing.startProfile) covers the main process only
+   import sys, threading
+   sys.setprofile(None)
+   threading.setprofile(None)
+
+   # Data base connections (SQLite) of the parent must not be re-used
+   # (only relevant if the worker was forked)
+   import GFSV2.inventoryCache, GFSV2.messageCache, GFSV2.s3Listing, GFSV2.stateDB, GFSV2.metrics, GFSV2.tracing
+   GFSV2.inventoryCache._instances.clear()
+   GFSV2.messageCache._instances.clear()
+   GFSV2.s3Listing._instances.clear()
+   GFSV2.stateDB._instances.clear()
+   # Own metrics per worker (JSON lines only, no exporter)
+   GFSV2.metrics._instances.clear()
+   GFSV2.metrics._serve = False
+   # Spans are appended to the trace file of the main process
+   GFSV2.tracing._instances.clear()
+   GFSV2.tracing._append = True
+
+   session = curlSession(config)
+   try:
+      while True:
+         date = dateq.get()
+         if date is None: break
+         log.info("Processing date {:s}".format(date.strftime("%Y-%m-%d %HZ")))
+         todo  = len(_jobs(config, date, extend = False))
+         error = None
+         try:
+            download(config, date, session = session)
+         except Exception as e:
+            log.error(f"Processing date {date:%Y-%m-%d %HZ} failed: {e}")
+            error = str(e)
+         missing = len(_jobs(config, date, extend = False))
+         resultq.put({"date": date, "downloaded": todo - missing, "missing": missing, "error": error})
+   finally:
+      session.close()
+      metrics = GFSV2.metrics.getMetrics(config)
+      if metrics: metrics.close()
+      tracer = GFSV2.tracing.getTracer(config)
+      if tracer: tracer.close()
+
+
+def _prefix(name):
+   """Returns a log filter prefixing the messages with 'name'."""
+   def fun(record):
+      record.msg = f"[{name}] {record.msg}"
+      return True
+   return fun
@@ -0,0 +1,539 @@
+# -------------------------------------------------------------------
+# - NAME:        rangePlanner.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Helper functions and classes to merge the byte ranges
+#                of the inventory entries into as few requests as
+#                possible and to write the (possibly multipart)
+#                responses back into the messages required.
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.rangePlanner")
+
+import re
+_re_content_range = re.compile(r"^\s*bytes\s+([0-9]+)-([0-9]+)/([0-9]+|\*)\s*$", re.I)
+_re_boundary      = re.compile(r"boundary=\"?([^\";]+)\"?", re.I)
+
+
+# -------------------------------------------------------------------
+# Merging byte ranges
+# -------------------------------------------------------------------
+def planRanges(entries, gap = 0):
+   """planRanges(entries, gap = 0)
+
+   Groups the inventory entries by grib file and merges adjacent
+   (or near-adjacent) byte ranges into larger spans.
+
+   Params
+   ------
+   entries : list
+        List of GFSV2.getInventory.inventry objects.
+   gap : int
+        Maximum number of unused bytes between two ranges for them
+        to be merged into one span. Defaults to 0 (only directly
+        adjacent ranges are merged). The unused bytes are downloaded
+        but not written to the output file.
+
+   Return
+   ------
+   Returns a dictionary with one entry per grib file (URL). Each
+   entry contains a dictionary with "wanted" (list of tuples with
+   the byte ranges of the messages, sorted) and "spans" (list of
+   tuples with the merged byte ranges to be requested). The end
+   of a range is None if the range goes to the end of the file.
+   """
+
+   assert isinstance(gap, int) and gap >= 0, ValueError("Argument 'gap' must be a non-negative integer")
+
+   res = {}
+   for rec in entries:
+      end = None if rec.bit_end == "END" else rec.bit_end
+      if not rec.gribfile in res:
+         res[rec.gribfile] = {"wanted": [], "spans": []}
+      res[rec.gribfile]["wanted"].append((rec.bit_start, end))
+
+   for grb,plan in res.items():
+      plan["wanted"].sort(key = lambda x: x[0])
+      plan["spans"] = mergeSpans(plan["wanted"], gap)
+      log.debug(f"Merged {len(plan['wanted']):d} ranges into {len(plan['spans']):d} span(s) for {grb}")
+
+   return res
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def mergeSpans(wanted, gap = 0, maxsize = None):
+   """mergeSpans(wanted, gap = 0, maxsize = None)
+
+   Params
+   ------
+   wanted : list
+        List of tuples (start, end) sorted by start; end can be None.
+   gap : int
+        Maximum number of unused bytes between two ranges to be merged.
+   maxsize : None or int
+        If set, ranges are only merged as long as the span does not
+        get larger than 'maxsize' bytes.
+
+   Return
+   ------
+   list : List of tuples (start, end) with the merged spans.
+   """
+   spans = []
+   for start,end in wanted:
+      if len(spans) > 0 and spans[-1][1] is not None and start - spans[-1][1] - 1 <= gap and \
+         (maxsize is None or (end is not None and end - spans[-1][0] + 1 <= maxsize)):
+         spans[-1] = (spans[-1][0], end)
+      else:
+         spans.append((start, end))
+   return spans
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def rangeString(spans):
+   """rangeString(spans)
+
+   Params
+   ------
+   spans : list
+        List of tuples (start, end); end can be None.
+
+   Return
+   ------
+   str : String to be used with curl (RANGE), e.g., "0-99,200-".
+   """
+   return ",".join([f"{a:d}-" if b is None else f"{a:d}-{b:d}" for a,b in spans])
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def chunkSpans(spans, multirange, maxranges = 50):
+   """chunkSpans(spans, multirange, maxranges = 50)
+
+   Splits the spans into the groups to be requested at once.
+
+   Params
+   ------
+   spans : list
+        List of tuples (start, end) as returned by planRanges().
+   multirange : bool
+        If False, each span is requested separately. If True, up
+        to 'maxranges' spans are combined into one multi-range request.
+   maxranges : int
+        Maximum number of ranges per request (keeps the header short).
+
+   Return
+   ------
+   list : List of lists of spans; one list per request.
+   """
+   if not multirange: return [[x] for x in spans]
+   return [spans[i:(i + maxranges)] for i in range(0, len(spans), maxranges)]
+
+
+# -------------------------------------------------------------------
+# Writing the wanted bytes
+# -------------------------------------------------------------------
+class rangeSink:
+   """Writes the bytes of the wanted ranges into a preallocated file.
+   Receives data together with the offset in the remote file and
+   writes the bytes which are part of one of the wanted ranges at
+   their final position in the output file (os.pwrite); everything
+   else (gaps between merged ranges) is dropped. Ranges can be
+   received in any order (and from multiple threads). If 'segment'
+   is set, large ranges are split into parts of up to 'segment' bytes
+   which can be received independently (segmented downloads); within
+   a part the bytes have to be contiguous. The sink keeps track of the
+   progress of each part such that failed requests can be resumed
+   (see remaining()). Each range is expected to be one grib message;
+   once complete, the message is validated (see GFSV2.verify.checkMessage)
+   using the first and last bytes received. Invalid messages (e.g.,
+   truncated or error pages) are reset and thus requested again.
+
+   Params
+   ------
+   fd : int
+        File descriptor of the (preallocated) output file.
+   wanted : list
+        List of tuples (start, end) with the wanted byte ranges,
+        sorted by start.
+   positions : list
+        Position of each range in the output file.
+   completed : None or set
+        Indices of the ranges already written (resume).
+   callback : None or function
+        Called with the index of the range whenever a range is complete.
+   segment : None or int
+        Maximum size of the parts in bytes, None to keep ranges in one piece.
+
+   Return
+   ------
+   No return, initializes a new object of class rangeSink.
+   """
+
+   def __init__(self, fd, wanted, positions, completed = None, callback = None, segment = None):
+      import threading
+      assert len(wanted) == len(positions), ValueError("Arguments 'wanted' and 'positions' must be of same length")
+      assert all([x[1] is not None for x in wanted]), ValueError("End of all ranges must be known")
+      completed     = set() if completed is None else completed
+      self.fd       = fd
+      self.wanted   = wanted
+      self.positions = positions
+      self.callback = callback
+      self.done     = [(x[1] - x[0] + 1) if i in completed else 0 for i,x in enumerate(wanted)]
+      self.written  = 0
+      self.invalid  = 0
+      self._head    = [b""] * len(wanted) # First 16 bytes of each message
+      self._tail    = [b""] * len(wanted) # Last 4 bytes
+      self._lock    = threading.Lock()
+      # Parts (start, end, index of the range) and bytes received per part
+      self._parts   = [(a, b, i) for i,(start,end) in enumerate(wanted) for a,b in splitRange(start, end, segment)]
+      self._pdone   = [(b - a + 1) if i in completed else 0 for a,b,i in self._parts]
+      self._starts  = [x[0] for x in self._parts]
+
+   def write(self, offset, data):
+      """write(offset, data)
+
+      Params
+      ------
+      offset : int
+         Position of the first byte of 'data' in the remote file.
+      data : bytes
+         Data received.
+      """
+      import bisect
+      data = memoryview(data)
+      last = offset + len(data) # First byte after 'data'
+      j    = max(0, bisect.bisect_right(self._starts, offset) - 1)
+      while j < len(self._parts) and self._parts[j][0] < last:
+         start,end,i = self._parts[j]
+         first,final = self.wanted[i]
+         with self._lock:
+            pos = start + self._pdone[j] # Next byte expected
+            if pos <= end and offset <= end:
+               if offset > pos:
+                  raise ValueError(f"Response not contiguous, missing bytes {pos:d}-{offset - 1:d}")
+               if pos < last:
+                  n = min(last, end + 1) - pos
+                  chunk = data[(pos - offset):(pos - offset + n)]
+                  self._store(i, chunk, pos - first)
+                  if pos - first < 16: self._head[i] += bytes(chunk[:(16 - pos + first)])
+                  if pos + n > final - 4: self._tail[i] = (self._tail[i] + bytes(chunk[-4:]))[-4:]
+                  self._pdone[j] += n
+                  self.done[i]   += n
+                  self.written   += n
+                  if self.done[i] == final - first + 1: self._complete(i)
+         j += 1
+
+   def _complete(self, i):
+      """Validates range 'i' once complete; resets the range if invalid."""
+      from GFSV2.verify import checkMessage
+      start,end = self.wanted[i]
+      error = checkMessage(self._head[i], self._tail[i], end - start + 1)
+      self._head[i] = b""; self._tail[i] = b""
+      if error:
+         log.warning(f"Invalid grib message in bytes {start:d}-{end:d} ({error}), requesting again")
+         self.done[i]  = 0
+         self.invalid += 1
+         for j,part in enumerate(self._parts):
+            if part[2] == i: self._pdone[j] = 0
+      elif self.callback:
+         self.callback(i)
+
+   def _store(self, i, data, position):
+      """Stores 'data' at 'position' relative to the start of range 'i'."""
+      _pwrite(self.fd, data, self.positions[i] + position)
+
+   def read(self, i):
+      """read(i)
+
+      Return
+      ------
+      bytes : Content of range 'i' (as written, see _store()).
+      """
+      import os
+      start,end = self.wanted[i]
+      size = end - start + 1
+      res  = bytearray()
+      while len(res) < size:
+         tmp = os.pread(self.fd, size - len(res), self.positions[i] + len(res))
+         if len(tmp) == 0: raise EOFError(f"Unexpected end of file reading range {i:d}")
+         res += tmp
+      return bytes(res)
+
+   def finish(self, spans):
+      """finish(spans)
+
+      Has to be called once a request was successful. Raises an error
+      if the response did not contain all bytes of the ranges requested.
+
+      Params
+      ------
+      spans : list
+         List of tuples (start, end), the spans requested.
+      """
+      for (start,end,_),done in zip(self._parts, self._pdone):
+         if start + done > end: continue
+         if any([a <= end and (b is None or end <= b) for a,b in spans]):
+            raise ValueError(f"Incomplete response, missing bytes {start + done:d}-{end:d}")
+
+   def remaining(self):
+      """remaining()
+
+      Return
+      ------
+      list : List of tuples (start, end) with the byte ranges (parts) not
+      yet written (partially written parts are continued).
+      """
+      return [(start + done, end) for (start,end,_),done in zip(self._parts, self._pdone) if start + done <= end]
+
+   def pending(self):
+      """pending()
+
+      Return
+      ------
+      list : Indices of the ranges not yet complete.
+      """
+      return [i for i,((start,end),done) in enumerate(zip(self.wanted, self.done)) if start + done <= end]
+
+
+class memorySink(rangeSink):
+   """Same as rangeSink but keeps the ranges in memory (one bytearray
+   per range, see 'buffers') instead of writing them to a file.
+
+   Params
+   ------
+   wanted : list
+        List of tuples (start, end) with the wanted byte ranges,
+        sorted by start.
+   callback : None or function
+        Called with the index of the range whenever a range is complete.
+   segment : None or int
+        Maximum size of the parts in bytes (see rangeSink).
+
+   Return
+   ------
+   No return, initializes a new object of class memorySink.
+   """
+
+   def __init__(self, wanted, callback = None, segment = None):
+      super().__init__(None, wanted, [0] * len(wanted), callback = callback, segment = segment)
+      self.buffers = [bytearray(end - start + 1) for start,end in wanted]
+
+   def _store(self, i, data, position):
+      self.buffers[i][position:(position + len(data))] = data
+
+   def read(self, i):
+      """read(i)
+
+      Return
+      ------
+      None or bytearray : Buffer of range 'i', None if already handed over.
+      """
+      return self.buffers[i]
+
+
+def splitRange(start, end, segment = None):
+   """splitRange(start, end, segment = None)
+
+   Splits a byte range into parts of (almost) equal size of up to
+   'segment' bytes.
+
+   Params
+   ------
+   start, end : int
+        First and last byte of the range.
+   segment : None or int
+        Maximum size of the parts; None to keep the range in one piece.
+
+   Return
+   ------
+   list : List of tuples (start, end).
+   """
+   size = end - start + 1
+   if segment is None or size <= segment: return [(start, end)]
+   n = -(-size // segment)
+   bounds = [start + k * size // n for k in range(n + 1)]
+   return [(bounds[k], bounds[k + 1] - 1) for k in range(n)]
+
+
+def _pwrite(fd, data, position):
+   """Writes all of 'data' at 'position' (os.pwrite may write less)."""
+   import os
+   while len(data) > 0:
+      n = os.pwrite(fd, data, position)
+      data = data[n:]; position += n
+
+
+def allocate(fd, size):
+   """allocate(fd, size)
+
+   Preallocates a file to 'size' bytes (posix_fallocate if supported
+   by the platform and file system, else the file is extended).
+
+   Params
+   ------
+   fd : int
+        File descriptor.
+   size : int
+        Size in bytes.
+   """
+   import os
+   if size > 0 and hasattr(os, "posix_fallocate"):
+      try:
+         os.posix_fallocate(fd, 0, size)
+         return
+      except OSError:
+         pass
+   os.ftruncate(fd, size)
+
+
+# -------------------------------------------------------------------
+# Handling curl responses (single or multipart)
+# -------------------------------------------------------------------
+class rangeResponse:
+   """Used as curl HEADERFUNCTION and WRITEFUNCTION for one range
+   request. Depending on the response the body is forwarded to the
+   rangeSink with the proper offset:
+
+   * 206 with 'Content-Range': single range, offset from header.
+   * 206 with 'multipart/byteranges': split into its parts.
+   * 200: server ignored the range header, the body is the full
+     file (offset 0).
+   * No HTTP status (e.g., FTP): offset is the first byte requested.
+   * Any other status (e.g., 404, 429, 503): the body is discarded,
+     the caller is expected to check 'status'.
+
+   check() compares the number of bytes received with 'Content-Length'.
+
+   Params
+   ------
+   sink : rangeSink
+        Object the data is forwarded to.
+   start : int
+        First byte requested (fallback offset).
+
+   Return
+   ------
+   No return, initializes a new object of class rangeResponse.
+   """
+
+   def __init__(self, sink, start):
+      self.sink      = sink
+      self.start     = start
+      self.status    = None
+      self.headers   = {}
+      self._offset   = None
+      self._splitter = None
+      self._discard  = False
+      self._received = 0
+
+   def header(self, line):
+      line = line.decode("iso-8859-1").strip()
+      if line.startswith("HTTP/"):
+         # New response (e.g., after '100 Continue'); reset
+         self.status  = int(line.split()[1])
+         self.headers = {}
+      elif ":" in line:
+         key,val = line.split(":", 1)
+         self.headers[key.strip().lower()] = val.strip()
+
+   def _setup(self):
+      ctype = self.headers.get("content-type", "")
+      if self.status == 206 and ctype.lower().startswith("multipart/byteranges"):
+         mtch = _re_boundary.search(ctype)
+         if not mtch: raise ValueError(f"No boundary found in \"{ctype}\"")
+         self._splitter = multipartSplitter(mtch.group(1), self.sink)
+      elif self.status == 206 and "content-range" in self.headers:
+         mtch = _re_content_range.match(self.headers["content-range"])
+         if not mtch: raise ValueError(f"Cannot decode \"{self.headers['content-range']}\"")
+         self._offset = int(mtch.group(1))
+      elif self.status == 200:
+         log.warning("Server ignored the range request, receiving the full file")
+         self._offset = 0
+      elif self.status is None or self.status == 206:
+         self._offset = self.start
+      else:
+         self._discard = True
+
+   def write(self, data):
+      if self._splitter is None and self._offset is None and not self._discard: self._setup()
+      self._received += len(data)
+      if self._discard:
+         return
+      elif self._splitter:
+         self._splitter.feed(data)
+      else:
+         self.sink.write(self._offset, data)
+         self._offset += len(data)
+
+   def check(self):
+      """check()
+
+      Raises a ValueError if less (or more) bytes than announced by
+      'Content-Length' have been received.
+      """
+      length = self.headers.get("content-length")
+      if self._discard or length is None or not length.isdigit(): return
+      if int(length) != self._received:
+         raise ValueError(f"Received {self._received:d} of {int(length):d} bytes (Content-Length)")
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class multipartSplitter:
+   """Streaming parser for 'multipart/byteranges' responses. Each
+   part starts with a boundary line followed by headers including
+   'Content-Range'; the body of the part is forwarded to the sink.
+
+   Params
+   ------
+   boundary : str
+        Boundary as specified in the 'Content-Type' header.
+   sink : rangeSink
+        Object the data is forwarded to.
+
+   Return
+   ------
+   No return, initializes a new object of class multipartSplitter.
+   """
+
+   def __init__(self, boundary, sink):
+      self.boundary = f"--{boundary}".encode("ascii")
+      self.sink     = sink
+      self._buffer  = b""
+      self._offset  = None  # Offset of the next byte of the current part
+      self._left    = 0     # Bytes left in the current part
+
+   def feed(self, data):
+      self._buffer += data
+      while len(self._buffer) > 0:
+         # Inside a part: forward body
+         if self._left > 0:
+            n = min(self._left, len(self._buffer))
+            self.sink.write(self._offset, self._buffer[:n])
+            self._buffer  = self._buffer[n:]
+            self._offset += n
+            self._left   -= n
+            continue
+         # Searching for the next part header
+         idx = self._buffer.find(self.boundary)
+         if idx < 0: return
+         hend = self._buffer.find(b"\r\n\r\n", idx)
+         if hend < 0:
+            # Closing boundary or incomplete header; wait for more data
+            if self._buffer.find(self.boundary + b"--", idx) == idx: self._buffer = b""
+            return
+         head = self._buffer[idx:hend].decode("iso-8859-1").split("\r\n")[1:]
+         self._buffer = self._buffer[(hend + 4):]
+         crange = None
+         for line in head:
+            if line.lower().startswith("content-range:"):
+               crange = _re_content_range.match(line.split(":", 1)[1])
+         if not crange: raise ValueError("Multipart response without valid Content-Range")
+         self._offset = int(crange.group(1))
+         self._left   = int(crange.group(2)) - self._offset + 1
+
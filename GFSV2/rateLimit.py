@@ -0,0 +1,224 @@
+# -------------------------------------------------------------------
+# - NAME:        rateLimit.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Rate control; token buckets limiting the number of
+#                requests and bytes per second, exponential backoff
+#                with jitter on errors and throttling responses
+#                (HTTP 429/503, Retry-After).
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.rateLimit")
+
+# HTTP status codes used by servers to throttle clients
+THROTTLE_STATUS = [429, 503]
+
+class httpError(Exception):
+   """Raised if the server responds with an unexpected HTTP status.
+
+   Params
+   ------
+   status : int
+        HTTP status code.
+   retry_after : None or float
+        Seconds to wait as requested by the server ('Retry-After').
+   """
+   def __init__(self, status, retry_after = None):
+      self.status      = status
+      self.retry_after = retry_after
+      super().__init__(f"Server returned HTTP status {status}")
+
+   @property
+   def throttled(self):
+      return self.status in THROTTLE_STATUS
+
+
+def retryAfter(value):
+   """retryAfter(value)
+
+   Params
+   ------
+   value : None or str
+        Value of the 'Retry-After' header (seconds or HTTP date).
+
+   Return
+   ------
+   None or float : Number of seconds to wait.
+   """
+   if value is None: return None
+   try:
+      return max(0., float(value))
+   except ValueError:
+      pass
+   try:
+      from email.utils import parsedate_to_datetime
+      from datetime import datetime, timezone
+      return max(0., (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+   except Exception:
+      log.debug(f"Cannot decode Retry-After \"{value}\"")
+      return None
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class tokenBucket:
+   """Thread-safe token bucket. Tokens are added with a constant rate
+   up to a maximum (burst); take() blocks until the tokens requested
+   are available. Requests larger than the bucket are allowed (the
+   bucket goes into debt, the caller waits accordingly).
+
+   Params
+   ------
+   rate : float
+        Tokens per second.
+   burst : None or float
+        Size of the bucket; defaults to 'rate' (one second).
+
+   Return
+   ------
+   No return, initializes a new object of class tokenBucket.
+   """
+
+   def __init__(self, rate, burst = None):
+      import threading, time
+      assert isinstance(rate, (int, float)) and rate > 0, ValueError("Argument 'rate' must be positive")
+      self.rate    = float(rate)
+      self.burst   = float(rate if burst is None else burst)
+      self._tokens = self.burst
+      self._last   = time.monotonic()
+      self._lock   = threading.Lock()
+
+   def take(self, n = 1):
+      """take(n = 1)
+
+      Params
+      ------
+      n : float
+         Number of tokens required; blocks until available.
+      """
+      import time
+      with self._lock:
+         now = time.monotonic()
+         self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+         self._last   = now
+         self._tokens -= n
+         wait = -self._tokens / self.rate if self._tokens < 0 else 0
+      if wait > 0: time.sleep(wait)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class rateControl:
+   """Rate control shared by all transfers of one session.
+
+   * '[curl] max_requests': maximum number of requests per second.
+   * '[curl] max_bandwidth': maximum bandwidth in megabytes per second.
+   * Errors are retried with exponential backoff and jitter, starting
+     with '[curl] sleeptime' seconds, up to '[curl] backoff_max'.
+   * If the server throttles (HTTP 429/503), all transfers pause for
+     the time requested by 'Retry-After' (or the backoff time).
+
+   By default (no limits set) requests are sent at full speed.
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+
+   Return
+   ------
+   No return, initializes a new object of class rateControl.
+   """
+
+   def __init__(self, config):
+      import threading
+      self.base     = config.curl_sleeptime
+      self.maximum  = config.curl_backoff_max
+      self.requests = tokenBucket(config.curl_max_requests) if config.curl_max_requests else None
+      self.bytes    = tokenBucket(config.curl_max_bandwidth * 1024**2) if config.curl_max_bandwidth else None
+      self._until   = 0.
+      self._lock    = threading.Lock()
+
+   def request(self):
+      """request()
+
+      To be called before each request; waits if all transfers are
+      paused (throttled) or the request rate is exceeded.
+      """
+      import time
+      with self._lock:
+         wait = self._until - time.monotonic()
+      if wait > 0:
+         log.debug(f"Throttled, waiting {wait:.1f} seconds")
+         time.sleep(wait)
+      if self.requests: self.requests.take(1)
+
+   def data(self, nbytes):
+      """data(nbytes)
+
+      To be called for each chunk of data received; waits if the
+      bandwidth is exceeded.
+      """
+      if self.bytes: self.bytes.take(nbytes)
+
+   def wrap(self, write):
+      """wrap(write)
+
+      Params
+      ------
+      write : function
+         Function used as curl WRITEFUNCTION.
+
+      Return
+      ------
+      function : 'write' itself if no bandwidth limit is set, else a
+      function calling data() before forwarding the data to 'write'.
+      """
+      if self.bytes is None: return write
+      def fun(data):
+         self.data(len(data))
+         return write(data)
+      return fun
+
+   def backoff(self, attempt, error = None):
+      """backoff(attempt, error = None)
+
+      Params
+      ------
+      attempt : int
+         Number of the failed attempt (0 for the first one).
+      error : None or Exception
+         The error. If httpError with status 429/503, all transfers
+         are paused.
+
+      Return
+      ------
+      float : Seconds to wait before the next attempt; exponential
+      backoff with jitter or the time requested by the server.
+      """
+      import random, time
+      throttled = isinstance(error, httpError) and error.throttled
+      # Never retry throttled requests immediately
+      base  = max(1., self.base) if throttled else self.base
+      delay = min(self.maximum, base * 2**attempt)
+      delay = delay / 2. + random.uniform(0, delay / 2.)
+      if throttled:
+         if error.retry_after is not None: delay = min(self.maximum, error.retry_after)
+         log.warning(f"Server throttling (HTTP {error.status}), pausing all transfers for {delay:.1f} seconds")
+         with self._lock:
+            self._until = max(self._until, time.monotonic() + delay)
+      return delay
+
+   def wait(self, attempt, error = None):
+      """wait(attempt, error = None)
+
+      Sleeps for the time returned by backoff().
+      """
+      import time
+      delay = self.backoff(attempt, error)
+      if delay > 0:
+         log.info("Sleeping {:.1f} seconds and retry download".format(delay))
+         time.sleep(delay)
@@ -102,6 +102,18 @@ class readConfig:
         except Exception as e:
            log.error("Problems reading s3 config")
            raise Exception(e)
+        # Discovery via bucket listing; the bucket defaults to the
+        # host of the base url (virtual-hosted-style).
+        try:
+           self.s3_discover = CNF.getboolean("s3", "discover")
+        except:
+           self.s3_discover = False
+        try:
+           self.s3_bucket = CNF.get("s3", "bucket")
+        except:
+           from urllib.parse import urlsplit
+           tmp = urlsplit(self.s3_baseurl)
+           self.s3_bucket = f"{tmp.scheme}://{tmp.netloc}"
 
       # Check if curl logfile is set (logging ftp return codes)
       try:
@@ -120,6 +132,119 @@ class readConfig:
          self.curl_sleeptime  = CNF.getfloat("curl","sleeptime")
       except:
          self.curl_sleeptime = 0
+      try:
+         self.curl_max_connections = CNF.getint("curl","max_connections")
+      except:
+         self.curl_max_connections = 1
+      try:
+         self.curl_range_gap = CNF.getint("curl","range_gap")
+      except:
+         self.curl_range_gap = 0
+      try:
+         self.curl_multirange = CNF.getboolean("curl","multirange")
+      except:
+         self.curl_multirange = False
+      try:
+         self.curl_segments = CNF.getint("curl","segments")
+      except:
+         self.curl_segments = 1
+      try:
+         self.curl_segment_size = int(CNF.getfloat("curl","segment_size") * 1024**2)
+      except:
+         self.curl_segment_size = 8 * 1024**2
+      try:
+         self.curl_http2 = CNF.getboolean("curl","http2")
+      except:
+         self.curl_http2 = False
+      try:
+         self.curl_resume = CNF.getboolean("curl","resume")
+      except:
+         self.curl_resume = False
+      try:
+         self.curl_max_requests = CNF.getfloat("curl","max_requests")
+      except:
+         self.curl_max_requests = None
+      try:
+         self.curl_max_bandwidth = CNF.getfloat("curl","max_bandwidth")
+      except:
+         self.curl_max_bandwidth = None
+      try:
+         self.curl_backoff_max = CNF.getfloat("curl","backoff_max")
+      except:
+         self.curl_backoff_max = 300.
+      try:
+         self.curl_throttle_retries = CNF.getint("curl","throttle_retries")
+      except:
+         self.curl_throttle_retries = 10
+      for key in ["max_requests", "max_bandwidth"]:
+         if getattr(self, f"curl_{key}") is not None and getattr(self, f"curl_{key}") <= 0:
+            log.error(f"[curl] {key} must be positive! Please check your config file")
+            sys.exit(9)
+      if self.curl_backoff_max < 0 or self.curl_throttle_retries < 0:
+         log.error("[curl] backoff_max and throttle_retries must be non-negative! Please check your config file")
+         sys.exit(9)
+      if self.curl_max_connections < 1:
+         log.error("[curl] max_connections must be a positive integer! Please check your config file")
+         sys.exit(9)
+      if self.curl_range_gap < 0:
+         log.error("[curl] range_gap must be a non-negative integer! Please check your config file")
+         sys.exit(9)
+      if self.curl_segments < 1 or self.curl_segment_size < 64 * 1024:
+         log.error("[curl] segments must be a positive integer, segment_size at least 0.0625 (64 kB)! Please check your config file")
+         sys.exit(9)
+
+      # Persistent inventory cache (disabled if no directory is set)
+      try:
+         self.cache_dir = CNF.get("cache","directory")
+      except:
+         self.cache_dir = None
+      try:
+         self.cache_max_size = CNF.getfloat("cache","max_size")
+      except:
+         self.cache_max_size = None
+      try:
+         self.cache_max_age = CNF.getfloat("cache","max_age")
+      except:
+         self.cache_max_age = None
+      try:
+         self.cache_negative_ttl = CNF.getfloat("cache","negative_ttl")
+      except:
+         self.cache_negative_ttl = 24.
+
+      # Message cache (grib messages; disabled if no directory is set)
+      try:
+         self.cache_message_dir = CNF.get("cache","message_directory")
+      except:
+         self.cache_message_dir = None
+      try:
+         self.cache_message_max_size = CNF.getfloat("cache","message_max_size")
+      except:
+         self.cache_message_max_size = None
+      if self.cache_message_max_size is not None and self.cache_message_max_size <= 0:
+         log.error("[cache] message_max_size must be positive! Please check your config file")
+         sys.exit(9)
+
+      # Transfer metrics (JSON lines file and/or Prometheus exporter)
+      try:
+         self.metrics_file = CNF.get("metrics","file")
+      except:
+         self.metrics_file = None
+      try:
+         self.metrics_port = CNF.getint("metrics","port")
+      except:
+         self.metrics_port = None
+      if self.metrics_port is not None and (self.metrics_port < 1 or self.metrics_port > 65535):
+         log.error("[metrics] port must be in the range 1-65535! Please check your config file")
+         sys.exit(9)
+      try:
+         self.metrics_address = CNF.get("metrics","address")
+      except:
+         self.metrics_address = "127.0.0.1"
+      # Tracing (Chrome trace event format)
+      try:
+         self.metrics_trace = CNF.get("metrics","trace")
+      except:
+         self.metrics_trace = None
 
       # Date range
       from datetime import datetime as dt
@@ -141,6 +266,15 @@ class readConfig:
       except:
          self.main_sleeptime = None
 
+      # Number of worker processes (dates processed in parallel)
+      try:
+         self.main_processes = CNF.getint("main","processes")
+      except:
+         self.main_processes = 1
+      if self.main_processes < 1:
+         log.error("[main] processes must be a positive integer! Please check your config file")
+         sys.exit(9)
+
       # Areal subset for wgrib2 --small-grib
       try:
          self._lonmin_ = CNF.getfloat("main","lonmin")
@@ -157,6 +291,31 @@ class readConfig:
             sys.exit()
          self.lonsubset = "{:.2f}:{:.2f}".format(self._lonmin_,self._lonmax_)
          self.latsubset = "{:.2f}:{:.2f}".format(self._latmin_,self._latmax_)
+      # wgrib2 if installed (faster), the native subsetting is opt-in
+      try:
+         self.subset_method = CNF.get("main","subset_method")
+      except:
+         import shutil
+         self.subset_method = "wgrib2" if shutil.which("wgrib2") else "native"
+      if not self.subset_method in ["native", "wgrib2"]:
+         log.error("[main] subset_method must be 'native' or 'wgrib2'! Please check your config file")
+         sys.exit(9)
+      # Post-processing stage (subsetting); number of parallel workers
+      # (defaults to the number of cores available) and retries.
+      try:
+         self.subset_workers = CNF.getint("main","subset_workers")
+      except:
+         self.subset_workers = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+      if self.subset_workers < 1:
+         log.error("[main] subset_workers must be a positive integer! Please check your config file")
+         sys.exit(9)
+      try:
+         self.subset_retries = CNF.getint("main","subset_retries")
+      except:
+         self.subset_retries = 2
+      if self.subset_retries < 0:
+         log.error("[main] subset_retries must be zero or positive! Please check your config file")
+         sys.exit(9)
 
       # Output file name
       try:
@@ -164,6 +323,33 @@ class readConfig:
       except Exception as e:
          log.error(e); sys.exit(9)
 
+      # Consolidated output: all messages of a date (or month, depending
+      # on the template) are appended to one archive with offset index.
+      try:
+         self.archive = CNF.get("main","archive")
+      except:
+         self.archive = None
+
+      # Extend existing output files (download missing fields only)
+      try:
+         self.main_extend = CNF.getboolean("main","extend")
+      except:
+         self.main_extend = False
+
+      # Download state data base; 'true' stores the data base in the
+      # output root directory, alternatively the name of the file.
+      from GFSV2.stateDB import outputRoot
+      try:
+         tmp = CNF.get("main","state").strip()
+      except:
+         tmp = "false"
+      if tmp.lower() in ["false", "no", "0", ""]:
+         self.state_file = None
+      elif tmp.lower() in ["true", "yes", "1"]:
+         self.state_file = os.path.join(outputRoot(self.outfile), "GFSV2_state.sqlite")
+      else:
+         self.state_file = tmp
+
       # Steps to download
       self.steps = []
       try:
@@ -204,14 +390,37 @@ class readConfig:
       """!Helper function. Prints content of the config class to console."""
       log.info("- {:20s} {:s}".format("Reforecast version:", str(self.version)))
       log.info("- {:20s} {:s}".format("Output files:",       str(self.outfile)))
+      log.info("- {:20s} {:s}".format("Output archive:",     str(self.archive)))
       log.info("- {:20s} {:s}".format("Date range from:",    str(self.main_from)))
       log.info("- {:20s} {:s}".format("Date range to:",      str(self.main_to)))
       log.info("- {:20s} {:s}".format("Only month nr:",      str(self.main_only)))
       log.info("- {:20s} {:s}".format("Forecast steps:",     str(self.steps)))
+      log.info("- {:20s} {:s}".format("Extend existing:",    str(self.main_extend)))
+      log.info("- {:20s} {:s}".format("Worker processes:",   str(self.main_processes)))
       log.info("- {:20s} {:s}".format("Subset lonmin:",      str(self._lonmin_)))
       log.info("- {:20s} {:s}".format("Subset lonmax:",      str(self._lonmax_)))
       log.info("- {:20s} {:s}".format("Subset latmin:",      str(self._latmin_)))
       log.info("- {:20s} {:s}".format("Subset latmax:",      str(self._latmax_)))
+      log.info("- {:20s} {:s}".format("Subset method:",      str(self.subset_method)))
+      log.info("- {:20s} {:s}".format("Subset workers:",     str(self.subset_workers)))
+      log.info("- {:20s} {:s}".format("Subset retries:",     str(self.subset_retries)))
+      log.info("- {:20s} {:s}".format("Curl connections:",   str(self.curl_max_connections)))
+      log.info("- {:20s} {:s}".format("Curl range gap:",     str(self.curl_range_gap)))
+      log.info("- {:20s} {:s}".format("Curl multirange:",    str(self.curl_multirange)))
+      log.info("- {:20s} {:s}".format("Curl segments:",      "{:d} x {:.1f} MB".format(self.curl_segments, self.curl_segment_size / 1024**2)))
+      log.info("- {:20s} {:s}".format("Curl http2:",         str(self.curl_http2)))
+      log.info("- {:20s} {:s}".format("Curl resume:",        str(self.curl_resume)))
+      log.info("- {:20s} {:s}".format("Curl max requests/s:", str(self.curl_max_requests)))
+      log.info("- {:20s} {:s}".format("Curl max MB/s:",      str(self.curl_max_bandwidth)))
+      log.info("- {:20s} {:s}".format("Curl backoff max:",   str(self.curl_backoff_max)))
+      log.info("- {:20s} {:s}".format("Inventory cache:",    str(self.cache_dir)))
+      log.info("- {:20s} {:s}".format("Message cache:",      str(self.cache_message_dir)))
+      log.info("- {:20s} {:s}".format("Message cache MB:",   str(self.cache_message_max_size)))
+      log.info("- {:20s} {:s}".format("State data base:",    str(self.state_file)))
+      log.info("- {:20s} {:s}".format("Metrics file:",       str(self.metrics_file)))
+      log.info("- {:20s} {:s}".format("Metrics port:",       str(self.metrics_port)))
+      log.info("- {:20s} {:s}".format("Metrics address:",    str(self.metrics_address)))
+      log.info("- {:20s} {:s}".format("Trace file:",         str(self.metrics_trace)))
       if self.version == 2:
           log.info("- {:20s} {:s}".format("FTP base url:",       str(self.ftp_baseurl)))
           log.info("- {:20s} {:s}".format("FTP file names:",     str(self.ftp_filename)))
@@ -221,6 +430,7 @@ class readConfig:
           log.info("- {:20s} {:s}".format("S3 base url:",        str(self.s3_baseurl)))
           log.info("- {:20s} {:s}".format("S3 file names:",      str(self.s3_filename)))
           log.info("- {:20s} {:s}".format("S3 members:",         str(self.s3_members)))
+          log.info("- {:20s} {:s}".format("S3 discover:",        str(self.s3_discover)))
       log.info("- {:20s} {:d}".format("[data] parameters defined:",len(self.data)))
       for k,settings in self.data.items(): log.info(f"  {k} {settings=}")
 
@@ -0,0 +1,196 @@
+# -------------------------------------------------------------------
+# - NAME:        s3Listing.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Availability discovery for GFS reforecast version 12
+#                ('[s3] discover'). Lists the objects of the bucket
+#                (S3 ListObjectsV2, one prefix per year) once instead
+#                of requesting inventory files which do not exist.
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.s3Listing")
+
+# One listing object per bucket (and process)
+import threading
+_instances = {}
+_lock      = threading.Lock()
+
+def getListing(config):
+   """getListing(config)
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+
+   Return
+   ------
+   None if discovery is not enabled ('[s3] discover', version 12 only),
+   else an object of class bucketListing. The object is created once
+   per process and bucket and shared afterwards.
+   """
+   if config.version != 12 or not config.s3_discover: return None
+   from GFSV2.inventoryCache import getCache
+   with _lock:
+      if not config.s3_bucket in _instances:
+         _instances[config.s3_bucket] = bucketListing(config, config.s3_bucket,
+               _prefix(config.s3_baseurl, config.s3_bucket), getCache(config))
+   return _instances[config.s3_bucket]
+
+
+def _prefix(baseurl, bucket):
+   """_prefix(baseurl, bucket)
+
+   Template of the prefix to be listed: path of 'baseurl' relative to
+   the bucket up to and including the first directory depending on
+   the date (e.g., 'GEFSv12/reforecast/%Y/').
+   """
+   path = baseurl[len(bucket):].lstrip("/") if baseurl.startswith(bucket) else baseurl
+   res  = []
+   for part in path.split("/"):
+      if "<" in part: break
+      res.append(part)
+      if "%" in part: break
+   return "/".join(res) + "/" if len(res) > 0 else ""
+
+
+class bucketListing:
+   """Lists the objects of an S3 bucket (ListObjectsV2, paginated).
+   Each prefix (e.g., one year, see getListing()) is listed once; the
+   keys are kept in memory and stored in the inventory cache ('[cache]
+   directory', if set) such that later runs do not list again.
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+   bucket : str
+        URL of the bucket (e.g., https://noaa-gefs-retrospective.s3.amazonaws.com).
+   prefix : str
+        Template of the prefix to be listed (formatted via strftime).
+   cache : None or GFSV2.inventoryCache.inventoryCache
+        Cache where to store the listings.
+
+   Return
+   ------
+   No return, initializes an object of class bucketListing.
+   """
+
+   def __init__(self, config, bucket, prefix, cache = None):
+      self.config   = config
+      self.bucket   = bucket.rstrip("/")
+      self.prefix   = prefix
+      self.cache    = cache
+      self.requests = 0
+      self._keys    = {}  # prefix -> set of keys (None if listing failed)
+      self._lock    = threading.Lock()
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def exists(self, url, date, session = None):
+      """exists(url, date, session = None)
+
+      Params
+      ------
+      url : str
+         URL of an object in the bucket (e.g., an inventory file).
+      date : datetime.datetime
+         Date of the object (defines the prefix to be listed).
+      session : None or GFSV2.session.curlSession
+         Session used if the prefix has to be listed.
+
+      Return
+      ------
+      bool : False if the object is not contained in the listing, True
+      if it is or if the availability is unknown (URL outside the
+      bucket or listing failed).
+      """
+      import urllib.parse
+      if not url.startswith(self.bucket + "/"): return True
+      key    = urllib.parse.unquote(url[(len(self.bucket) + 1):])
+      prefix = date.strftime(self.prefix)
+      if not key.startswith(prefix): return True
+      keys = self.keys(prefix, session)
+      return True if keys is None else key in keys
+
+   def keys(self, prefix, session = None):
+      """keys(prefix, session = None)
+
+      Params
+      ------
+      prefix : str
+         Prefix to be listed.
+      session : None or GFSV2.session.curlSession
+         Session used for the listing requests. If None, a temporary
+         session is created.
+
+      Return
+      ------
+      None if the listing failed, else a set with all keys starting
+      with 'prefix'.
+      """
+      with self._lock:
+         if not prefix in self._keys:
+            keys = self.cache.getListing(self.bucket, prefix) if self.cache else None
+            if keys is None:
+               keys = self._list(prefix, session)
+               if keys is not None and self.cache: self.cache.putListing(self.bucket, prefix, keys)
+            self._keys[prefix] = keys
+         return self._keys[prefix]
+
+   def _list(self, prefix, session):
+      """_list(prefix, session)
+
+      Lists all keys starting with 'prefix' (one request per 1000 keys).
+
+      Return
+      ------
+      None if the listing failed, else a set of keys.
+      """
+      import urllib.parse
+      import xml.etree.ElementTree as ET
+      from GFSV2.session import curlSession
+      from GFSV2.tracing import span
+
+      own_session = session is None
+      if own_session: session = curlSession(self.config)
+      log.info(f"Listing {self.bucket}/{prefix}")
+      keys = set(); token = None
+      try:
+         while True:
+            query = {"list-type": "2", "prefix": prefix}
+            if token: query["continuation-token"] = token
+            url = f"{self.bucket}/?{urllib.parse.urlencode(query)}"
+            try:
+               with span(self.config, "bucket listing", url = url):
+                  status, raw = session.fetch(url)
+            except Exception as e:
+               log.error(f"Listing {url} failed ({e})")
+               return None
+            self.requests += 1
+            if status != 200:
+               log.error(f"Listing {url} failed, return code {status}")
+               return None
+            # Not a listing (e.g., error page served with status 200):
+            # availability unknown.
+            try:
+               root = ET.fromstring(raw)
+            except ET.ParseError as e:
+               log.error(f"Listing {url} failed, invalid response ({e})")
+               return None
+            # Ignore XML namespaces
+            find  = lambda node, tag: [x for x in node if x.tag.split("}")[-1] == tag]
+            for node in find(root, "Contents"):
+               key = find(node, "Key")
+               if key and key[0].text: keys.add(key[0].text)
+            truncated = find(root, "IsTruncated")
+            token     = find(root, "NextContinuationToken")
+            if not truncated or truncated[0].text != "true" or not token: break
+            token = token[0].text
+      finally:
+         if own_session: session.close()
+      log.info(f"Found {len(keys):d} objects in {self.bucket}/{prefix}")
+      return keys
@@ -0,0 +1,216 @@
+# -------------------------------------------------------------------
+# - NAME:        session.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Curl session shared by all downloads (inventories
+#                and data) to re-use DNS lookups, TLS sessions and
+#                open (keep-alive) connections.
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.session")
+
+class curlSession:
+   """Keeps a pool of curl handles which share DNS cache, TLS sessions
+   and connections via a curl share handle. Handles are re-used across
+   files, parameters and dates such that the connection to the server
+   only has to be established once. Can be used from multiple threads
+   (each thread acquires its own handle).
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+
+   Return
+   ------
+   No return, initializes an object of class curlSession.
+
+   Example
+   -------
+   >>> session = curlSession(config)
+   >>> download(config, date, session = session)
+   >>> session.close()
+   """
+
+   def __init__(self, config):
+      import pycurl, threading
+      from GFSV2.readConfig import readConfig
+      from GFSV2.rateLimit import rateControl
+      from GFSV2.metrics import getMetrics
+
+      assert isinstance(config, readConfig), TypeError("Argument 'config' must be of type GFSV2.readConfig.readConfig")
+
+      self.config = config
+      self._lock  = threading.Lock()
+      self._idle  = []
+      self._all   = []
+      # Rate control (limits, backoff) shared by all transfers
+      self.rate   = rateControl(config)
+      # Transfer metrics (None if disabled)
+      self.metrics = getMetrics(config)
+
+      # Share handle; connection sharing requires a more recent libcurl
+      self._share = pycurl.CurlShare()
+      for lock in ["LOCK_DATA_DNS", "LOCK_DATA_SSL_SESSION", "LOCK_DATA_CONNECT"]:
+         if not hasattr(pycurl, lock): continue
+         try:
+            self._share.setopt(pycurl.SH_SHARE, getattr(pycurl, lock))
+         except pycurl.error as e:
+            log.debug(f"Curl share option {lock} not supported ({e})")
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def _configure(self, c):
+      import pycurl
+      c.setopt(pycurl.FOLLOWLOCATION, 0)
+      c.setopt(pycurl.NOPROGRESS, 1)
+      c.setopt(pycurl.TCP_KEEPALIVE, 1)
+      if self.config.curl_timeout:
+         c.setopt(pycurl.CONNECTTIMEOUT, self.config.curl_timeout)
+      if self.config.curl_http2:
+         c.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+      return c
+
+   def acquire(self):
+      """acquire()
+
+      Return
+      ------
+      pycurl.Curl : An idle curl handle (or a new one if none is idle),
+      configured with the defaults of this session. Has to be given back
+      via release() once done.
+      """
+      import pycurl
+      with self._lock:
+         if len(self._idle) > 0: return self._configure(self._idle.pop())
+      c = pycurl.Curl()
+      c.setopt(pycurl.SHARE, self._share)
+      with self._lock:
+         self._all.append(c)
+      return self._configure(c)
+
+   def release(self, c):
+      """release(c)
+
+      Params
+      ------
+      c : pycurl.Curl
+         Handle previously returned by acquire(). All options are reset,
+         open connections (and the share handle) are kept for re-use.
+      """
+      c.reset()
+      with self._lock:
+         self._idle.append(c)
+
+   def handle(self):
+      """handle()
+
+      Context manager around acquire() and release().
+
+      Example
+      -------
+      >>> with session.handle() as c: ...
+      """
+      from contextlib import contextmanager
+      @contextmanager
+      def _handle():
+         c = self.acquire()
+         try:
+            yield c
+         finally:
+            self.release(c)
+      return _handle()
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def fetch(self, url):
+      """fetch(url)
+
+      Downloads a (small) file into memory, e.g., an inventory file.
+
+      Params
+      ------
+      url : str
+         URL of the file to be downloaded.
+
+      Return
+      ------
+      Returns a tuple (status, content) with the HTTP status code (or
+      the FTP response code) and the content as bytes. Raises an
+      exception if the transfer itself fails; FTP 'file not found'
+      errors are returned as status 404. If the server throttles
+      (HTTP 429/503) the request is repeated after waiting (up to
+      '[curl] throttle_retries' times). Each request is recorded as
+      'inventory' in the transfer metrics (if enabled).
+      """
+      import pycurl
+      from io import BytesIO
+      from GFSV2.rateLimit import THROTTLE_STATUS, httpError, retryAfter
+      attempt = 0
+      while True:
+         buf     = BytesIO()
+         headers = {}
+         def header(line):
+            line = line.decode("iso-8859-1")
+            if ":" in line: headers[line.split(":", 1)[0].strip().lower()] = line.split(":", 1)[1].strip()
+         self.rate.request()
+         with self.handle() as c:
+            c.setopt(pycurl.URL, url)
+            c.setopt(pycurl.WRITEFUNCTION, self.rate.wrap(buf.write))
+            c.setopt(pycurl.HEADERFUNCTION, header)
+            try:
+               c.perform()
+            except pycurl.error as e:
+               if self.metrics: self.metrics.request(c, url, "inventory", e, attempt = attempt)
+               if e.args[0] == pycurl.E_REMOTE_FILE_NOT_FOUND: return (404, b"")
+               raise
+            status = c.getinfo(pycurl.RESPONSE_CODE)
+            if self.metrics: self.metrics.request(c, url, "inventory", attempt = attempt)
+         if not status in THROTTLE_STATUS or attempt >= self.config.curl_throttle_retries: break
+         self.rate.wait(attempt, httpError(status, retryAfter(headers.get("retry-after"))))
+         attempt += 1
+      return (status, buf.getvalue())
+
+   def size(self, url):
+      """size(url)
+
+      Size of a remote file (HEAD request; SIZE via ftp).
+
+      Params
+      ------
+      url : str
+         URL of the file.
+
+      Return
+      ------
+      None or int : Size of the file in bytes, None if not available.
+      """
+      import pycurl
+      self.rate.request()
+      with self.handle() as c:
+         c.setopt(pycurl.URL, url)
+         c.setopt(pycurl.NOBODY, 1)
+         try:
+            c.perform()
+         except pycurl.error as e:
+            log.debug(f"Cannot get size of {url} ({e})")
+            return None
+         status = c.getinfo(pycurl.RESPONSE_CODE)
+         size   = c.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD)
+      return int(size) if status in [0, 200, 213, 350] and size >= 0 else None
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def close(self):
+      """close()
+
+      Closes all curl handles and the share handle.
+      """
+      with self._lock:
+         for c in self._all: c.close()
+         self._all = []; self._idle = []
+         self._share.close()
+
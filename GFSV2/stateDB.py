@@ -0,0 +1,283 @@
+# -------------------------------------------------------------------
+# - NAME:        stateDB.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Download state (manifest) data base. Keeps track of
+#                all output files (source URLs, byte ranges, size,
+#                checksum, status) such that completed files can be
+#                skipped without checking the file system and without
+#                downloading the inventories again.
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.stateDB")
+
+# One state object per data base file (and process)
+import threading
+_instances = {}
+_lock      = threading.Lock()
+
+# Status of the output files
+PENDING     = "pending"      # Download started (or interrupted)
+COMPLETE    = "complete"     # Output file written
+FAILED      = "failed"       # Download or subsetting failed
+UNAVAILABLE = "unavailable"  # No fields available (empty/missing inventory)
+MISSING     = "missing"      # Complete but output file missing (see sync())
+
+def getState(config):
+   """getState(config)
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+
+   Return
+   ------
+   None if '[main] state' is not set, else an object of class stateDB.
+   The object is created once per process and file and shared afterwards.
+   """
+   if config.state_file is None: return None
+   with _lock:
+      if not config.state_file in _instances:
+         _instances[config.state_file] = stateDB(config.state_file)
+   return _instances[config.state_file]
+
+
+def outputRoot(outfile):
+   """outputRoot(outfile)
+
+   Params
+   ------
+   outfile : str
+        Output file name template ([main] outfile).
+
+   Return
+   ------
+   str : Directory up to the first placeholder (date format
+   or <...>) of the output file template.
+   """
+   import os, re
+   static = re.split("[%<]", outfile)[0]
+   return os.path.dirname(static) if os.path.dirname(static) else "."
+
+
+class stateDB:
+   """Download state data base (SQLite). Stores one row per output
+   file with the date, parameter, type, source URLs, byte ranges,
+   size, SHA1 checksum and status of the file.
+
+   Params
+   ------
+   file : str
+        Name of the SQLite data base file (created if needed).
+
+   Return
+   ------
+   No return, initializes an object of class stateDB.
+   """
+
+   _schema = """
+   CREATE TABLE IF NOT EXISTS files (
+      outfile  TEXT PRIMARY KEY,
+      date     TEXT NOT NULL,
+      param    TEXT NOT NULL,
+      type     TEXT NOT NULL,
+      status   TEXT NOT NULL,
+      sources  TEXT,
+      ranges   TEXT,
+      size     INTEGER,
+      sha1     TEXT,
+      updated  REAL NOT NULL
+   );
+   CREATE INDEX IF NOT EXISTS files_date ON files (date, status);
+   """
+
+   def __init__(self, file):
+      import os, sqlite3, threading
+
+      assert isinstance(file, str), TypeError("Argument 'file' must be string")
+
+      if os.path.dirname(file): os.makedirs(os.path.dirname(file), exist_ok = True)
+      self.file  = file
+
+      log.debug(f"Opening state data base {self.file}")
+      self._lock = threading.Lock()
+      self._db   = sqlite3.connect(self.file, timeout = 60, check_same_thread = False)
+      with self._lock, self._db:
+         self._db.executescript(self._schema)
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def completed(self, date):
+      """completed(date)
+
+      Params
+      ------
+      date : datetime.datetime
+         Date of interest.
+
+      Return
+      ------
+      set : Names of all output files of this date with status complete.
+      """
+      with self._lock:
+         rows = self._db.execute("SELECT outfile FROM files WHERE date = ? AND status = ?",
+                                 (date.isoformat(), COMPLETE)).fetchall()
+      return set([x[0] for x in rows])
+
+   def status(self, outfile):
+      """status(outfile)
+
+      Return
+      ------
+      None if the file is unknown, else a dictionary with the information
+      stored for 'outfile'.
+      """
+      import json
+      cols = ["outfile", "date", "param", "type", "status", "sources", "ranges", "size", "sha1", "updated"]
+      with self._lock:
+         row = self._db.execute(f"SELECT {', '.join(cols)} FROM files WHERE outfile = ?", (outfile,)).fetchone()
+      if row is None: return None
+      res = dict(zip(cols, row))
+      for key in ["sources", "ranges"]:
+         if res[key] is not None: res[key] = json.loads(res[key])
+      return res
+
+   def summary(self):
+      """summary()
+
+      Return
+      ------
+      dict : Number of files per status.
+      """
+      with self._lock:
+         return dict(self._db.execute("SELECT status, COUNT(*) FROM files GROUP BY status").fetchall())
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def register(self, outfile, date, param, typ, status = PENDING, sources = None, ranges = None):
+      """register(outfile, date, param, typ, status = PENDING, sources = None, ranges = None)
+
+      Adds an output file or updates its status. Sources and byte
+      ranges are kept if not specified.
+
+      Params
+      ------
+      outfile : str
+         Name of the output file.
+      date : datetime.datetime
+         Date of the output file.
+      param : str
+         Parameter name.
+      typ : str
+         Type (member) of the output file.
+      status : str
+         Status of the file (PENDING, UNAVAILABLE, ...).
+      sources : None or list
+         URLs of the grib files the data are taken from.
+      ranges : None or list
+         Byte ranges; list of tuples (url, start, end).
+      """
+      import json, time
+      with self._lock, self._db:
+         self._db.execute("""INSERT INTO files (outfile, date, param, type, status, sources, ranges, updated)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                             ON CONFLICT(outfile) DO UPDATE SET status = excluded.status,
+                                sources = COALESCE(excluded.sources, sources),
+                                ranges  = COALESCE(excluded.ranges, ranges),
+                                updated = excluded.updated""",
+               (outfile, date.isoformat(), param, typ, status,
+                None if sources is None else json.dumps(sources),
+                None if ranges is None else json.dumps(ranges), time.time()))
+
+   def mark(self, outfile, status):
+      """mark(outfile, status)
+
+      Sets the status of a registered output file.
+
+      Params
+      ------
+      outfile : str
+         Name of the output file.
+      status : str
+         New status (PENDING, FAILED, ...).
+      """
+      import time
+      with self._lock, self._db:
+         self._db.execute("UPDATE files SET status = ?, updated = ? WHERE outfile = ?",
+                          (status, time.time(), outfile))
+
+   def complete(self, outfile, date = None, param = None, typ = None):
+      """complete(outfile, date = None, param = None, typ = None)
+
+      Marks an output file as complete; stores size and SHA1 checksum
+      of the file. Date, param and type are only required if the
+      file is not yet known.
+      """
+      import os, time, hashlib
+      sha1 = hashlib.sha1()
+      with open(outfile, "rb") as fid:
+         for chunk in iter(lambda: fid.read(1024**2), b""): sha1.update(chunk)
+      size = os.path.getsize(outfile)
+      with self._lock, self._db:
+         cur = self._db.execute("UPDATE files SET status = ?, size = ?, sha1 = ?, updated = ? WHERE outfile = ?",
+                                (COMPLETE, size, sha1.hexdigest(), time.time(), outfile))
+         if cur.rowcount == 0:
+            self._db.execute("""INSERT INTO files (outfile, date, param, type, status, size, sha1, updated)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                  (outfile, date.isoformat(), param, typ, COMPLETE, size, sha1.hexdigest(), time.time()))
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def sync(self, config, dates):
+      """sync(config, dates)
+
+      Synchronizes the data base with the output files on disk for the
+      given dates. Output files existing on disk but not known as complete
+      are added (e.g., downloaded before the data base has been used),
+      complete files which no longer exist or changed in size are marked
+      as missing such that they will be downloaded again.
+
+      Params
+      ------
+      config : GFSV2.readConfig.readConfig
+         Object as returned by the readConfig() function of this package.
+      dates : list
+         List of datetime.datetime objects.
+
+      Return
+      ------
+      tuple : Number of files added and number of files marked as missing.
+      """
+      import os
+      from GFSV2.download import _outfiles
+      from GFSV2.gribArchive import getArchive
+
+      added = 0; missing = 0
+      for date in dates:
+         archive = getArchive(config, date)
+         for param, typ, levels, outfile in _outfiles(config, date):
+            rec    = self.status(outfile)
+            exists = os.path.isfile(outfile)
+            # Consolidated output: file has been appended to the archive
+            if not exists and archive is not None and archive.contains(date, param, typ):
+               if rec is None or rec["status"] != COMPLETE:
+                  self.register(outfile, date, param, typ, COMPLETE)
+                  added += 1
+               continue
+            if exists and (rec is None or rec["status"] != COMPLETE):
+               self.complete(outfile, date, param, typ)
+               added += 1
+            elif rec is not None and rec["status"] == COMPLETE and \
+                 (not exists or os.path.getsize(outfile) != rec["size"]):
+               self.mark(outfile, MISSING)
+               missing += 1
+      log.info(f"State synchronized: {added:d} file(s) added, {missing:d} file(s) missing")
+      return (added, missing)
+
+   def close(self):
+      with self._lock:
+         self._db.close()
@@ -0,0 +1,261 @@
+# -------------------------------------------------------------------
+# - NAME:        stream.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Streaming API. Yields the grib messages of a date as
+#                they arrive (in memory, nothing is written to disk)
+#                such that they can be processed directly without
+#                writing and reading back temporary files.
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.stream")
+
+# Default memory budget in bytes
+DEFAULT_BUDGET = 256 * 1024**2
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def iterMessages(config, date, session = None, budget = DEFAULT_BUDGET):
+   """iterMessages(config, date, session = None, budget = DEFAULT_BUDGET)
+
+   Generator yielding the grib messages of one date (all parameters
+   and types/members defined by the config) as they arrive. Nothing
+   is written to disk; existing output files, the archive and the
+   state data base are not considered (the message cache is used if
+   configured, see GFSV2.messageCache). '[curl] max_connections' files
+   are downloaded in parallel.
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+   date : datetime.datetime
+        Date of interest.
+   session : None or GFSV2.session.curlSession
+        Session used for all downloads. If None, a new session is
+        created and closed once done.
+   budget : int
+        Maximum number of bytes kept in memory (messages being
+        downloaded plus messages not yet consumed). Downloads wait
+        until the consumer catches up (backpressure). A message larger
+        than the budget is still downloaded (on its own).
+
+   Return
+   ------
+   Yields tuples (param, typ, entry, data); 'param' and 'typ' are the
+   name of the parameter and the type (member) as used in the config
+   file, 'entry' the GFSV2.getInventory.inventry object of the message
+   (level, step, ...) and 'data' the message (memoryview). A message
+   counts towards the budget until the next one is requested; keep a
+   copy (bytes(data)) if needed longer. If an areal subset is defined
+   the messages are subsetted (native subsetting only, raises a
+   NotImplementedError if not supported). Fields which cannot be
+   downloaded are skipped (logged); exceptions in one of the workers
+   are raised.
+
+   Example
+   -------
+   >>> for param, typ, entry, data in iterMessages(config, date):
+   ...    process(entry.level, entry.step, data)
+   """
+
+   import queue
+   from concurrent.futures import ThreadPoolExecutor, Future
+   from datetime import datetime as dt
+   from GFSV2.readConfig import readConfig
+   from GFSV2.session import curlSession
+   from GFSV2.download import _outfiles
+   from GFSV2.gribSubset import _subset_message
+
+   assert isinstance(config, readConfig), TypeError("argument 'config' of must be GFSV2.readConfig.readConfig")
+   assert isinstance(date, dt), TypeError("argument 'date' must be of type 'datetime.datetime'")
+   assert isinstance(session, (type(None), curlSession)), TypeError("argument 'session' must be None or GFSV2.session.curlSession")
+   assert isinstance(budget, int) and budget > 0, ValueError("argument 'budget' must be a positive integer")
+
+   jobs = _outfiles(config, date)
+   if len(jobs) == 0: return
+   bounds = None
+   if config.lonsubset is not None:
+      bounds = (config._lonmin_, config._lonmax_, config._latmin_, config._latmax_)
+
+   own_session = session is None
+   if own_session: session = curlSession(config)
+
+   # Each worker downloads the fields of one file in groups of up to
+   # 'chunk' bytes such that all workers can make progress.
+   nworkers = min(config.curl_max_connections, len(jobs))
+   chunk    = max(1, budget // nworkers)
+   mem      = memoryBudget(budget)
+   msgq     = queue.Queue()
+   pool     = ThreadPoolExecutor(max_workers = nworkers)
+   try:
+      futures = [pool.submit(_produce, config, date, param, typ, levels, outfile, session, mem, chunk, msgq)
+                 for param, typ, levels, outfile in jobs]
+      for f in futures: f.add_done_callback(msgq.put)
+
+      pending = len(futures)
+      while pending > 0:
+         item = msgq.get()
+         # Worker finished; re-raises exceptions
+         if isinstance(item, Future):
+            pending -= 1
+            item.result()
+            continue
+         nbytes, (param, typ, entry, data) = item
+         try:
+            if bounds: data = memoryview(_subset_message(bytes(data), bounds))
+            yield (param, typ, entry, data)
+         finally:
+            mem.release(nbytes)
+   finally:
+      # Stops the workers (if the consumer stopped early)
+      mem.cancel()
+      pool.shutdown(wait = True)
+      if own_session: session.close()
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def _produce(config, date, param, typ, levels, outfile, session, mem, chunk, msgq):
+   """_produce(config, date, param, typ, levels, outfile, session, mem, chunk, msgq)
+
+   Downloads the fields of one parameter and type (member) and puts
+   each message into 'msgq' once complete. Used by iterMessages().
+
+   Params
+   ------
+   outfile : str
+        Name of the output file (logging, metrics; nothing is written).
+   mem : memoryBudget
+        Budget to be acquired before downloading the fields.
+   chunk : int
+        Maximum number of bytes requested at once.
+   msgq : queue.Queue
+        Queue of tuples (nbytes, (param, typ, entry, data)).
+
+   Return
+   ------
+   No return.
+   """
+
+   from datetime import datetime as dt
+   from GFSV2.getInventory import getInventory
+   from GFSV2.rangePlanner import planRanges, memorySink
+   from GFSV2.download import _resolve, _fetch, _segment
+   from GFSV2.messageCache import getMessageCache
+   from GFSV2.tracing import span
+
+   if mem.cancelled: return
+   inv = getInventory(config, date, param, typ, levels, session = session)
+   if len(inv.entries) == 0:
+      log.info(f"Inventory empty, skip {param} {typ}")
+      return
+   curlrange = planRanges(inv.entries, config.curl_range_gap)
+   if not _resolve(session, curlrange):
+      log.error(f"Skip {param} {typ}")
+      return
+   entries = {(x.gribfile, x.bit_start): x for x in inv.entries}
+   # Messages are handed over once complete; added to the cache here
+   cache   = getMessageCache(config)
+
+   timer = dt.now()
+   c = session.acquire()
+   try:
+      for grb,plan in curlrange.items():
+         for wanted in _groups(plan["wanted"], chunk):
+            nbytes = [end - start + 1 for start,end in wanted]
+            if not mem.acquire(sum(nbytes)): return
+
+            def deliver(i):
+               if cache: cache.store(grb, sink, [i])
+               data = memoryview(sink.buffers[i])
+               sink.buffers[i] = None
+               msgq.put((nbytes[i], (param, typ, entries[(grb, wanted[i][0])], data)))
+
+            sink = memorySink(wanted, callback = deliver, segment = _segment(config))
+            with span(config, "fetch", url = grb, fields = len(wanted), date = date, param = param, type = typ):
+               ok, _, _ = _fetch(config, session, c, grb, sink, outfile, None, None, timer)
+            if not ok:
+               # Give back the budget of the fields not delivered
+               mem.release(sum([n for n,(start,end),done in zip(nbytes, wanted, sink.done) if start + done <= end]))
+               log.error(f"Failed to download {param} {typ} from {grb}, skip remaining fields")
+               return
+   finally:
+      session.release(c)
+
+
+def _groups(wanted, size):
+   """_groups(wanted, size)
+
+   Splits the byte ranges into groups of up to 'size' bytes (at least
+   one range per group).
+
+   Return
+   ------
+   list : List of lists of tuples (start, end).
+   """
+   res = [[]]; total = 0
+   for start,end in wanted:
+      n = end - start + 1
+      if len(res[-1]) > 0 and total + n > size:
+         res.append([]); total = 0
+      res[-1].append((start, end)); total += n
+   return res
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+class memoryBudget:
+   """Number of bytes which may be held in memory; shared by the
+   workers of iterMessages() and released by the consumer.
+
+   Params
+   ------
+   size : int
+        Budget in bytes.
+
+   Return
+   ------
+   No return, initializes an object of class memoryBudget.
+   """
+
+   def __init__(self, size):
+      import threading
+      self.size      = size
+      self.used      = 0
+      self.cancelled = False
+      self._cond     = threading.Condition()
+
+   def acquire(self, nbytes):
+      """acquire(nbytes)
+
+      Waits until 'nbytes' are available (or nothing is used at all).
+
+      Return
+      ------
+      bool : False if the budget has been cancelled (stop).
+      """
+      with self._cond:
+         while not self.cancelled and self.used > 0 and self.used + nbytes > self.size:
+            self._cond.wait()
+         if self.cancelled: return False
+         self.used += nbytes
+         return True
+
+   def release(self, nbytes):
+      """release(nbytes)"""
+      with self._cond:
+         self.used -= nbytes
+         self._cond.notify_all()
+
+   def cancel(self):
+      """cancel()
+
+      Wakes up all waiting workers, acquire() returns False from now on.
+      """
+      with self._cond:
+         self.cancelled = True
+         self._cond.notify_all()
@@ -0,0 +1,281 @@
+# -------------------------------------------------------------------
+# - NAME:        tracing.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Tracing and profiling hooks. Spans around the phases
+#                of a download (inventory, transfer, subsetting,
+#                renaming, sleeping, ...) are recorded and written in
+#                the Chrome trace event format (chrome://tracing,
+#                https://ui.perfetto.dev); startProfile() wraps a run
+#                in cProfile and logs a sorted report.
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.tracing")
+
+# One tracer per process
+import threading
+_instances = {}
+_lock      = threading.Lock()
+_append    = False  # Set to True in worker processes (append to the file of the main process)
+
+def getTracer(config):
+   """getTracer(config)
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+
+   Return
+   ------
+   None if '[metrics] trace' is not set, else an object of class
+   traceRecorder. The object is created once per process and shared
+   afterwards.
+   """
+   if config.metrics_trace is None: return None
+   with _lock:
+      if not config.metrics_trace in _instances:
+         _instances[config.metrics_trace] = traceRecorder(config.metrics_trace, append = _append)
+   return _instances[config.metrics_trace]
+
+
+def span(config, name, **args):
+   """span(config, name, **args)
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+   name : str
+        Name of the span (phase).
+   **args
+        Attributes of the span (e.g., date, param, type).
+
+   Return
+   ------
+   Context manager recording the time spent inside the 'with' block
+   (see traceRecorder.span()); does nothing if tracing is disabled.
+
+   Example
+   -------
+   >>> with span(config, "subset", outfile = outfile):
+   >>>     ...
+   """
+   import contextlib
+   tracer = getTracer(config)
+   return contextlib.nullcontext() if tracer is None else tracer.span(name, **args)
+
+
+class traceRecorder:
+   """Records spans (complete events) in the Chrome trace event format.
+   The events are buffered and appended to 'file' (one JSON object per
+   line, JSON array format); worker processes append to the file of the
+   main process (see GFSV2.processPool). Once the main process closes
+   the recorder the file is rewritten as a JSON object ('traceEvents')
+   which can be opened in chrome://tracing or https://ui.perfetto.dev.
+
+   Params
+   ------
+   file : str
+        Name of the trace file.
+   append : bool
+        If False (main process) the file is created (truncated),
+        else the events are appended to an existing file.
+
+   Return
+   ------
+   No return, initializes an object of class traceRecorder.
+   """
+
+   def __init__(self, file, append = False):
+      import os, time
+      assert isinstance(file, str), TypeError("Argument 'file' must be str")
+      assert isinstance(append, bool), TypeError("Argument 'append' must be bool")
+
+      self.file    = file
+      self.append  = append
+      self.pid     = os.getpid()
+      self._lock   = threading.Lock()
+      self._events = []
+      self._tids   = set()
+      # Wall clock based timestamps such that the events of all
+      # processes are on the same time axis.
+      self._offset = time.time_ns() - time.perf_counter_ns()
+
+      outdir = os.path.dirname(file)
+      if outdir: os.makedirs(outdir, exist_ok = True)
+      if not append:
+         with open(file, "w") as fid: fid.write("[\n")
+      self._fd = os.open(file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+      import multiprocessing as mp
+      self._events.append({"name": "process_name", "ph": "M", "pid": self.pid,
+                           "args": {"name": "GFSV2" if not append else mp.current_process().name}})
+
+   def _now(self):
+      import time
+      return (time.perf_counter_ns() + self._offset) / 1000.
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def span(self, name, **args):
+      """span(name, **args)
+
+      Params
+      ------
+      name : str
+         Name of the span.
+      **args
+         Attributes of the span; datetime objects are converted to
+         strings. If the block raises an exception, the error is
+         added ('error').
+
+      Return
+      ------
+      Context manager.
+      """
+      import contextlib
+      @contextlib.contextmanager
+      def fun():
+         start = self._now()
+         try:
+            yield
+         except BaseException as e:
+            args["error"] = f"{type(e).__name__}: {e}"
+            raise
+         finally:
+            self.add(name, start, self._now() - start, **args)
+      return fun()
+
+   def add(self, name, start, duration, **args):
+      """add(name, start, duration, **args)
+
+      Adds a complete event for the current thread.
+
+      Params
+      ------
+      name : str
+         Name of the event.
+      start, duration : float
+         Start (microseconds since epoch) and duration (microseconds).
+      **args
+         Attributes of the event.
+      """
+      import datetime as dt
+      thread = threading.current_thread()
+      event  = {"name": name, "cat": "GFSV2", "ph": "X", "pid": self.pid, "tid": thread.ident,
+                "ts": round(start, 1), "dur": round(duration, 1),
+                "args": dict([(k, v.strftime("%Y-%m-%d %H:%M") if isinstance(v, dt.datetime) else v)
+                              for k,v in args.items() if v is not None])}
+      with self._lock:
+         if not thread.ident in self._tids:
+            self._tids.add(thread.ident)
+            self._events.append({"name": "thread_name", "ph": "M", "pid": self.pid,
+                                 "tid": thread.ident, "args": {"name": thread.name}})
+         self._events.append(event)
+         if len(self._events) >= 1000: self._flush()
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def flush(self):
+      """flush()
+
+      Appends the buffered events to the trace file.
+      """
+      with self._lock:
+         self._flush()
+
+   def _flush(self):
+      import json, os
+      if len(self._events) == 0 or self._fd is None: return
+      # One write per batch; the events of multiple processes
+      # are not interleaved (O_APPEND).
+      os.write(self._fd, "".join([json.dumps(x) + ",\n" for x in self._events]).encode("UTF-8"))
+      self._events = []
+
+   def close(self):
+      """close()
+
+      Writes the remaining events. The main process (append = False)
+      rewrites the file as a JSON object; should be called once all
+      worker processes are done.
+      """
+      import json, os
+      with self._lock:
+         self._flush()
+         if self._fd is None: return
+         os.close(self._fd)
+         self._fd = None
+      if self.append: return
+
+      events = []
+      with open(self.file, "r") as fid:
+         for line in fid:
+            line = line.strip().rstrip(",")
+            if line in ["", "["]: continue
+            events.append(json.loads(line))
+      tmp = f"{self.file}.tmp"
+      with open(tmp, "w") as fid:
+         json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fid)
+      os.replace(tmp, self.file)
+      log.info(f"Trace ({len(events):d} events) written to {self.file}; open in https://ui.perfetto.dev or chrome://tracing")
+
+
+# -------------------------------------------------------------------
+# Profiling
+# -------------------------------------------------------------------
+def startProfile(file = None, sort = "cumulative", limit = 40):
+   """startProfile(file = None, sort = "cumulative", limit = 40)
+
+   Profiles the remaining run of the script (cProfile, including the
+   threads started afterwards). When the interpreter exits, a report
+   sorted by 'sort' is written to stderr.
+
+   Params
+   ------
+   file : None or str
+        If set, the raw statistics are dumped to this file as well
+        (e.g., for snakeviz or 'python -m pstats').
+   sort : str
+        Sort key of the report (see pstats.Stats.sort_stats).
+   limit : int
+        Number of functions shown in the report.
+
+   Return
+   ------
+   No return. Only the calling process is profiled; the worker
+   processes used if '[main] processes' > 1 are not included.
+   """
+   import atexit, cProfile
+
+   profiles = [cProfile.Profile()]
+   def hook(*args):
+      # Called once in each new thread; replaced by the profiler. Since
+      # python 3.12 a single profiler covers all threads and enabling
+      # a second one fails.
+      p = cProfile.Profile()
+      try:
+         p.enable()
+      except ValueError:
+         import sys
+         sys.setprofile(None)
+         return
+      profiles.append(p)
+
+   def report():
+      import pstats, sys
+      threading.setprofile(None)
+      profiles[0].disable()
+      stats = pstats.Stats(profiles[0], stream = sys.stderr)
+      for p in profiles[1:]: stats.add(p)
+      if file: stats.dump_stats(file)
+      log.info(f"Profile of {len(profiles):d} thread(s), sorted by {sort}" + (f" (statistics in {file})" if file else ""))
+      stats.sort_stats(sort).print_stats(limit)
+      sys.stderr.flush()
+
+   threading.setprofile(hook)
+   atexit.register(report)
+   profiles[0].enable()
@@ -0,0 +1,351 @@
+# -------------------------------------------------------------------
+# - NAME:        verify.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Integrity checks of grib messages. Used while the
+#                data are downloaded (see rangePlanner.rangeSink) and
+#                to verify (and repair) existing output files
+#                (see GFSV2_verify).
+# -------------------------------------------------------------------
+
+# Initialize logger
+import logging, logging.config
+log = logging.getLogger("GFSV2.verify")
+
+# Result of verifyFile()
+OK          = "ok"
+REPAIRED    = "repaired"
+BAD         = "bad"
+MISSING     = "missing"
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def checkMessage(head, tail, size = None):
+   """checkMessage(head, tail, size = None)
+
+   Checks one grib message given its first and last bytes: 'GRIB'
+   marker, edition, message length and '7777' end marker.
+
+   Params
+   ------
+   head : bytes
+        First (up to) 16 bytes of the message.
+   tail : bytes
+        Last 4 bytes of the message.
+   size : None or int
+        Expected size of the message (e.g., from the inventory).
+
+   Return
+   ------
+   None if the message is valid, else a str describing the problem.
+   """
+   if len(head) < 8 or head[:4] != b"GRIB":
+      return "no GRIB header"
+   if head[7] == 2:
+      if len(head) < 16: return "truncated header"
+      length = int.from_bytes(head[8:16], "big")
+   elif head[7] == 1:
+      length = int.from_bytes(head[4:7], "big")
+      # Large GRIB1 messages use a different encoding; not checked
+      if length & 0x800000: length = None
+   else:
+      return f"unknown GRIB edition {head[7]:d}"
+   if size is not None and length is not None and length != size:
+      return f"message length {length:d} does not match the expected {size:d} bytes"
+   if tail != b"7777":
+      return "no end marker (7777)"
+   return None
+
+
+def scanGrib(file, sizes = None):
+   """scanGrib(file, sizes = None)
+
+   Checks all messages of a grib file; only the header and the end
+   marker of each message are read.
+
+   Params
+   ------
+   file : str
+        Name of the grib file.
+   sizes : None or list
+        Expected size of each message (layout of the file). If None,
+        the messages are followed using the message length.
+
+   Return
+   ------
+   Returns a tuple (messages, bad). 'messages' is the list of tuples
+   (offset, length) of the messages found (or expected), 'bad' a list
+   with the indices of the invalid messages. If 'sizes' is None and
+   the file is corrupt, the index of the first invalid message is
+   returned in 'bad' (the messages after cannot be located).
+   """
+   import os
+   total = os.path.getsize(file)
+   msgs  = []; bad = []
+   with open(file, "rb") as fid:
+      def check(offset, size):
+         fid.seek(offset); head = fid.read(16)
+         length = size
+         if length is None:
+            if len(head) < 16 or head[:4] != b"GRIB": return (None, "no GRIB header")
+            length = int.from_bytes(head[8:16] if head[7] == 2 else head[4:7], "big")
+         if length < 20 or offset + length > total: return (length, "truncated")
+         fid.seek(offset + length - 4)
+         return (length, checkMessage(head, fid.read(4), size))
+
+      offset = 0
+      if sizes is not None:
+         for i,size in enumerate(sizes):
+            msgs.append((offset, size))
+            if check(offset, size)[1]: bad.append(i)
+            offset += size
+      else:
+         while offset < total:
+            length, error = check(offset, None)
+            if error:
+               log.debug(f"Invalid message at byte {offset:d} in {file} ({error})")
+               bad.append(len(msgs))
+               break
+            msgs.append((offset, length))
+            offset += length
+   return (msgs, bad)
+
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def verifyFile(config, date, param, typ, levels, outfile, session, repair = True, exact = False):
+   """verifyFile(config, date, param, typ, levels, outfile, session, repair = True, exact = False)
+
+   Verifies one output file. The structure of the file is checked
+   first (see scanGrib(); number of messages compared to the field
+   index '<outfile>.inv' if available). Files failing this check (or
+   all files if 'exact' is set) are verified against the inventory.
+   Without areal subset the layout of the file is known (messages in
+   inventory order), thus only the invalid messages are downloaded
+   again and written in place. Subsetted files are downloaded again if
+   invalid or if the number of messages does not match the inventory.
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+   date : datetime.datetime
+        Date of the file.
+   param, typ, levels, outfile :
+        As returned by GFSV2.download._outfiles().
+   session : GFSV2.session.curlSession
+        Session used to download inventories and data.
+   repair : bool
+        If False the file is checked only.
+   exact : bool
+        If True, all files are verified against the inventory (the
+        sizes of the messages are compared) which requires to download
+        the inventory and the size of the remote files.
+
+   Return
+   ------
+   Returns a tuple (status, nbad) with the status (OK, REPAIRED, BAD
+   or MISSING) and the number of invalid messages found.
+   """
+
+   import os
+   from datetime import datetime as dt
+   from GFSV2.getInventory import getInventory
+   from GFSV2.rangePlanner import planRanges, rangeSink
+   from GFSV2.download import _resolve, _fetch, _segment
+   from GFSV2.stateDB import getState
+
+   if not os.path.isfile(outfile): return (MISSING, 0)
+   if not exact and _checkLocal(outfile): return (OK, 0)
+
+   inv = getInventory(config, date, param, typ, levels, session = session)
+   curlrange = planRanges(inv.entries)
+   if len(inv.entries) == 0 or not _resolve(session, curlrange):
+      # Inventory not available: check the structure of the file only
+      log.warning(f"No inventory for {outfile}, checking the grib structure only")
+      nbad = len(scanGrib(outfile)[1])
+      return (OK if nbad == 0 else BAD, nbad)
+   pieces = [(grb, x[0], x[1]) for grb,plan in curlrange.items() for x in plan["wanted"]]
+   sizes  = [end - start + 1 for _,start,end in pieces]
+
+   # Without subset the size of the file is known as well
+   resize = False
+   if config.lonsubset is None:
+      msgs, bad = scanGrib(outfile, sizes)
+      resize    = os.path.getsize(outfile) != sum(sizes)
+      if resize: log.warning(f"{outfile} has {os.path.getsize(outfile):d} bytes, expected {sum(sizes):d}")
+   else:
+      msgs, bad = scanGrib(outfile)
+      if len(bad) == 0 and len(msgs) != len(pieces):
+         log.debug(f"{outfile} contains {len(msgs):d} messages, expected {len(pieces):d}")
+         bad = list(range(len(pieces)))
+   if len(bad) == 0 and not resize: return (OK, 0)
+   if len(bad) > 0: log.warning(f"{len(bad):d} invalid message(s) in {outfile}")
+   if not repair: return (BAD, len(bad))
+
+   # Subsetted: download the file again
+   if config.lonsubset is not None:
+      log.info(f"Downloading {outfile} again")
+      ok = _redownload(config, inv, outfile, session)
+   # Else re-fetch the invalid messages and write them in place
+   else:
+      positions = [x[0] for x in msgs]
+      timer = dt.now()
+      ok = True
+      fd = os.open(outfile, os.O_RDWR)
+      c  = session.acquire()
+      try:
+         if resize: os.ftruncate(fd, sum(sizes))
+         for grb in curlrange.keys():
+            idx = [i for i in bad if pieces[i][0] == grb]
+            if len(idx) == 0: continue
+            sink = rangeSink(fd, [pieces[i][1:] for i in idx], [positions[i] for i in idx], segment = _segment(config))
+            ok = _fetch(config, session, c, grb, sink, outfile, None, None, timer)[0] and ok
+      finally:
+         session.release(c)
+         os.close(fd)
+      ok = ok and len(scanGrib(outfile, sizes)[1]) == 0
+      state = getState(config)
+      if ok and state: state.complete(outfile, date, param, typ)
+
+   if not ok:
+      log.error(f"Could not repair {outfile}")
+      return (BAD, len(bad))
+   log.info(f"Repaired {outfile} ({len(bad):d} message(s))")
+   return (REPAIRED, len(bad))
+
+
+def _redownload(config, inv, outfile, session):
+   """_redownload(config, inv, outfile, session)
+
+   Downloads and subsets an output file again. The new file is written
+   to '<outfile>.repair' and replaces 'outfile' only if valid (all
+   messages of the inventory). If '[main] archive' is set the file is
+   appended to the archive (and removed) and the messages in the
+   archive are checked.
+
+   Return
+   ------
+   bool : True if successful.
+   """
+   import os
+   from GFSV2.download import _transfer, _subset, _index, _archive
+   from GFSV2.gribArchive import getArchive
+   from GFSV2.stateDB import getState
+
+   tmp = f"{outfile}.repair"
+   ok  = _transfer(config, inv, tmp, session, None, None) and _subset(config, f"{tmp}.tmp", tmp)
+   if ok:
+      msgs, bad = scanGrib(tmp)
+      ok = len(bad) == 0 and len(msgs) == len(inv.entries)
+   if not ok:
+      for file in [tmp, f"{tmp}.tmp", f"{tmp}.tmp.journal"]:
+         if os.path.isfile(file): os.remove(file)
+      return False
+
+   os.replace(tmp, outfile)
+   state = getState(config)
+   if state: state.complete(outfile, inv.date, inv.param, inv.typ)
+   archive = getArchive(config, inv.date)
+   if archive is None:
+      _index(outfile, inv.entries)
+      return True
+   return _archive(config, outfile, inv) and _verifyArchive(archive, inv.date, inv.param, inv.typ)[0] == OK
+
+
+def _checkLocal(outfile):
+   """_checkLocal(outfile)
+
+   Checks the structure of a file without inventory (see scanGrib());
+   if the field index '<outfile>.inv' exists, the number of messages
+   has to match the index.
+
+   Return
+   ------
+   bool : True if the file passed the check.
+   """
+   import os
+   msgs, bad = scanGrib(outfile)
+   if len(bad) > 0 or len(msgs) == 0: return False
+   index = f"{outfile}.inv"
+   if os.path.isfile(index):
+      with open(index, "r") as fid:
+         nidx = len([x for x in fid if x.strip()])
+      if nidx != len(msgs):
+         log.debug(f"{outfile} contains {len(msgs):d} messages, field index {nidx:d}")
+         return False
+   return True
+
+
+def verify(config, dates, session = None, repair = True, exact = False):
+   """verify(config, dates, session = None, repair = True, exact = False)
+
+   Verifies all output files of the given dates (see verifyFile()).
+   Files appended to the archive ('[main] archive') are checked but
+   not repaired.
+
+   Params
+   ------
+   config : GFSV2.readConfig.readConfig
+        Object as returned by the readConfig() function of this package.
+   dates : list
+        List of datetime.datetime objects.
+   session : None or GFSV2.session.curlSession
+        Session used for all downloads. If None, a new session is
+        created and closed once done.
+   repair : bool
+        If False the files are checked only.
+   exact : bool
+        If True, all files are verified against the inventory, else only
+        the files failing the structure check (see verifyFile()).
+
+   Return
+   ------
+   dict : Number of files per status (OK, REPAIRED, BAD, MISSING) and
+   the number of invalid messages ('messages').
+   """
+
+   import os
+   from GFSV2.session import curlSession
+   from GFSV2.download import _outfiles
+   from GFSV2.gribArchive import getArchive
+
+   own_session = session is None
+   if own_session: session = curlSession(config)
+
+   res = {OK: 0, REPAIRED: 0, BAD: 0, MISSING: 0, "messages": 0}
+   try:
+      for date in dates:
+         log.info("Verifying date {:s}".format(date.strftime("%Y-%m-%d %HZ")))
+         archive = getArchive(config, date)
+         for param, typ, levels, outfile in _outfiles(config, date):
+            if not os.path.isfile(outfile) and archive is not None and archive.contains(date, param, typ):
+               status, nbad = _verifyArchive(archive, date, param, typ)
+            else:
+               status, nbad = verifyFile(config, date, param, typ, levels, outfile, session, repair, exact)
+            res[status]     += 1
+            res["messages"] += nbad
+   finally:
+      if own_session: session.close()
+
+   log.info("Files verified: {:d} ok, {:d} repaired, {:d} bad, {:d} missing ({:d} invalid messages)".format(
+            res[OK], res[REPAIRED], res[BAD], res[MISSING], res["messages"]))
+   return res
+
+
+def _verifyArchive(archive, date, param, typ):
+   """_verifyArchive(archive, date, param, typ)
+
+   Checks the messages of one date, parameter and type in the archive.
+
+   Return
+   ------
+   Returns a tuple (status, nbad).
+   """
+   nbad = 0
+   for entry in archive.entries(date, param, typ):
+      data = archive.read(entry)
+      if checkMessage(data[:16], data[-4:], entry.length): nbad += 1
+   if nbad > 0: log.warning(f"{nbad:d} invalid message(s) in {archive.file} ({date:%Y-%m-%d %H} {param} {typ})")
+   return (OK if nbad == 0 else BAD, nbad)
@@ -0,0 +1,232 @@
+#!/usr/bin/python
+# -------------------------------------------------------------------
+# - NAME:        download.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: End-to-end benchmark of the downloader. Writes a
+#                synthetic noaa-gefs-retrospective bucket, serves it
+#                locally (benchmark/s3server.py) and runs a set of
+#                scenarios (download(), downloadAsync(), downloadDates()
+#                and GFSV2_bulk) each in a separate process, reporting
+#                files/s, MB/s, requests and peak memory. No network
+#                access required.
+#
+#                Usage: python benchmark/download.py [options] [scenarios]
+#                       python benchmark/download.py --help
+# -------------------------------------------------------------------
+
+import logging
+logging.basicConfig(format = "# %(levelname)s %(message)s", level = logging.INFO)
+log = logging.getLogger()
+
+import os, sys
+
+# Scenarios; 'run' defines how the data are downloaded, 'main' and
+# 'curl' are written into the config file, 'server' overrules the
+# settings of the local server (error injection).
+SCENARIOS = {
+   "download":    {"run": "download",  "curl": {"max_connections": 1}},
+   "download-j4": {"run": "download",  "curl": {"max_connections": 4}},
+   "pipeline":    {"run": "pipeline",  "curl": {"max_connections": 4}},
+   "multirange":  {"run": "pipeline",  "curl": {"max_connections": 4, "multirange": "true"}},
+   "segmented":   {"run": "pipeline",  "curl": {"max_connections": 4, "segments": 4, "segment_size": 0.0625}},
+   "processes":   {"run": "processes", "curl": {"max_connections": 4}, "main": {"processes": 2}},
+   "bulk":        {"run": "bulk",      "curl": {"max_connections": 4}},
+   "subset":      {"run": "pipeline",  "curl": {"max_connections": 4},
+                   "main": {"lonmin": 0, "lonmax": 20, "latmin": 40, "latmax": 60}},
+   "flaky":       {"run": "pipeline",  "curl": {"max_connections": 4, "retries": 5},
+                   "server": {"fail_every": 50}},
+   "throttled":   {"run": "pipeline",  "curl": {"max_connections": 4},
+                   "server": {"throttle_every": 25}},
+}
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def writeConfig(file, url, outdir, dates, members, steps, scenario):
+   """Writes the config file for one scenario."""
+   main = {"version": 12,
+           "outfile": os.path.join(outdir, "%Y/%m/GFSV<version>_%Y%m%d%H_<param>_<type>.grib2"),
+           "from":    dates[0].strftime("%Y-%m-%d"),
+           "to":      dates[-1].strftime("%Y-%m-%d"),
+           "steps":   ",".join([str(x) for x in steps])}
+   curl = {"timeout": 30, "retries": 2, "sleeptime": 0}
+   main.update(scenario.get("main", {}))
+   curl.update(scenario.get("curl", {}))
+   with open(file, "w") as fid:
+      for name, section in [("main", main), ("curl", curl)]:
+         fid.write(f"[{name}]\n" + "".join([f"{k} = {v}\n" for k,v in section.items()]))
+      fid.write("[s3]\n")
+      fid.write(f"baseurl  = {url}/GEFSv12/reforecast/%Y/%Y%m%d%H/<type>/<days>\n")
+      fid.write("filename = <param>_%Y%m%d%H_<type>.grib2\n")
+      fid.write(f"members  = {','.join(members)}\n")
+      fid.write("[data tmp_pres]\nlevels = 500,850\n")
+      fid.write("[data tmax_2m]\n")
+      fid.write("[data pres_msl]\n")
+
+
+def runScenario(name, scenario, server, workdir, args):
+   """Runs one scenario in a separate process.
+
+   Return
+   ------
+   dict : Results (files written, MB transferred, seconds, requests,
+   peak memory).
+   """
+   import shutil, subprocess, time
+
+   outdir = os.path.join(workdir, "out", name)
+   config = os.path.join(workdir, f"{name}.conf")
+   shutil.rmtree(outdir, ignore_errors = True)
+   writeConfig(config, server.url, outdir, args.dates, args.members, args.steps, scenario)
+
+   # Server settings (error injection)
+   for key in ["fail_every", "throttle_every"]:
+      setattr(server, key, scenario.get("server", {}).get(key, 0))
+   server.reset()
+
+   # The peak memory is measured by the child itself; the resource
+   # usage returned by wait4 would include the high-water mark the child
+   # inherits from this process (which runs the server).
+   result = os.path.join(workdir, f"{name}.peak")
+   if os.path.isfile(result): os.remove(result)
+   cmd = [sys.executable, __file__, "--child", scenario["run"], config, result]
+   with open(os.path.join(workdir, f"{name}.log"), "w") as logfile:
+      timer = time.perf_counter()
+      proc  = subprocess.Popen(cmd, stdout = logfile, stderr = subprocess.STDOUT)
+      proc.wait()
+      elapsed = time.perf_counter() - timer
+   peak = float("nan")
+   if os.path.isfile(result):
+      with open(result) as fid: peak = float(fid.read())
+
+   # Files written, data transferred (incl. inventories, retries)
+   files  = [f for _,_,fs in os.walk(outdir) for f in fs if f.endswith(".grib2")]
+   nbytes = server.bytes
+   return {"scenario": name, "status": proc.returncode, "files": len(files),
+           "MB": nbytes / 1024.**2, "seconds": elapsed,
+           "files/s": len(files) / elapsed, "MB/s": nbytes / 1024.**2 / elapsed,
+           "requests": server.requests, "peak MB": peak}
+
+
+def peakMemory():
+   """Peak resident set size in MB of the calling process (VmHWM, unlike
+   ru_maxrss not inherited from the parent process) or of its worker
+   processes, whichever is larger."""
+   import resource
+   peak = None
+   try:
+      with open("/proc/self/status") as fid:
+         for line in fid:
+            if line.startswith("VmHWM:"): peak = int(line.split()[1]) / 1024.
+   except OSError:
+      pass
+   if peak is None: peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+   return max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.)
+
+
+def runChild(run, config, result):
+   """Downloads the data defined in the config file (child process);
+   the peak memory is written to 'result'."""
+   try:
+      _runChild(run, config)
+   finally:
+      with open(result, "w") as fid: fid.write(f"{peakMemory():.3f}")
+
+
+def _runChild(run, config):
+   import asyncio, runpy
+   from GFSV2 import readConfig, download, downloadAsync, downloadDates
+   from GFSV2.session import curlSession
+   import datetime as dt
+
+   if run == "bulk":
+      sys.argv = ["GFSV2_bulk", "-c", config]
+      try:
+         runpy.run_path(os.path.join(os.path.dirname(__file__), "..", "bin", "GFSV2_bulk"), run_name = "__main__")
+      except SystemExit as e:
+         if e.code: raise
+      return
+
+   config = readConfig(config)
+   dates  = [config.main_from + dt.timedelta(i) for i in range((config.main_to - config.main_from).days + 1)]
+   if run == "processes":
+      downloadDates(config, dates)
+      return
+   session = curlSession(config)
+   try:
+      if run == "download":
+         for date in dates: download(config, date, session = session)
+      else:
+         asyncio.run(downloadAsync(config, dates, session = session))
+   finally:
+      session.close()
+
+
+# -------------------------------------------------------------------
+# Main part of the script
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+   import argparse, json, tempfile
+   import datetime as dt
+
+   if len(sys.argv) == 5 and sys.argv[1] == "--child":
+      runChild(sys.argv[2], sys.argv[3], sys.argv[4])
+      sys.exit(0)
+
+   parser = argparse.ArgumentParser(description = "End-to-end benchmark against a local S3 stand-in.")
+   parser.add_argument("scenarios", nargs = "*", default = list(SCENARIOS.keys()),
+         help = "Scenarios to run: " + ", ".join(SCENARIOS.keys()) + " (default all).")
+   parser.add_argument("--workdir", type = str, default = None,
+         help = "Directory for the synthetic bucket and the output (default: temporary directory). " + \
+                "The bucket is re-used if it already exists.")
+   parser.add_argument("--ndates", type = int, default = 4, help = "Number of dates (default 4).")
+   parser.add_argument("--nmembers", type = int, default = 5, help = "Number of members (default 5).")
+   parser.add_argument("--grid", type = int, nargs = 2, default = [360, 181],
+         help = "Grid points in longitude and latitude direction (default 360 181).")
+   parser.add_argument("--latency", type = float, default = 0.02, help = "Server latency in seconds (default 0.02).")
+   parser.add_argument("--bandwidth", type = float, default = None,
+         help = "Server bandwidth per connection in MB/s (default unlimited).")
+   parser.add_argument("--json", type = str, default = None, help = "Write the results to this file (JSON).")
+   args = parser.parse_args()
+
+   for name in args.scenarios:
+      if not name in SCENARIOS: parser.error(f"Unknown scenario \"{name}\"")
+
+   from s3server import s3Server, writeBucket
+
+   args.dates   = [dt.datetime(2000, 1, 1) + dt.timedelta(i) for i in range(args.ndates)]
+   args.members = ["c00"] + [f"p{i:02d}" for i in range(1, args.nmembers)]
+   args.steps   = list(range(6, 241, 6))
+
+   tmpdir  = None if args.workdir else tempfile.TemporaryDirectory(prefix = "GFSV2_benchmark_")
+   workdir = args.workdir if args.workdir else tmpdir.name
+   root    = os.path.join(workdir, "bucket_{:d}x{:d}".format(*args.grid))
+   log.info(f"Writing synthetic bucket to {root}")
+   total   = writeBucket(root, args.dates, args.members, params = ["tmp_pres", "tmax_2m", "pres_msl"],
+                         ni = args.grid[0], nj = args.grid[1])
+   log.info("Bucket: {:d} dates, {:d} members, {:.1f} MB".format(len(args.dates), len(args.members), total / 1024.**2))
+
+   server  = s3Server(root, latency = args.latency, bandwidth = args.bandwidth)
+   log.info(f"Serving bucket on {server.url} (latency {args.latency} s, bandwidth {args.bandwidth} MB/s)")
+
+   results = []
+   try:
+      for name in args.scenarios:
+         log.info(f"Running scenario {name}")
+         res = runScenario(name, SCENARIOS[name], server, workdir, args)
+         if res["status"] != 0: log.error(f"Scenario {name} failed, see {os.path.join(workdir, name + '.log')}")
+         results.append(res)
+   finally:
+      server.close()
+
+   log.info("{:12s} {:>6s} {:>8s} {:>8s} {:>8s} {:>8s} {:>9s} {:>8s}".format(
+            "scenario", "files", "MB", "seconds", "files/s", "MB/s", "requests", "peak MB"))
+   for res in results:
+      log.info("{:12s} {:6d} {:8.1f} {:8.2f} {:8.2f} {:8.2f} {:9d} {:8.1f}".format(
+               res["scenario"], res["files"], res["MB"], res["seconds"], res["files/s"],
+               res["MB/s"], res["requests"], res["peak MB"]))
+   if args.json:
+      with open(args.json, "w") as fid: json.dump(results, fid, indent = 2)
+   if tmpdir: tmpdir.cleanup()
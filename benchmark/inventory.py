@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# -------------------------------------------------------------------
+# - NAME:        inventory.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Micro-benchmark for parsing and filtering inventory
+#                files (GFSV2.getInventory). Uses synthetic inventories
+#                similar to the GFS reforecast version 12 .idx files,
+#                no network access required.
+#
+#                Usage: python benchmark/inventory.py [ninventories]
+# -------------------------------------------------------------------
+
+import logging
+logging.basicConfig(format = "# %(levelname)s %(message)s", level = logging.INFO)
+log = logging.getLogger()
+
+# -------------------------------------------------------------------
+# -------------------------------------------------------------------
+def synthetic_inventory(date, param, levels, steps):
+   """Returns the lines of a synthetic inventory file."""
+   lines = []; offset = 0
+   for step in steps:
+      for level in levels:
+         desc = "2 m above ground" if level is None else f"{level:d} mb"
+         lines.append(f"{len(lines) + 1:d}:{offset:d}:d={date:s}:{param.upper():s}:{desc:s}:{step:d} hour fcst:ENS=+1")
+         offset += 200000
+   return lines
+
+
+# -------------------------------------------------------------------
+# Main part of the script
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+   import sys, time, tracemalloc
+   from GFSV2.getInventory import parseInventory, filterEntries
+
+   ninv   = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+   levels = [1000, 925, 850, 700, 500, 300, 250, 200]
+   steps  = list(range(3, 243, 3))
+   lines  = synthetic_inventory("2000010100", "tmp_pres", levels, steps)
+   log.info(f"Parsing {ninv:d} inventories with {len(lines):d} lines each")
+
+   # Parsing
+   timer   = time.perf_counter()
+   entries = [parseInventory(f"file_{i:d}.grib2", lines) for i in range(ninv)]
+   tparse  = time.perf_counter() - timer
+
+   # Memory (separately, tracemalloc slows down the parsing)
+   tracemalloc.start()
+   tmp     = parseInventory("file.grib2", lines)
+   mem     = tracemalloc.get_traced_memory()[0]
+   tracemalloc.stop()
+   del tmp
+
+   # Filtering
+   timer   = time.perf_counter()
+   nkeep   = sum([len(filterEntries(x, [500, 850], [6, 9, 24, 48, 240])) for x in entries])
+   tfilter = time.perf_counter() - timer
+
+   nlines = ninv * len(lines)
+   log.info("- {:20s} {:.3f} s ({:.0f} lines/s)".format("Parsing:", tparse, nlines / tparse))
+   log.info("- {:20s} {:.3f} s ({:.0f} entries/s, {:d} kept)".format("Filtering:", tfilter, nlines / tfilter, nkeep))
+   log.info("- {:20s} {:.0f} bytes/entry".format("Memory:", mem / len(lines)))
@@ -0,0 +1,311 @@
+#!/usr/bin/python
+# -------------------------------------------------------------------
+# - NAME:        s3server.py
+# - AUTHOR:      Reto Stauffer
+# - DATE:        2022-09-18
+# -------------------------------------------------------------------
+# - DESCRIPTION: Local stand-in for the noaa-gefs-retrospective S3
+#                bucket used by the benchmarks. Writes synthetic GRIB2
+#                files (regular lat/lon grid, simple packing) with
+#                matching .idx inventories using the same directory
+#                layout as the bucket and serves them via http
+#                (range and multi-range requests, HEAD, ListObjectsV2)
+#                with configurable latency, bandwidth and error injection.
+#
+#                Usage: python benchmark/s3server.py <directory> [port]
+# -------------------------------------------------------------------
+
+import logging
+log = logging.getLogger("benchmark.s3server")
+
+import os, struct, threading, time, random, zlib
+
+# Parameters provided by the synthetic bucket; name used in the
+# inventory, level type and whether or not the field is a
+# maximum over the last 3 hours.
+PARAMS = {"tmp_pres": ("TMP",  [1000, 925, 850, 700, 500, 300, 250, 200], False),
+          "hgt_pres": ("HGT",  [1000, 925, 850, 700, 500, 300, 250, 200], False),
+          "tmax_2m":  ("TMAX", None, True),
+          "pres_msl": ("PRMSL", None, False)}
+
+# -------------------------------------------------------------------
+# Synthetic GRIB2 data
+# -------------------------------------------------------------------
+def _signed(value, nbytes):
+   """GRIB2 sign-magnitude representation of negative integers."""
+   return (abs(value) | (1 << (8 * nbytes - 1))) if value < 0 else value
+
+def gribMessage(step, level, ni = 72, nj = 37, nbits = 12, seed = 0):
+   """gribMessage(step, level, ni = 72, nj = 37, nbits = 12, seed = 0)
+
+   Returns one GRIB2 message (bytes) on a global regular lat/lon grid
+   with 'ni' x 'nj' points (simple packing, 'nbits' bits per value).
+   The data values are pseudo-random (reproducible via 'seed').
+   """
+   npts = ni * nj
+   dlon = int(360e6 / ni); dlat = int(180e6 / (nj - 1))
+   s1   = struct.pack(">IBHHBBBHBBBBBBB", 21, 1, 7, 0, 2, 1, 1, 2000, 1, 1, 0, 0, 0, 0, 1)
+   t30  = struct.pack(">BBIBIBIIIIIIIBIIIIB", 6, 0, 0, 0, 0, 0, 0, ni, nj, 0, 0xFFFFFFFF,
+                      90000000, 0, 48, _signed(-90000000, 4), 360000000 - dlon, dlon, dlat, 0)
+   s3   = struct.pack(">IBBIBBH", 14 + len(t30), 3, 0, npts, 0, 0, 0) + t30
+   t40  = struct.pack(">BBBBBHBBIBBIBBI", 0, 0, 2, 0, 0, 0, 0, 1, step,
+                      100 if level else 103, 0, (level or 2) * (100 if level else 1), 255, 0, 0)
+   s4   = struct.pack(">IBHH", 9 + len(t40), 4, 0, 0) + t40
+   s5   = struct.pack(">IBIH", 21, 5, npts, 0) + struct.pack(">fhhBB", 200.0, 0, 0, nbits, 0)
+   s6   = struct.pack(">IBB", 6, 6, 255)
+   data = random.Random(seed).randbytes((npts * nbits + 7) // 8)
+   s7   = struct.pack(">IB", 5 + len(data), 7) + data
+   body = s1 + s3 + s4 + s5 + s6 + s7 + b"7777"
+   return b"GRIB\0\0\0\2" + struct.pack(">Q", 16 + len(body)) + body
+
+
+def writeBucket(root, dates, members, params = None, steps = range(3, 243, 3), ni = 72, nj = 37):
+   """writeBucket(root, dates, members, params = None, steps = range(3, 243, 3), ni = 72, nj = 37)
+
+   Writes synthetic GRIB2 files and .idx inventories into 'root' using
+   the layout of the noaa-gefs-retrospective bucket, i.e.,
+   'GEFSv12/reforecast/%Y/%Y%m%d%H/<member>/Days:1-10/<param>_%Y%m%d%H_<member>.grib2'.
+   Files which already exist are kept (re-used across benchmark runs).
+
+   Params
+   ------
+   root : str
+        Target directory.
+   dates : list
+        List of datetime.datetime objects.
+   members : list
+        List of members (e.g., ["c00", "p01"]).
+   params : None or list
+        Parameters to write (keys of PARAMS); all if None.
+   steps : list
+        Forecast steps (hours).
+   ni, nj : int
+        Number of grid points in longitude and latitude direction.
+
+   Return
+   ------
+   int : Total number of bytes of all grib files.
+   """
+   total = 0
+   for date in dates:
+      for member in members:
+         for param in (params or PARAMS.keys()):
+            name, levels, maximum = PARAMS[param]
+            path = os.path.join(root, date.strftime("GEFSv12/reforecast/%Y/%Y%m%d%H"), member,
+                                "Days:1-10", f"{param}_{date:%Y%m%d%H}_{member}.grib2")
+            if os.path.isfile(path) and os.path.isfile(path + ".idx"):
+               total += os.path.getsize(path); continue
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            lines = []; offset = 0
+            with open(path + ".tmp", "wb") as fid:
+               for step in steps:
+                  for level in (levels or [None]):
+                     msg  = gribMessage(step, level, ni, nj, seed = zlib.crc32(f"{date}{member}{param}{step}{level}".encode()))
+                     desc = f"{level:d} mb" if level else ("2 m above ground" if maximum else "mean sea level")
+                     fcst = f"{step - 3:d}-{step:d} hour max fcst" if maximum else f"{step:d} hour fcst"
+                     lines.append(f"{len(lines) + 1:d}:{offset:d}:d={date:%Y%m%d%H}:{name:s}:{desc:s}:{fcst:s}:ENS=+0")
+                     fid.write(msg); offset += len(msg)
+            with open(path + ".idx", "w") as fid: fid.write("\n".join(lines) + "\n")
+            os.rename(path + ".tmp", path)
+            total += offset
+   return total
+
+
+# -------------------------------------------------------------------
+# http server
+# -------------------------------------------------------------------
+class s3Server:
+   """Serves the files in 'root' via http on 127.0.0.1 in a background
+   thread. Supports GET/HEAD, single and multi-range requests, bucket
+   listings (ListObjectsV2, 'GET /?list-type=2&prefix=...', paginated)
+   and keep-alive connections.
+
+   Params
+   ------
+   root : str
+        Directory to be served (see writeBucket()).
+   port : int
+        Port, 0 to pick a free one (see attribute 'port').
+   latency : float
+        Seconds added before each response is sent.
+   bandwidth : None or float
+        Bandwidth limit per connection in megabytes per second.
+   fail_every : int
+        If > 0, every n-th range request is interrupted after
+        sending half of the data (truncated response).
+   throttle_every : int
+        If > 0, every n-th request is answered with HTTP 503
+        ('SlowDown') and 'Retry-After: 1'.
+
+   Return
+   ------
+   No return, initializes an object of class s3Server. The counters
+   'requests' and 'bytes' can be reset via reset().
+   """
+
+   def __init__(self, root, port = 0, latency = 0., bandwidth = None, fail_every = 0, throttle_every = 0):
+      import http.server
+      self.root           = root
+      self.latency        = latency
+      self.bandwidth      = bandwidth
+      self.fail_every     = fail_every
+      self.throttle_every = throttle_every
+      self._lock          = threading.Lock()
+      self.reset()
+
+      server = self
+      class handler(http.server.BaseHTTPRequestHandler):
+         protocol_version = "HTTP/1.1"
+         disable_nagle_algorithm = True
+         def log_message(self, *args): pass
+         def do_HEAD(self): server._handle(self, head = True)
+         def do_GET(self):  server._handle(self, head = False)
+
+      self._httpd = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+      self._httpd.daemon_threads = True
+      self.port   = self._httpd.server_address[1]
+      self.url    = f"http://127.0.0.1:{self.port:d}"
+      threading.Thread(target = self._httpd.serve_forever, daemon = True).start()
+
+   def reset(self):
+      """reset()
+
+      Resets the request and byte counters.
+      """
+      with self._lock:
+         self.requests = 0
+         self.bytes    = 0
+
+   def close(self):
+      """close()
+
+      Stops the server.
+      """
+      self._httpd.shutdown()
+      self._httpd.server_close()
+
+   # ----------------------------------------------------------------
+   # ----------------------------------------------------------------
+   def _send(self, handler, body):
+      """Sends the body in chunks, honoring the bandwidth limit."""
+      chunk = 65536
+      start = time.monotonic()
+      for i in range(0, len(body), chunk):
+         handler.wfile.write(body[i:i + chunk])
+         if self.bandwidth:
+            wait = (i + chunk) / (self.bandwidth * 1024.**2) - (time.monotonic() - start)
+            if wait > 0: time.sleep(wait)
+      with self._lock: self.bytes += len(body)
+
+   def _handle(self, handler, head):
+      with self._lock:
+         self.requests += 1
+         count = self.requests
+      if self.latency > 0: time.sleep(self.latency)
+
+      def reply(status, body = b"", headers = {}):
+         handler.send_response(status)
+         for key,val in headers.items(): handler.send_header(key, val)
+         handler.send_header("Content-Length", str(len(body)))
+         handler.end_headers()
+         if not head: self._send(handler, body)
+
+      if self.throttle_every > 0 and count % self.throttle_every == 0:
+         return reply(503, b"SlowDown", {"Retry-After": "1"})
+
+      if handler.path.startswith("/?"):
+         return reply(*self._list(handler.path[2:]))
+
+      path = os.path.join(self.root, handler.path.split("?")[0].lstrip("/"))
+      if not os.path.isfile(path): return reply(404)
+      size = os.path.getsize(path)
+
+      rng = handler.headers.get("Range")
+      if not rng:
+         with open(path, "rb") as fid: return reply(200, fid.read(), {"Content-Type": "application/octet-stream"})
+
+      # Only the bytes requested are read
+      spans = []
+      for part in rng.split("=", 1)[1].split(","):
+         a, b = part.strip().split("-")
+         spans.append((int(a), min(int(b) if b else size - 1, size - 1)))
+      with open(path, "rb") as fid:
+         data = []
+         for a,b in spans:
+            fid.seek(a); data.append(fid.read(b - a + 1))
+      if len(spans) == 1:
+         a, b = spans[0]
+         body = data[0]
+         headers = {"Content-Type": "application/octet-stream",
+                    "Content-Range": f"bytes {a:d}-{b:d}/{size:d}"}
+      else:
+         boundary = "GFSV2BENCHMARK"
+         body = b"".join([f"\r\n--{boundary:s}\r\nContent-Type: application/octet-stream\r\n".encode() +
+                          f"Content-Range: bytes {a:d}-{b:d}/{size:d}\r\n\r\n".encode() + x
+                          for (a,b),x in zip(spans, data)]) + f"\r\n--{boundary:s}--\r\n".encode()
+         headers = {"Content-Type": f"multipart/byteranges; boundary={boundary:s}"}
+
+      # Error injection: send half of the data and close the connection
+      if self.fail_every > 0 and count % self.fail_every == 0 and not head:
+         handler.send_response(206)
+         for key,val in headers.items(): handler.send_header(key, val)
+         handler.send_header("Content-Length", str(len(body)))
+         handler.end_headers()
+         self._send(handler, body[:len(body) // 2])
+         handler.close_connection = True
+         return
+      reply(206, body, headers)
+
+
+   def _list(self, query, max_keys = 1000):
+      """Bucket listing (ListObjectsV2); returns (status, body, headers)."""
+      import base64, urllib.parse
+      from xml.sax.saxutils import escape
+      args = dict(urllib.parse.parse_qsl(query))
+      if args.get("list-type") != "2": return (400, b"Only ListObjectsV2 supported")
+      prefix   = args.get("prefix", "")
+      max_keys = min(max_keys, int(args.get("max-keys", max_keys)))
+      after    = base64.urlsafe_b64decode(args["continuation-token"]).decode() if "continuation-token" in args else ""
+      keys = []
+      for path, dirs, files in os.walk(self.root):
+         for file in files:
+            key = os.path.relpath(os.path.join(path, file), self.root).replace(os.sep, "/")
+            if key.startswith(prefix) and key > after and not key.endswith(".tmp"): keys.append(key)
+      keys.sort()
+      page = keys[:max_keys]
+      xml  = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?>",
+              "<ListBucketResult xmlns=\"http://s3.amazonaws.com/doc/2006-03-01/\">",
+              f"<Prefix>{escape(prefix)}</Prefix><KeyCount>{len(page):d}</KeyCount><MaxKeys>{max_keys:d}</MaxKeys>",
+              f"<IsTruncated>{'true' if len(keys) > max_keys else 'false'}</IsTruncated>"]
+      if len(keys) > max_keys:
+         xml.append(f"<NextContinuationToken>{base64.urlsafe_b64encode(page[-1].encode()).decode()}</NextContinuationToken>")
+      for key in page:
+         size = os.path.getsize(os.path.join(self.root, key))
+         xml.append(f"<Contents><Key>{escape(key)}</Key><Size>{size:d}</Size></Contents>")
+      xml.append("</ListBucketResult>")
+      return (200, "".join(xml).encode("UTF-8"), {"Content-Type": "application/xml"})
+
+
+# -------------------------------------------------------------------
+# Main part of the script
+# -------------------------------------------------------------------
+if __name__ == "__main__":
+
+   import argparse
+   logging.basicConfig(format = "# %(levelname)s %(message)s", level = logging.INFO)
+
+   parser = argparse.ArgumentParser(description = "Serves a synthetic noaa-gefs-retrospective bucket.")
+   parser.add_argument("root", type = str, help = "Directory to be served.")
+   parser.add_argument("port", type = int, nargs = "?", default = 8765, help = "Port (default 8765).")
+   parser.add_argument("--latency", type = float, default = 0., help = "Seconds added per request.")
+   parser.add_argument("--bandwidth", type = float, default = None, help = "Megabytes per second and connection.")
+   parser.add_argument("--fail-every", type = int, default = 0, help = "Truncate every n-th range request.")
+   parser.add_argument("--throttle-every", type = int, default = 0, help = "Answer every n-th request with 503.")
+   args = parser.parse_args()
+
+   server = s3Server(args.root, args.port, args.latency, args.bandwidth, args.fail_every, args.throttle_every)
+   log.info(f"Serving {args.root} on {server.url}")
+   try:
+      while True: time.sleep(3600)
+   except KeyboardInterrupt:
+      server.close()
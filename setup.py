@@ -34,7 +34,10 @@ setup(name="GFSV2",     # This is the package name
       ],
       scripts=["bin/GFSV2_bulk",
                "bin/GFSV2_get",
-               "bin/GFSV2_defaultconfig"],
+               "bin/GFSV2_defaultconfig",
+               "bin/GFSV2_daemon",
+               "bin/GFSV2_client",
+               "bin/GFSV2_verify"],
       include_package_data=True,
       czip_safe=False)
 